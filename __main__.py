@@ -1,46 +1,31 @@
+import json
 from datetime import timedelta
 
-import asyncio
-import logging
-import os
+import time
 import humanize
 from fastapi import Request
-from fastapi.responses import RedirectResponse, FileResponse
+from fastapi.responses import RedirectResponse
 from nicegui import ui, app
-from plexapi.collection import *
-from plexapi.video import *
-from plexapi.media import MediaPart, Media
 
 from config import config
-from login import check_login, logout
+from login import check_login, logout, remember_session
+import plex
 from plex import get_server, get_self
 from locales import _
 
-from common import io_bound
-
-
-logger = logging.getLogger("plexdlweb.download")
-
-
-class DownloadFileResponse(FileResponse):
-    # Starlette's default is 64 KiB. Larger chunks reduce per-chunk overhead for
-    # multi-gigabyte video downloads while preserving Range support.
-    chunk_size = 1024 * 1024
-
-    async def __call__(self, scope, receive, send) -> None:
-        try:
-            await super().__call__(scope, receive, send)
-        except Exception:
-            logger.exception("Download failed while streaming %s", self.path)
-            raise
-
-
-DOWNLOAD_HEADERS = {
-    # Prevent common reverse proxies from buffering large responses to disk.
-    "X-Accel-Buffering": "no",
-    # Tell intermediaries not to compress or otherwise rewrite video downloads.
-    "Cache-Control": "private, no-transform",
-}
+from common import io_bound, server_pool, LatestOnly, Superseded, Overloaded, POOLS
+import search_index
+import library
+from library import Item, MediaVersion
+import thumbs
+from thumbs import thumb_url
+import media
+import api
+import metrics
+import pwa
+import zipstream
+from scheduler import scheduler
+from sessions import Login
 
 
 def apartial(func, *args, **kwargs):
@@ -51,12 +36,23 @@ def apartial(func, *args, **kwargs):
 
 @app.middleware("http")
 async def check_auth(request: Request, call_next):
+    # signed downloads, the API and metrics carry their own authorization, and are used without the session cookie;
+    # the manifest and service worker are public, and must not be redirected
+    if request.url.path.startswith(("/download/signed/", "/webseed/", "/api/", "/metrics")) \
+            or request.url.path in ("/sw.js", "/plexdlweb.webmanifest"):
+        return await call_next(request)
     # https://github.com/zauberzeug/nicegui/blob/main/examples/authentication/main.py
-    if not await check_login():
+    if not (tokens := await check_login()):
         if not request.url.path.startswith("/_nicegui") and request.url.path != "/login":
             app.storage.user['referrer_path'] = request.url.path
             return RedirectResponse('/login')
-    return await call_next(request)
+        return await call_next(request)
+    # media routes read the login from here, download workers from the shared session cookie
+    request.state.login = login = Login(*tokens)
+    response = await call_next(request)
+    if not request.url.path.startswith("/_nicegui"):
+        await remember_session(request, response, login)
+    return response
 
 
 # todo: find a way
@@ -89,34 +85,56 @@ async def header():
 
     with ui.row():
         ui.button(_("home"), on_click=lambda: ui.navigate.to("/"))
+        ui.button(_("transfers"), on_click=lambda: ui.navigate.to("/transfers"))
         ui.button(_("logout"), on_click=logout_handler)
         ui.label(_("user", user=user.email))
 
 
-@app.api_route("/download/{media}/{index}", methods=["GET", "HEAD"])
-async def download(request: Request, media: int, index: int):
+@ui.page("/transfers", title=_("transfers"))
+async def transfers():
     """
-    Downloads the specified media part from Plex
+    Live view of the downloads in progress: the user's own in detail, everyone else's as a total
     """
-    server = await get_server()
-    item = await io_bound(server.fetchItem, media)
-    part = item.media[index].parts[0]  # is there ever more than one part per media?
-    filename = os.path.basename(part.file)
-    stat_result = os.stat(part.file)
-    logger.info(
-        "Starting download media=%s index=%s filename=%r size=%s range=%r",
-        media,
-        index,
-        filename,
-        stat_result.st_size,
-        request.headers.get("range"),
-    )
-    return DownloadFileResponse(
-        part.file,
-        filename=filename,
-        stat_result=stat_result,
-        headers=DOWNLOAD_HEADERS,
-    )
+    await header()
+    user = (await get_self()).username
+    columns = [
+        {"name": "name", "label": _("file"), "field": "name", "align": "left"},
+        {"name": "progress", "label": _("progress"), "field": "progress"},
+        {"name": "speed", "label": _("speed"), "field": "speed"},
+        {"name": "elapsed", "label": _("elapsed"), "field": "elapsed"},
+    ]
+    table = ui.table(columns=columns, rows=[], row_key="id").classes(add="w-full")
+    table.props(f'no-data-label="{_("no_transfers")}"')
+    others = ui.label()
+    # bytes sent by each transfer at the previous refresh, to show current rather than average speeds
+    previous: dict[int, tuple[float, int]] = {}
+
+    async def refresh():
+        # downloads served by every process, the workers included
+        rows = await io_bound(scheduler.table.rows)
+        now = time.time()
+        speeds = {}
+        for t in rows:
+            last_time, last_sent = previous.get(t.id, (t.started, 0))
+            speeds[t.id] = (t.sent - last_sent) / max(now - last_time, 1e-3)
+            previous[t.id] = (now, t.sent)
+        for key in previous.keys() - speeds.keys():
+            del previous[key]
+        table.rows = [{
+            "id": t.id,
+            "name": t.name,
+            "progress": f"{humanize.naturalsize(t.sent)} / {humanize.naturalsize(t.size)}",
+            "speed": f"{humanize.naturalsize(speeds[t.id])}/s",
+            "elapsed": humanize.naturaldelta(timedelta(seconds=now - t.started)),
+        } for t in rows if t.user == user]
+        table.update()
+        rest = [t for t in rows if t.user != user]
+        others.set_text(_("other_transfers", count=len(rest),
+                          speed=humanize.naturalsize(sum(speeds[t.id] for t in rest))))
+        others.set_visibility(bool(rest))
+
+    await refresh()
+    ui.timer(1.0, refresh)
 
 
 @ui.page("/", title="PlexDLWeb")
@@ -148,6 +166,20 @@ async def index():
                 ui.html(text)
             return e
 
+    async def checked_download(url):
+        # ui.download would save an error or "try again later" answer as the file, so the browser asks first
+        status = await ui.run_javascript(f"return (await fetch({json.dumps(url)}, {{method: 'HEAD'}})).status")
+        if status == 200:
+            ui.download(url)
+        elif status in (202, 503):
+            ui.notify(_("download_not_ready"))
+        else:
+            ui.notify(_("download_failed", status=status), color="negative")
+
+    def torrent_button(url):
+        return ui.button(icon="hub").props("flat").tooltip(_("torrent")).on(
+            "click.stop", apartial(checked_download, url)).classes(add="px-3")
+
     def fake_button_label(text):
         return ui.label(text).classes(add="m-3 q-btn q-btn--flat p-0").style("min-height: 0")
     
@@ -172,63 +204,103 @@ async def index():
         except ValueError:
             return [*query, *new]
 
+    # searches and browsing share one slot: whatever the user asked for last cancels what is still loading
+    navigator = LatestOnly()
+
+    def navigation(func):
+        async def handler(*args):
+            loading.set_visibility(True)
+            try:
+                await func(*args)
+            except Superseded:
+                # the newer navigation owns the spinner now
+                return
+            except BaseException:
+                loading.set_visibility(False)
+                raise
+            loading.set_visibility(False)
+        return handler
+
+    def first_page(item: Item):
+        if not config.page_size:
+            return library.children(server, item), None
+        return library.children_page(server, item, 0, config.page_size)
+
     @ui.refreshable
-    def result_list(query, results):
-        def refresh(query2, results2):
+    def result_list(query, results, next_start=None):
+        """
+        next_start: where the next page of the children of the last crumb starts, if they aren't all in results
+        """
+        def refresh(query2, results2, next_start2=None):
             # don't refresh if the parameters haven't changed
             if (query2, results2) == (query, results):
                 return
-            result_list.refresh(query2, results2)
+            result_list.refresh(query2, results2, next_start2)
 
         if not query:
             return
         if not results:
             ui.label(_("no_results"))
             return
+        @navigation
+        async def browse(item: Item):
+            refresh([*query, item], *await navigator.run(server_pool.run(first_page, item)))
+
+        @navigation
+        async def browse_episode(e: Item):
+            # the show and season crumbs come from the episode itself, only the episode list needs a request
+            sea = library.season_of(e)
+            refresh(merge(query, [library.show_of(e), sea]), *await navigator.run(server_pool.run(first_page, sea)))
+
         kinds = {
-            Movie: (
+            "movie": (
                 _("movie"),
                 "bg-green-300",
-                lambda m: (f"<span style='font-size: 70%'>{m.editionTitle}</span><br>" if m.editionTitle else "") + m.title,
-                lambda m: print(list(m.iterParts()))
+                lambda m: (f"<span style='font-size: 70%'>{m.edition_title}</span><br>" if m.edition_title else "") + m.title,
+                # movies are downloaded from their buttons, there is nothing to browse into
+                lambda m: None
             ),
-            Show: (
+            "show": (
                 _("show"),
                 "bg-yellow-300",
                 lambda s: s.title,
-                lambda s: refresh([*query, s], s.seasons())
+                browse
             ),
-            Season: (
+            "season": (
                 _("season"),
                 "bg-red-300",
-                lambda s: f"{s.parentTitle} - {s.title}",
-                lambda s: refresh([*query, s], s.episodes())
+                lambda s: f"{s.parent_title} - {s.title}",
+                browse
             ),
-            Episode: (
+            "episode": (
                 _("episode"),
                 "bg-teal-300",
                 lambda
-                    e: f"<span style='font-size: 70%'>{e.grandparentTitle} - {e.parentTitle} - {_('episode')} {e.index}</span><br>{e.title}",
-                lambda e: refresh(merge(query, [e.show(), sea := e.season()]), sea.episodes())
+                    e: f"<span style='font-size: 70%'>{e.grandparent_title} - {e.parent_title} - {_('episode')} {e.index}</span><br>{e.title}",
+                browse_episode
             ),
-            Collection: (
+            "collection": (
                 _("collection"),
                 "bg-violet-300",
                 lambda c: c.title,
-                lambda c: refresh([*query, c], c.items())
+                browse
             ),
-            str: (
+            "search": (
                 _("search_noun"),
                 "bg-blue-300",
                 lambda s: s,
                 lambda s: do_search(s, True)
             )
         }
+
+        def kind_of(x):
+            return "search" if isinstance(x, str) else x.type
+
         result_as_list = app.storage.user.get("result_as_list", False)
         with ui.row():
             def format_change(e):
                 app.storage.user['result_as_list'] = e.value
-                result_list.refresh(query, results)
+                result_list.refresh(query, results, next_start)
 
             ui.label(_("display"))
             ui.toggle({False: _("grid"), True: _("list")}, value=result_as_list, on_change=format_change)
@@ -237,7 +309,7 @@ async def index():
             ui.label(_("history"))
 
             def display_crumb(i, part):
-                kind, color, namer, clicked = kinds[type(part)]
+                kind, color, namer, clicked = kinds[kind_of(part)]
 
                 async def handler():
                     del query[i:]
@@ -249,38 +321,44 @@ async def index():
 
             for i, part in enumerate(query):
                 display_crumb(i, part)
-                
-        with ui.column() if result_as_list else ui.grid(columns=3):
+
+        with ui.column() if result_as_list else ui.grid(columns=3) as container:
             def display_result(r):
-                opts = kinds.get(type(r), None)
+                opts = kinds.get(kind_of(r), None)
                 if opts is None:
                     return
                 kind, color, namer, clicked = opts
 
                 def dl_button():
-                    if isinstance(r, Playable):
+                    if r.playable and r.media:
                         if len(r.media) > 1:
                             def handler():
-                                def part_line(i, media: Media):
-                                    part = media.parts[0]
-                                    fake_button_label(duration_to_string(part.duration)).style("text-transform: none").classes(add="text-right")
+                                def part_line(i, media: MediaVersion):
+                                    fake_button_label(duration_to_string(media.duration or 0)).style("text-transform: none").classes(add="text-right")
                                     fake_button_label(f"{media.width}x{media.height}").style("text-transform: none")
-                                    fake_button_label(humanize.naturalsize(part.size)).classes(add="text-right")
-                                    ui.button(icon="download").props("flat").on("click.stop", lambda: ui.download(f"/download/{r.ratingKey}/{i}")).classes(add="px-3")
+                                    fake_button_label(humanize.naturalsize(media.size or 0)).classes(add="text-right")
+                                    ui.button(icon="download").props("flat").on("click.stop", lambda: ui.download(f"/download/{r.rating_key}/{i}")).classes(add="px-3")
+                                    torrent_button(f"/torrent/{r.rating_key}.torrent?index={i}")
                                 with ui.dialog() as dialog, ui.card():
-                                    with ui.grid(columns=4):
+                                    with ui.grid(columns=5):
                                         for i, media in enumerate(r.media):
                                             part_line(i, media)
                                 dialog.open()
                         else:
                             def handler():
-                                ui.download(f"/download/{r.ratingKey}/0")
-                        part = r.media[0].parts[0]
-                        fake_button_label(duration_to_string(part.duration)).classes(add="ml-auto self-center").style(
+                                ui.download(f"/download/{r.rating_key}/0")
+                        media = r.media[0]
+                        fake_button_label(duration_to_string(media.duration or 0)).classes(add="ml-auto self-center").style(
                             "text-transform: none; font-size: 90%")
-                        fake_button_label(humanize.naturalsize(part.size)).classes(add="mx-0 self-center").style(
+                        fake_button_label(humanize.naturalsize(media.size or 0)).classes(add="mx-0 self-center").style(
                             "font-size: 90%")
                         ui.button(icon="download").props("flat").on("click.stop", handler).classes(add="px-3")
+                        if len(r.media) == 1:
+                            torrent_button(f"/torrent/{r.rating_key}.torrent")
+                    elif r.type in ("show", "season", "collection"):
+                        ui.button(icon="download").props("flat").on(
+                            "click.stop", apartial(checked_download, f"/download/bundle/{r.rating_key}")).classes(add="ml-auto px-3")
+                        torrent_button(f"/torrent/{r.rating_key}.torrent")
 
                 if result_as_list:
                     with fake_button_group().on("click", lambda: clicked(r)).classes(add="w-full cursor-pointer-rec"):
@@ -292,12 +370,42 @@ async def index():
                         with ui.card_section().classes(add=color).classes(add="p-0 row w-full"):
                             fake_button_label(kind)
                             dl_button()
-                        ui.image("/plex" + r.thumb)
+                        if thumb := thumb_url(r):
+                            ui.image(thumb).props("loading=lazy")
                         with ui.card_section().classes(add="mt-auto"):
                             ui.html("<span style='font-size: 120%'>" + namer(r) + "</span>")
 
-            for r in results:
-                display_result(r)
+        # only a page of results is in the DOM at first, the next ones are rendered (and fetched from Plex for
+        # browsed items) as the user asks for them
+        page = config.page_size or len(results)
+        results = list(results)
+        shown = 0
+
+        def show_page():
+            nonlocal shown
+            with container:
+                for r in results[shown:shown + page]:
+                    display_result(r)
+            shown = min(len(results), shown + page)
+            more.set_visibility(shown < len(results) or next_start is not None)
+
+        @navigation
+        async def show_more():
+            nonlocal next_start
+            if shown >= len(results) and next_start is not None:
+                more.props("loading")
+                try:
+                    items, next_start = await navigator.run(
+                        server_pool.run(library.children_page, server, query[-1], next_start, page))
+                finally:
+                    more.props(remove="loading")
+                if container.is_deleted:
+                    return
+                results.extend(items)
+            show_page()
+
+        more = ui.button(_("load_more"), on_click=show_more).props("flat").classes(add="self-center")
+        show_page()
 
     last_search = None
 
@@ -308,15 +416,11 @@ async def index():
         previous, last_search = last_search, query
         if not force and query == previous or len(query) < 3:
             return
+        await show_search(query)
 
-        loading.set_visibility(True)
-        results = await io_bound(server.search, query)
-        async def all_editions(x):
-            if isinstance(x, Movie):
-                return [x, *(await io_bound(x.editions))]
-            return [x]
-        result_list.refresh([query], [item for editions in (await asyncio.gather(*[all_editions(res) for res in results])) for item in editions])
-        loading.set_visibility(False)
+    @navigation
+    async def show_search(query):
+        result_list.refresh([query], await navigator.run(search_index.search(server, query)))
 
     debounce = None
 
@@ -337,32 +441,25 @@ async def index():
     result_list([], [])
 
 
-@app.get("/plexdlweb.webmanifest")
-def manifest():
-    return {
-        "name": "PlexDLWeb",
-        "short_name": "Volume",
-        "start_url": "/",
-        "display": "standalone",
-        "background_color": "#282a2d",
-        "theme_color": "#000",
-        "icons": [
-            {
-                "src": "https://app.plex.tv/desktop/static/icon-ipad@2x.png",
-                "sizes": "512x512",
-                "type": "image/png"
-            }
-        ]
-    }
-
-
-@app.get("/sw.js")
-def sw():
-    return """
-    self.addEventListener('install', function(event) {});
-    self.addEventListener('fetch', function(event) {});
-    self.addEventListener('activate', function(event) {});
-    """
-
+@app.on_shutdown
+def shutdown_pools():
+    for pool in POOLS:
+        pool.shutdown()
+
+
+app.include_router(media.router)
+app.include_router(plex.router)
+app.include_router(thumbs.router)
+app.include_router(api.router)
+app.include_router(metrics.router)
+app.include_router(pwa.router)
+app.add_middleware(metrics.MetricsMiddleware)
+# files of workers that exited before the UI restarted
+app.on_startup(metrics.clean)
+app.on_startup(metrics.startup)
+app.on_shutdown(metrics.shutdown)
+app.on_shutdown(zipstream.shutdown)
+app.add_exception_handler(Overloaded, media.overloaded)
+app.add_exception_handler(TimeoutError, media.timed_out)
 
 ui.run(host=config.host, port=config.port, show=False, storage_secret=config.secret, gzip_middleware_factory=None)
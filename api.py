@@ -0,0 +1,253 @@
+"""
+JSON API for scripts and mobile clients: search, browsing and signed download links, without the NiceGUI UI.
+
+Requests authenticate with the user's Plex token as a bearer token (Authorization: Bearer <token>). Lists are paged
+with opaque cursors (the remaining keys of a search, so later pages neither search again nor shift), metadata
+responses carry an ETag derived from the items' Plex updatedAt so clients can revalidate them with If-None-Match, and
+are compressed (brotli when its package is installed, else gzip) when the client accepts it; downloads themselves go
+through the signed URLs, which are never compressed.
+"""
+import base64
+import gzip
+import hashlib
+import importlib
+import json
+import logging
+import zlib
+from dataclasses import dataclass
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import Response
+from plexapi.server import PlexServer
+
+import library
+import search_index
+from bundles import bundle_files, manifest_entry
+from common import io_bound, server_pool, TTLCache, SingleFlight
+from config import config
+from library import Item, MediaVersion
+from plex import account_for_token, server_for_token, get_server_token, check_tokens
+
+logger = logging.getLogger("plexdlweb.api")
+
+try:
+    brotli = importlib.import_module("brotli")
+except ImportError:
+    brotli = None
+
+MAX_LIMIT = 500
+# smaller bodies aren't worth compressing
+MIN_COMPRESSED_SIZE = 1024
+# decoded size of a search cursor, a comma-separated list of ratingKeys
+MAX_SEARCH_CURSOR = 64 * 1024
+
+router = APIRouter(prefix="/api/v1")
+
+# user token hash -> server token, so requests don't list the account's resources on plex.tv each time
+_server_tokens = TTLCache(maxsize=config.plex_pool_size, ttl=config.auth_cache_ttl)
+_resolving = SingleFlight()
+
+
+@dataclass(frozen=True)
+class Session:
+    user: str
+    server: PlexServer
+    # the server token the user's token resolved to
+    server_token: str
+
+
+async def _server_token(key: str, user_token: str) -> str:
+    token = await get_server_token(user_token)
+    _server_tokens.set(key, token)
+    return token
+
+
+async def session(request: Request) -> Session:
+    """
+    The user and server of the bearer token, or 401
+    """
+    scheme, _, user_token = request.headers.get("authorization", "").partition(" ")
+    user_token = user_token.strip()
+    if scheme.lower() != "bearer" or not user_token:
+        raise HTTPException(status_code=401, headers={"WWW-Authenticate": "Bearer"})
+    key = hashlib.sha256(user_token.encode()).hexdigest()
+    try:
+        if (server_token := _server_tokens.get(key)) is None:
+            server_token = await _resolving.run(key, _server_token, key, user_token)
+        if not await check_tokens(user_token, server_token):
+            raise ValueError("token rejected")
+        account = await account_for_token(user_token)
+        server = await server_for_token(server_token)
+    except Exception as e:
+        logger.info("Rejected API token: %s", e)
+        _server_tokens.pop(key)
+        raise HTTPException(status_code=401, headers={"WWW-Authenticate": 'Bearer error="invalid_token"'})
+    return Session(account.username, server, server_token)
+
+
+def _compact(d: dict) -> dict:
+    return {k: v for k, v in d.items() if v not in (None, "", [], ())}
+
+
+def _media(m: MediaVersion) -> dict:
+    # file paths are the server's business, clients download through signed URLs
+    return _compact({"width": m.width, "height": m.height, "duration": m.duration, "size": m.size})
+
+
+def _item(i: Item) -> dict:
+    return _compact({
+        "key": i.rating_key,
+        "type": i.type,
+        "title": i.title,
+        "edition": i.edition_title,
+        "index": i.index,
+        "parent": _compact({"key": i.parent_key, "title": i.parent_title}) or None,
+        "grandparent": _compact({"key": i.grandparent_key, "title": i.grandparent_title}) or None,
+        "updated": i.updated_at,
+        "media": [_media(m) for m in i.media],
+    })
+
+
+def _etag(request: Request, items: list[Item]) -> str:
+    h = hashlib.sha256(str(request.url.path).encode() + b"?" + str(request.url.query).encode())
+    for i in items:
+        h.update(b"%d:%d;" % (i.rating_key, i.updated_at or 0))
+    return f'W/"{h.hexdigest()[:32]}"'
+
+
+def _accepts(request: Request, encoding: str) -> bool:
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, q = part.strip().partition(";")
+        if name.strip().lower() == encoding:
+            return q.strip().replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def _respond(request: Request, data, etag: Optional[str] = None) -> Response:
+    """
+    Compact JSON, or 304 when the client's copy is still current, compressed when that helps
+    """
+    headers = {"Vary": "Accept-Encoding, Authorization"}
+    if etag is None:
+        headers["Cache-Control"] = "private, no-store"
+    else:
+        headers.update({"ETag": etag, "Cache-Control": "private, no-cache"})
+        if etag in (t.strip() for t in request.headers.get("if-none-match", "").split(",")):
+            return Response(status_code=304, headers=headers)
+    body = json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+    if len(body) >= MIN_COMPRESSED_SIZE:
+        if brotli is not None and _accepts(request, "br"):
+            body = brotli.compress(body, quality=5)
+            headers["Content-Encoding"] = "br"
+        elif _accepts(request, "gzip"):
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def _limit(limit: Optional[int]) -> int:
+    return max(1, min(limit or config.page_size or MAX_LIMIT, MAX_LIMIT))
+
+
+def _cursor(cursor: Optional[str]) -> int:
+    try:
+        start = int(cursor or 0)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    if start < 0:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    return start
+
+
+def _search_cursor(keys: list[int]) -> Optional[str]:
+    if not keys:
+        return None
+    return base64.urlsafe_b64encode(zlib.compress(",".join(map(str, keys)).encode())).rstrip(b"=").decode()
+
+
+def _search_keys(cursor: str) -> list[int]:
+    try:
+        inflater = zlib.decompressobj()
+        data = inflater.decompress(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)), MAX_SEARCH_CURSOR)
+        if not inflater.eof:
+            raise ValueError("cursor too large")
+        return [int(k) for k in data.decode().split(",")]
+    except (ValueError, zlib.error):
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+
+def _page(request: Request, items: list[Item], next_start: int | str | None) -> Response:
+    data = {"items": [_item(i) for i in items]}
+    if next_start is not None:
+        data["next"] = str(next_start)
+    return _respond(request, data, _etag(request, items))
+
+
+async def _fetch(s: Session, key: int) -> Item:
+    if (item := await server_pool.run(library.fetch_item, s.server, key)) is None:
+        raise HTTPException(status_code=404)
+    return item
+
+
+@router.get("/search")
+async def search(request: Request, q: str, cursor: str = None, limit: int = None, s: Session = Depends(session)):
+    """
+    Items matching q, other editions of movies included; the cursor carries the keys of the remaining results
+    """
+    size = _limit(limit)
+    if cursor:
+        keys = _search_keys(cursor)
+        items = await server_pool.run(library.fetch_items, s.server, keys[:size])
+        rest = keys[size:]
+    else:
+        results = await search_index.search(s.server, q)
+        items, rest = results[:size], [i.rating_key for i in results[size:]]
+    return _page(request, items, _search_cursor(rest))
+
+
+@router.get("/items/{key}")
+async def item(request: Request, key: int, s: Session = Depends(session)):
+    """
+    An item with its media versions
+    """
+    i = await _fetch(s, key)
+    return _respond(request, _item(i), _etag(request, [i]))
+
+
+@router.get("/items/{key}/children")
+async def children(request: Request, key: int, cursor: str = None, limit: int = None,
+                   s: Session = Depends(session)):
+    """
+    Seasons of a show, episodes of a season or items of a collection, a page at a time straight from Plex
+    """
+    i = await _fetch(s, key)
+    if i.playable:
+        raise HTTPException(status_code=404)
+    items, next_start = await server_pool.run(library.children_page, s.server, i, _cursor(cursor), _limit(limit))
+    return _page(request, items, next_start)
+
+
+@router.get("/items/{key}/editions")
+async def editions(request: Request, key: int, s: Session = Depends(session)):
+    """
+    The other editions of a movie
+    """
+    items = await server_pool.run(library.editions, s.server, await _fetch(s, key))
+    return _page(request, items, None)
+
+
+@router.get("/items/{key}/downloads")
+async def downloads(request: Request, key: int, index: int = 0, s: Session = Depends(session)):
+    """
+    Signed download URLs of a movie or episode, or of every episode or movie of a show, season or collection,
+    usable without any credentials until they expire
+    """
+    i = await _fetch(s, key)
+    leaves = await server_pool.run(library.leaves, s.server, i)
+    base = str(request.base_url).rstrip("/")
+    entries = [await io_bound(manifest_entry, base, name, version, s.user, s.server_token)
+               for name, version in bundle_files(i, leaves, index)]
+    logger.info("Issued API download links media=%s files=%s user=%r", key, len(entries), s.user)
+    return _respond(request, {"files": [_compact({"name": e.name, "url": e.url, "size": e.size, "sha256": e.sha256})
+                                        for e in entries]})
@@ -0,0 +1,114 @@
+"""
+Measures the send paths of DownloadFileResponse: throughput and CPU time per GB.
+
+The response is driven by a minimal ASGI server over a loopback TCP connection. Body chunks are written with
+sock_sendall; with the path send extension offered, the server sends the whole file with sock_sendfile (os.sendfile),
+as servers implementing the extension do. Run from the repository root:
+
+    python -m benchmarks.download --size 2048 --repeat 3
+"""
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import tempfile
+import threading
+import time
+
+from download import DownloadFileResponse
+
+MiB = 1024 * 1024
+PATHSEND = "http.response.pathsend"
+
+
+def _cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _drain(sock: socket.socket, result: dict):
+    buf = memoryview(bytearray(MiB))
+    received = 0
+    while n := sock.recv_into(buf):
+        received += n
+    result["received"] = received
+    result["cpu"] = time.thread_time()
+
+
+async def serve_once(path: str, pathsend: bool, range_header: str | None) -> tuple[int, float, float]:
+    """
+    Returns (bytes received, wall seconds, CPU seconds spent outside the receiving thread)
+    """
+    loop = asyncio.get_running_loop()
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+    server.setblocking(False)
+    result = {}
+    reader = threading.Thread(target=_drain, args=(client, result))
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            await loop.sock_sendall(server, f"HTTP/1.1 {message['status']}\r\n\r\n".encode())
+        elif message["type"] == PATHSEND:
+            with open(message["path"], "rb") as file:
+                await loop.sock_sendfile(server, file)
+        else:
+            await loop.sock_sendall(server, message.get("body", b""))
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    headers = [(b"range", range_header.encode())] if range_header else []
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": headers, "asgi": {"spec_version": "2.4"},
+             "extensions": {PATHSEND: {}} if pathsend else {}}
+    response = DownloadFileResponse(path, stat_result=os.stat(path))
+    reader.start()
+    cpu, wall = _cpu_time(), time.perf_counter()
+    await response(scope, receive, send)
+    server.shutdown(socket.SHUT_WR)
+    await asyncio.to_thread(reader.join)
+    wall, cpu = time.perf_counter() - wall, _cpu_time() - cpu - result["cpu"]
+    server.close()
+    client.close()
+    return result["received"], wall, cpu
+
+
+def _make_file(size: int) -> str:
+    block = os.urandom(MiB)
+    fd, path = tempfile.mkstemp(prefix="plexdlweb-bench-")
+    with os.fdopen(fd, "wb") as f:
+        for _ in range(size // MiB):
+            f.write(block)
+    return path
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", help="file to serve (default: a temporary file of --size MiB)")
+    parser.add_argument("--size", type=int, default=1024, help="size of the temporary file in MiB")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    path = args.file or _make_file(args.size * MiB)
+    size = os.path.getsize(path)
+    try:
+        # warm the page cache so that every run reads from memory
+        await serve_once(path, False, None)
+        print(f"{'server':<16} {'request':<8} {'MB/s':>10} {'CPU s/GB':>10}")
+        for mode, pathsend in (("chunked", False), ("pathsend", True)):
+            # Range responses always go through the chunked path
+            for label, range_header in (("full", None), ("range", f"bytes={size // 2}-")):
+                total = wall = cpu = 0
+                for _ in range(args.repeat):
+                    n, w, c = await serve_once(path, pathsend, range_header)
+                    total, wall, cpu = total + n, wall + w, cpu + c
+                print(f"{mode:<16} {label:<8} {total / wall / 1e6:>10.0f} {cpu / (total / 1e9):>10.3f}")
+    finally:
+        if not args.file:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,316 @@
+"""
+A stand-in for a Plex server and plex.tv, to run PlexDLWeb and measure it without either.
+
+One ASGI app answers what PlexDLWeb asks of both: the server's /, /identity, /library/sections, hub search,
+/library/metadata (with children, all leaves and container paging), part downloads and the photo transcoder, and
+plex.tv's /api/v2/user and /api/v2/resources. Its library is generated: movies (every tenth one with a second
+edition) and shows with seasons and episodes, titled from a small vocabulary so that searches match, each backed by
+a sparse file of the requested size. Sparse files read as zeros without touching the disk, so benchmarks using them
+measure PlexDLWeb rather than the storage. Run from the repository root:
+
+    python -m benchmarks.fakeplex --dir /tmp/fakeplex --movies 2000 --shows 100 --port 32401
+
+then point PlexDLWeb at it with the settings it prints.
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from xml.etree.ElementTree import Element, SubElement, tostring
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, Response
+
+MiB = 1024 * 1024
+SERVER_ID = "fakeplex-server"
+USER_TOKEN = "fakeplex-user-token"
+SERVER_TOKEN = "fakeplex-server-token"
+USERNAME = "bench"
+
+WORDS = (
+    "alien", "american", "blue", "city", "dark", "dead", "dream", "earth", "empire", "fire", "ghost", "girl", "gold",
+    "green", "heart", "house", "ice", "island", "king", "last", "light", "lost", "love", "man", "moon", "night",
+    "ocean", "queen", "red", "river", "road", "secret", "shadow", "silent", "sky", "star", "storm", "street", "summer",
+    "sun", "time", "war", "water", "white", "wild", "wind", "winter", "wolf", "world", "young",
+)
+MOVIES, SHOWS = 1, 2
+# Plex's numeric item types, used by /library/sections/{id}/all?type=
+TYPES = {1: "movie", 2: "show", 3: "season", 4: "episode"}
+
+
+@dataclass
+class Entry:
+    key: int
+    type: str
+    title: str
+    section: int
+    parent: Optional["Entry"] = None
+    index: Optional[int] = None
+    guid: Optional[str] = None
+    edition: Optional[str] = None
+    file: Optional[str] = None
+    size: int = 0
+    children: list["Entry"] = field(default_factory=list)
+
+    @property
+    def playable(self) -> bool:
+        return self.file is not None
+
+
+class Library:
+    def __init__(self, root: str, movies: int, shows: int, seasons: int, episodes: int, file_size: int,
+                 seed: int = 0):
+        rng = random.Random(seed)
+        self.updated_at = int(time.time())
+        self.entries: dict[int, Entry] = {}
+        self.sections: dict[int, list[Entry]] = {MOVIES: [], SHOWS: []}
+
+        def title() -> str:
+            return " ".join(rng.sample(WORDS, 2)).title()
+
+        def add(entry: Entry) -> Entry:
+            self.entries[entry.key] = entry
+            if entry.parent is None:
+                self.sections[entry.section].append(entry)
+            else:
+                entry.parent.children.append(entry)
+            return entry
+
+        def media(entry: Entry, directory: str):
+            path = os.path.join(root, directory, f"{entry.key} - {entry.title}.mkv")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # sparse: allocates nothing, reads return zeros
+            with open(path, "ab") as f:
+                f.truncate(file_size)
+            entry.file, entry.size = path, file_size
+
+        key = 0
+        for n in range(movies):
+            key += 1
+            if n % 10 == 9:
+                # a second edition of the previous movie
+                previous = self.entries[key - 1]
+                movie = add(Entry(key, "movie", previous.title, MOVIES, guid=previous.guid, edition="Director's Cut"))
+            else:
+                movie = add(Entry(key, "movie", title(), MOVIES, guid=f"plex://movie/{key}"))
+            media(movie, "Movies")
+        for _ in range(shows):
+            key += 1
+            show = add(Entry(key, "show", title(), SHOWS, guid=f"plex://show/{key}"))
+            for s in range(1, seasons + 1):
+                key += 1
+                season = add(Entry(key, "season", f"Season {s}", SHOWS, parent=show, index=s))
+                for e in range(1, episodes + 1):
+                    key += 1
+                    episode = add(Entry(key, "episode", title(), SHOWS, parent=season, index=e))
+                    media(episode, os.path.join("TV Shows", f"{show.key} - {show.title}", season.title))
+
+    def leaves(self, entry: Entry) -> list[Entry]:
+        if entry.playable:
+            return [entry]
+        return [leaf for child in entry.children for leaf in self.leaves(child)]
+
+    def search(self, query: str) -> list[Entry]:
+        query = query.lower()
+        return [e for e in self.entries.values() if e.type in ("movie", "show", "episode") and query in e.title.lower()]
+
+
+def element(library: Library, e: Entry) -> Element:
+    attrs = {
+        "ratingKey": str(e.key), "key": f"/library/metadata/{e.key}", "type": e.type, "title": e.title,
+        "librarySectionID": str(e.section), "updatedAt": str(library.updated_at),
+        "thumb": f"/library/metadata/{e.key}/thumb/{library.updated_at}",
+    }
+    if e.guid:
+        attrs["guid"] = e.guid
+    if e.edition:
+        attrs["editionTitle"] = e.edition
+    if e.index is not None:
+        attrs["index"] = str(e.index)
+    if e.parent is not None:
+        attrs.update(parentRatingKey=str(e.parent.key), parentTitle=e.parent.title)
+        if e.parent.parent is not None:
+            attrs.update(grandparentRatingKey=str(e.parent.parent.key), grandparentTitle=e.parent.parent.title)
+    node = Element("Video" if e.playable else "Directory", attrs)
+    if e.playable:
+        m = SubElement(node, "Media", {"width": "1920", "height": "1080", "duration": "5400000"})
+        SubElement(m, "Part", {"key": f"/library/parts/{e.key}/{library.updated_at}/file.mkv", "file": e.file,
+                               "size": str(e.size), "duration": "5400000"})
+    return node
+
+
+def container(children: list[Element] = (), start: int = None, total: int = None, **attrs) -> Element:
+    node = Element("MediaContainer", {k: str(v) for k, v in attrs.items()})
+    node.extend(children)
+    node.set("size", str(len(children)))
+    if total is not None:
+        node.set("offset", str(start or 0))
+        node.set("totalSize", str(total))
+    return node
+
+
+def jpeg(size: int) -> bytes:
+    """
+    A JPEG-framed blob as big as a resized poster: start of image, comments as padding, end of image
+    """
+    body = bytearray(b"\xff\xd8")
+    remaining = max(0, size - 4)
+    while remaining > 4:
+        n = min(remaining - 4, 65533)
+        body += b"\xff\xfe" + (n + 2).to_bytes(2, "big") + bytes(n)
+        remaining -= n + 4
+    return bytes(body + b"\xff\xd9")
+
+
+def create_app(library: Library, latency: float = 0.0, thumb_size: int = 30 * 1024) -> FastAPI:
+    """
+    The fake server; latency (seconds) is added to every metadata answer, as a real server's processing time
+    """
+    app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+    thumbnail = jpeg(thumb_size)
+
+    async def xml(request: Request, node: Element, token: str = SERVER_TOKEN) -> Response:
+        given = request.headers.get("x-plex-token") or request.query_params.get("X-Plex-Token")
+        if given != token:
+            raise HTTPException(status_code=401)
+        if latency:
+            await asyncio.sleep(latency)
+        return Response(tostring(node, encoding="utf-8"), media_type="text/xml;charset=utf-8")
+
+    def paged(request: Request, entries: list[Entry], **attrs) -> Element:
+        params = request.query_params
+        start = int(params.get("X-Plex-Container-Start", 0))
+        size = params.get("X-Plex-Container-Size")
+        page = entries[start:start + int(size)] if size is not None else entries[start:]
+        return container([element(library, e) for e in page], start, len(entries), **attrs)
+
+    def entry(key: int, type: str = None) -> Entry:
+        if (e := library.entries.get(key)) is None or (type is not None and e.type != type):
+            raise HTTPException(status_code=404)
+        return e
+
+    @app.get("/")
+    async def root(request: Request):
+        return await xml(request, container(friendlyName="Fake Plex", machineIdentifier=SERVER_ID, version="1.40.0",
+                                            myPlex=1, myPlexUsername=USERNAME, transcoderPhoto=1))
+
+    @app.get("/identity")
+    async def identity(request: Request):
+        return await xml(request, container(machineIdentifier=SERVER_ID, version="1.40.0"))
+
+    @app.get("/library/sections")
+    async def sections(request: Request):
+        return await xml(request, container([
+            Element("Directory", {"key": str(MOVIES), "type": "movie", "title": "Movies",
+                                  "updatedAt": str(library.updated_at)}),
+            Element("Directory", {"key": str(SHOWS), "type": "show", "title": "TV Shows",
+                                  "updatedAt": str(library.updated_at)}),
+        ]))
+
+    @app.get("/library/sections/{section}/all")
+    async def section_all(request: Request, section: int, type: int = None, guid: str = None):
+        if section not in library.sections:
+            raise HTTPException(status_code=404)
+        wanted = TYPES.get(type, "movie" if section == MOVIES else "show")
+        entries = [e for e in library.entries.values() if e.section == section and e.type == wanted
+                   and (guid is None or e.guid == guid)]
+        return await xml(request, paged(request, entries, librarySectionID=section))
+
+    @app.get("/hubs/search")
+    async def search(request: Request, query: str, limit: int = 30):
+        hubs = []
+        found = library.search(query)
+        for type in ("movie", "show", "episode"):
+            hub = Element("Hub", {"type": type, "hubIdentifier": type, "title": type.title()})
+            hub.extend(element(library, e) for e in [e for e in found if e.type == type][:limit])
+            hub.set("size", str(len(hub)))
+            hubs.append(hub)
+        return await xml(request, container(hubs))
+
+    @app.get("/library/metadata/{keys}")
+    async def metadata(request: Request, keys: str):
+        try:
+            entries = [library.entries[int(k)] for k in keys.split(",") if int(k) in library.entries]
+        except ValueError:
+            raise HTTPException(status_code=400)
+        if not entries:
+            raise HTTPException(status_code=404)
+        return await xml(request, container([element(library, e) for e in entries]))
+
+    @app.get("/library/metadata/{key}/children")
+    async def children(request: Request, key: int):
+        e = entry(key)
+        return await xml(request, paged(request, e.children, librarySectionID=e.section))
+
+    @app.get("/library/metadata/{key}/allLeaves")
+    async def all_leaves(request: Request, key: int):
+        e = entry(key)
+        return await xml(request, paged(request, library.leaves(e), librarySectionID=e.section))
+
+    @app.api_route("/library/parts/{key}/{updated}/{name}", methods=["GET", "HEAD"])
+    async def part(request: Request, key: int, updated: int, name: str):
+        e = entry(key)
+        if request.headers.get("x-plex-token") != SERVER_TOKEN or not e.playable:
+            raise HTTPException(status_code=401 if e.playable else 404)
+        return FileResponse(e.file, filename=os.path.basename(e.file))
+
+    @app.get("/photo/:/transcode")
+    async def transcode(request: Request):
+        if request.headers.get("x-plex-token") != SERVER_TOKEN:
+            raise HTTPException(status_code=401)
+        if latency:
+            await asyncio.sleep(latency)
+        return Response(thumbnail, media_type="image/jpeg")
+
+    # plex.tv
+    @app.get("/api/v2/user")
+    async def user(request: Request):
+        node = Element("user", {"id": "1", "uuid": "fakeplex", "username": USERNAME, "title": USERNAME,
+                                "email": f"{USERNAME}@example.com", "authToken": USER_TOKEN, "scrobbleTypes": "1"})
+        # plexapi reads these children unconditionally
+        SubElement(node, "subscription", {"active": "0"})
+        SubElement(node, "profile")
+        return await xml(request, node, USER_TOKEN)
+
+    @app.get("/api/v2/resources")
+    async def resources(request: Request):
+        resource = Element("resource", {"name": "Fake Plex", "product": "Plex Media Server", "provides": "server",
+                                        "clientIdentifier": SERVER_ID, "accessToken": SERVER_TOKEN, "owned": "1"})
+        base = f"{request.url.scheme}://{request.url.netloc}"
+        SubElement(SubElement(resource, "connections"), "connection",
+                   {"protocol": request.url.scheme, "uri": base, "local": "1"})
+        node = Element("resources")
+        node.append(resource)
+        return await xml(request, node, USER_TOKEN)
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", required=True, help="where the sparse media files are created")
+    parser.add_argument("--movies", type=int, default=2000)
+    parser.add_argument("--shows", type=int, default=100)
+    parser.add_argument("--seasons", type=int, default=3, help="per show")
+    parser.add_argument("--episodes", type=int, default=10, help="per season")
+    parser.add_argument("--file-size", type=int, default=1024, help="size of each media file in MiB")
+    parser.add_argument("--latency", type=float, default=0, help="added to each metadata answer, in milliseconds")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=32401)
+    args = parser.parse_args()
+
+    library = Library(args.dir, args.movies, args.shows, args.seasons, args.episodes, args.file_size * MiB)
+    base = f"http://{args.host}:{args.port}"
+    print(f"{len(library.entries)} items; run PlexDLWeb with:")
+    print(f"    PDW_SERVER_URL={base} PDW_SERVER_ID={SERVER_ID} PDW_PLEXTV_URL={base}")
+    print(f"user token {USER_TOKEN}, server token {SERVER_TOKEN}")
+    uvicorn.run(create_app(library, args.latency / 1000), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Load scenarios against PlexDLWeb's download worker app (the routes the UI mounts too), backed by the fake Plex
+server of benchmarks.fakeplex, reporting throughput, p50/p99 latency and the CPU time PlexDLWeb used:
+
+- search: clients searching through the API, each query a random word of the generated titles
+- browse: clients listing the seasons of shows and the episodes of seasons through the API
+- thumbs: clients loading grids of posters, six at a time like a browser; the first views transcode, later ones hit
+  the thumbnail cache
+- ranges: clients downloading random ranges of random files, like segmented download managers
+
+The fake server and PlexDLWeb run in their own processes, in a temporary directory holding PlexDLWeb's config and
+databases; only PlexDLWeb's CPU time is counted (Linux only). The load generator is a single Python process, so
+compare runs with the same --clients. Run from the repository root:
+
+    python -m benchmarks.load --scenario search thumbs --clients 32 --duration 15
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from xml.etree.ElementTree import fromstring
+
+import httpx
+
+from benchmarks.fakeplex import MiB, SERVER_ID, SERVER_TOKEN, USER_TOKEN, WORDS
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("search", "browse", "thumbs", "ranges")
+# connections a browser opens to one host
+BROWSER_CONNECTIONS = 6
+METRICS_TOKEN = "load"
+
+
+@dataclass
+class Stats:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+    bytes: int = 0
+
+    def percentile(self, p: float) -> float:
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] if ordered else float("nan")
+
+
+@dataclass
+class Target:
+    client: httpx.AsyncClient
+    movies: list[int]
+    shows: list[int]
+    seasons: list[int]
+    playable: list[int]
+    updated_at: int
+    file_size: int
+    chunk: int
+
+
+async def timed(stats: Stats, request, ok=(200,)):
+    started = time.perf_counter()
+    try:
+        async with request as resp:
+            async for chunk in resp.aiter_raw():
+                stats.bytes += len(chunk)
+    except httpx.HTTPError:
+        stats.errors += 1
+        return
+    if resp.status_code in ok:
+        stats.latencies.append(time.perf_counter() - started)
+    else:
+        stats.errors += 1
+
+
+async def search(t: Target, stats: Stats):
+    await timed(stats, t.client.stream("GET", "/api/v1/search", params={"q": random.choice(WORDS)},
+                                       headers={"Authorization": f"Bearer {USER_TOKEN}"}))
+
+
+async def browse(t: Target, stats: Stats):
+    key = random.choice(t.shows + t.seasons)
+    await timed(stats, t.client.stream("GET", f"/api/v1/items/{key}/children",
+                                       headers={"Authorization": f"Bearer {USER_TOKEN}"}))
+
+
+async def thumbs(t: Target, stats: Stats, grid: int = 60):
+    queue = random.sample(t.movies + t.shows, min(grid, len(t.movies) + len(t.shows)))
+
+    async def connection():
+        while queue:
+            key = queue.pop()
+            await timed(stats, t.client.stream("GET", f"/thumb/300/450/library/metadata/{key}/thumb/{t.updated_at}"))
+
+    await asyncio.gather(*(connection() for _ in range(BROWSER_CONNECTIONS)))
+
+
+async def ranges(t: Target, stats: Stats):
+    start = random.randrange(0, max(1, t.file_size - t.chunk))
+    end = min(t.file_size, start + t.chunk) - 1
+    await timed(stats, t.client.stream("GET", f"/download/{random.choice(t.playable)}/0",
+                                       headers={"Range": f"bytes={start}-{end}"}), ok=(206,))
+
+
+def _ppid(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return int(f.read().rpartition(")")[2].split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """
+    User and system CPU time of a process and its children (uvicorn's workers), from /proc
+    """
+    pids = [pid] + [int(p) for p in os.listdir("/proc") if p.isdigit() and _ppid(int(p)) == pid] \
+        if os.path.isdir("/proc") else []
+    total = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rpartition(")")[2].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK") if pids else None
+
+
+async def run(scenario, t: Target, clients: int, duration: float) -> tuple[Stats, float]:
+    stats = Stats()
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        while time.perf_counter() < deadline:
+            await scenario(t, stats)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    return stats, time.perf_counter() - started
+
+
+async def wait_ready(url: str, timeout: float = 120, **kwargs):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                if (await client.get(url, **kwargs)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} didn't come up")
+            await asyncio.sleep(0.2)
+
+
+async def keys(base: str, section: int, type: int) -> list[int]:
+    async with httpx.AsyncClient(base_url=base, headers={"X-Plex-Token": SERVER_TOKEN}) as client:
+        resp = await client.get(f"/library/sections/{section}/all", params={"type": type})
+        resp.raise_for_status()
+    return [int(e.get("ratingKey")) for e in fromstring(resp.content)]
+
+
+def _port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--clients", type=int, default=32, help="concurrent clients per scenario")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    parser.add_argument("--movies", type=int, default=2000)
+    parser.add_argument("--shows", type=int, default=100)
+    parser.add_argument("--file-size", type=int, default=1024, help="size of each media file in MiB")
+    parser.add_argument("--chunk", type=int, default=4, help="size of each range request in MiB")
+    parser.add_argument("--latency", type=float, default=0, help="added by the fake server, in milliseconds")
+    parser.add_argument("--workers", type=int, default=1, help="PlexDLWeb worker processes")
+    parser.add_argument("--remote", action="store_true", help="relay downloads from the fake server")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory")
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix="plexdlweb-load-")
+    fake_base, port = f"http://127.0.0.1:{_port()}", _port()
+    processes = []
+    try:
+        processes.append(subprocess.Popen([
+            sys.executable, "-m", "benchmarks.fakeplex", "--dir", os.path.join(work, "media"),
+            "--movies", str(args.movies), "--shows", str(args.shows), "--file-size", str(args.file_size),
+            "--latency", str(args.latency), "--port", fake_base.rpartition(":")[2],
+        ], cwd=REPO, stdout=subprocess.DEVNULL))
+        # background hashing would compete with the scenarios
+        config = {"server_url": fake_base, "server_id": SERVER_ID, "plextv_url": fake_base, "checksum_algorithms": [],
+                  "remote_downloads": "always" if args.remote else "auto", "metrics_token": METRICS_TOKEN}
+        env = {**os.environ, "PYTHONPATH": REPO, "IS_DOCKER": "1",
+               **{f"PDW_{k.upper()}": v if isinstance(v, str) else json.dumps(v) for k, v in config.items()}}
+        processes.append(subprocess.Popen([
+            sys.executable, "-m", "uvicorn", "worker:app", "--host", "127.0.0.1", "--port", str(port),
+            "--workers", str(args.workers), "--log-level", "warning",
+        ], cwd=work, env=env))
+        await wait_ready(f"{fake_base}/identity", headers={"X-Plex-Token": SERVER_TOKEN})
+        await wait_ready(f"http://127.0.0.1:{port}/metrics", headers={"Authorization": f"Bearer {METRICS_TOKEN}"})
+
+        # the browser session the UI would have handed out, read by the worker from the shared session store
+        os.chdir(work)
+        os.environ.update(env)
+        import sessions
+        cookie = sessions.store.create(sessions.Login(USER_TOKEN, SERVER_TOKEN))
+
+        movies, shows = await keys(fake_base, 1, 1), await keys(fake_base, 2, 2)
+        seasons, episodes = await keys(fake_base, 2, 3), await keys(fake_base, 2, 4)
+        limits = httpx.Limits(max_connections=args.clients * BROWSER_CONNECTIONS,
+                              max_keepalive_connections=args.clients * BROWSER_CONNECTIONS)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", cookies={sessions.COOKIE: cookie},
+                                     limits=limits, timeout=60) as client:
+            updated_at = int((await client.get("/api/v1/items/1", headers={"Authorization": f"Bearer {USER_TOKEN}"}))
+                             .json().get("updated", 0))
+            t = Target(client, movies, shows, seasons, movies + episodes, updated_at, args.file_size * MiB,
+                       args.chunk * MiB)
+            print(f"{'scenario':<10} {'requests':>9} {'errors':>7} {'req/s':>9} {'MB/s':>9} {'p50 ms':>9} "
+                  f"{'p99 ms':>9} {'CPU s':>7} {'CPU %':>7}")
+            for name in args.scenario:
+                scenario = globals()[name]
+                # token checks, connections and Plex sessions are set up outside of the measurement
+                await scenario(t, Stats())
+                cpu = cpu_seconds(processes[1].pid)
+                stats, wall = await run(scenario, t, args.clients, args.duration)
+                cpu = cpu_seconds(processes[1].pid) - cpu if cpu is not None else float("nan")
+                n = len(stats.latencies)
+                print(f"{name:<10} {n:>9} {stats.errors:>7} {n / wall:>9.1f} {stats.bytes / wall / 1e6:>9.1f} "
+                      f"{stats.percentile(50) * 1000:>9.1f} {stats.percentile(99) * 1000:>9.1f} {cpu:>7.2f} "
+                      f"{cpu / wall * 100:>7.0f}")
+    finally:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.wait()
+        if args.keep:
+            print(f"kept {work}")
+        else:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
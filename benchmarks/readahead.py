@@ -0,0 +1,98 @@
+"""
+Measures cold-cache read throughput of DownloadFileResponse with and without page cache hints.
+
+Before each run the file's pages are dropped from the page cache, so reads come from the disk: run it on a large
+file on the storage the media lives on (a spinning disk is where it matters). The chunked send path is driven with a
+send callable that discards the body, and the growth of the page cache over the run is reported where
+/proc/meminfo is available. Run from the repository root:
+
+    python -m benchmarks.readahead --file /mnt/media/some-movie.mkv --window 32
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.download import MiB, _make_file
+from download import DownloadFileResponse
+
+
+def _drop_cache(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _cached_kib() -> int | None:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("Cached:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+async def read_once(path: str, range_header: str | None, **options) -> tuple[int, float]:
+    """
+    Returns (bytes sent, wall seconds)
+    """
+    sent = 0
+
+    async def send(message):
+        nonlocal sent
+        sent += len(message.get("body", b""))
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    headers = [(b"range", range_header.encode())] if range_header else []
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": headers, "asgi": {"spec_version": "2.4"}}
+    response = DownloadFileResponse(path, stat_result=os.stat(path), mode="chunked", **options)
+    wall = time.perf_counter()
+    await response(scope, receive, send)
+    return sent, time.perf_counter() - wall
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", help="file to read (default: a temporary file of --size MiB)")
+    parser.add_argument("--size", type=int, default=2048, help="size of the temporary file in MiB")
+    parser.add_argument("--window", type=int, default=32, help="readahead window in MiB")
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    path = args.file or _make_file(args.size * MiB)
+    size = os.path.getsize(path)
+    window = args.window * MiB
+    variants = (
+        ("none", {}),
+        ("hints", {"readahead": window}),
+        ("hints, keep", {"readahead": window, "drop_behind": False}),
+        ("prefetch", {"readahead": window, "prefetch": True}),
+    )
+    try:
+        print(f"{'hints':<12} {'request':<8} {'MB/s':>10} {'cache MiB':>10}")
+        for name, options in variants:
+            for label, range_header in (("full", None), ("range", f"bytes={size // 3}-")):
+                total = wall = grown = 0
+                for _ in range(args.repeat):
+                    _drop_cache(path)
+                    before = _cached_kib()
+                    n, w = await read_once(path, range_header, **options)
+                    after = _cached_kib()
+                    total, wall = total + n, wall + w
+                    if before is not None and after is not None:
+                        grown += (after - before) / 1024
+                print(f"{name:<12} {label:<8} {total / wall / 1e6:>10.0f} {grown / args.repeat:>10.0f}")
+    finally:
+        if not args.file:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+"""
+How library items map to downloadable files: names inside bundles, ZIP entries and signed manifest entries.
+"""
+import os
+import re
+from urllib.parse import quote
+
+from fastapi import HTTPException
+
+import checksums
+import manifest
+import signing
+from hashcache import hashes
+from library import Item, MediaVersion
+from remote import local_path, local_stat
+from zipstream import ZipEntry
+
+
+def _path_safe(name: str) -> str:
+    return re.sub(r'[\x00-\x1f/\\:*?"<>|]', "_", name).strip() or "_"
+
+
+def bundle_name(item: Item) -> str:
+    if item.type == "season":
+        return _path_safe(f"{item.parent_title} - {item.title}")
+    return _path_safe(item.title)
+
+
+def bundle_files(item: Item, leaves: list[Item], index: int) -> list[tuple[str, MediaVersion]]:
+    """
+    The parts of a bundle, with their unique names in it
+    """
+    root = bundle_name(item)
+    files, names = [], set()
+    for leaf in leaves:
+        if not leaf.media:
+            continue
+        # same choice as single downloads, for the items that have that many versions
+        version = leaf.media[index] if index < len(leaf.media) else leaf.media[0]
+        folder = f"{root}/{_path_safe(leaf.parent_title)}" if item.type == "show" and leaf.parent_title else root
+        name = f"{folder}/{_path_safe(os.path.basename(version.file))}"
+        stem, ext = os.path.splitext(name)
+        n = 1
+        while name in names:
+            n += 1
+            name = f"{stem} ({n}){ext}"
+        names.add(name)
+        files.append((name, version))
+    return files
+
+
+def bundle_entries(item: Item, leaves: list[Item], index: int) -> list[ZipEntry]:
+    entries = []
+    for name, version in bundle_files(item, leaves, index):
+        if (st := local_stat(version.file)) is None:
+            # the archive layout needs every size and CRC, which would mean fetching every part twice
+            raise HTTPException(status_code=501, detail="ZIP bundles need the media to be readable locally")
+        entries.append(ZipEntry(name, local_path(version.file), st))
+    return entries
+
+
+def manifest_entry(base: str, name: str, version: MediaVersion, user: str, server_token: str) -> manifest.ManifestEntry:
+    sha256 = mtime_ns = None
+    if (st := local_stat(version.file)) is not None:
+        size, mtime_ns = st.st_size, st.st_mtime_ns
+        if (sha256 := hashes.get("sha256", local_path(version.file), st)) is None:
+            checksums.service.request(local_path(version.file))
+    else:
+        size = version.size or 0
+    token = signing.sign(version.file, size, user, server_token, version.part_key, mtime_ns)
+    url = f"{base}/download/signed/{token}/{quote(os.path.basename(version.file))}"
+    return manifest.ManifestEntry(name, url, size, sha256.hex() if sha256 else None)
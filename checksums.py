@@ -0,0 +1,199 @@
+"""
+Checksums of media parts, computed in the background and kept in the hash cache.
+
+A part gets queued the first time it is downloaded (or its checksum asked for), by whichever process serves it, in a
+table of the hash cache. A small pool of workers in the UI process reads the queued parts while no process is serving
+a download, optionally at a capped speed, without keeping them in the page cache. Once known, the
+SHA-256 is sent with downloads as Repr-Digest/Digest headers so clients can check a resumed download, and every
+configured algorithm is available as a sidecar file.
+"""
+import asyncio
+import base64
+import hashlib
+import importlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from nicegui import app
+
+from config import config
+from common import io_bound
+from hashcache import hashes
+from readahead import Readahead
+from scheduler import scheduler, TokenBucket
+
+logger = logging.getLogger("plexdlweb.checksums")
+
+CHUNK = 4 * 1024 * 1024
+QUEUE_SIZE = 1000
+# how often paused workers check whether downloads are over, and idle ones whether files were queued
+IDLE_POLL = 1.0
+
+
+def _optional(module: str, attr: str) -> Optional[Callable]:
+    try:
+        return getattr(importlib.import_module(module), attr)
+    except ImportError:
+        return None
+
+
+# name (also the sidecar file extension) -> hash constructor
+ALGORITHMS = {
+    "sha256": hashlib.sha256,
+    "blake3": _optional("blake3", "blake3"),
+    "xxh128": _optional("xxhash", "xxh3_128"),
+}
+
+
+def _step(f, hashers: list) -> int:
+    chunk = f.read(CHUNK)
+    for h in hashers:
+        h.update(chunk)
+    return len(chunk)
+
+
+class ChecksumService:
+    def __init__(self, algorithms: list[str], workers: int, rate: int):
+        self.algorithms = []
+        for name in algorithms:
+            if ALGORITHMS.get(name) is None:
+                logger.warning("Checksum algorithm %r is unknown or its package isn't installed", name)
+            else:
+                self.algorithms.append(name)
+        self.workers = workers
+        self._bucket = TokenBucket(rate * 1024 * 1024) if rate else None
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="plexdlweb-checksum")
+        self._queue: Optional[asyncio.Queue] = None
+        # queued files handed to the workers and not done yet
+        self._pending: set[str] = set()
+        self._tasks: list[asyncio.Task] = []
+        self._checked = 0.0
+
+    def get(self, path: str, st: os.stat_result) -> dict[str, bytes]:
+        """
+        Known checksums of a file, blocking
+        """
+        values = {}
+        for name in self.algorithms:
+            if (value := hashes.get(name, path, st)) is not None:
+                values[name] = value
+        return values
+
+    def request(self, path: str):
+        """
+        Queues a file for hashing; blocking
+        """
+        if self.algorithms:
+            hashes.request(path, QUEUE_SIZE)
+
+    def lookup(self, path: str, st: os.stat_result) -> dict[str, bytes]:
+        """
+        Known checksums of a file, queueing it for hashing when some are missing; blocking
+        """
+        values = self.get(path, st)
+        if len(values) < len(self.algorithms):
+            self.request(path)
+        return values
+
+    async def _throttle(self, n: int):
+        # downloads come first, whichever process serves them: wait for them to be over
+        while time.monotonic() - self._checked > IDLE_POLL:
+            if not await io_bound(scheduler.table.busy):
+                self._checked = time.monotonic()
+                break
+            await asyncio.sleep(IDLE_POLL)
+        if self._bucket is not None:
+            await asyncio.sleep(self._bucket.reserve(n))
+
+    async def _hash(self, path: str, st: os.stat_result):
+        known = await io_bound(self.get, path, st)
+        missing = [name for name in self.algorithms if name not in known]
+        if not missing:
+            return
+        loop = asyncio.get_running_loop()
+        hashers = [ALGORITHMS[name]() for name in missing]
+        f = await loop.run_in_executor(self._pool, open, path, "rb")
+        hints = Readahead(f.fileno(), 0, st.st_size, 2 * CHUNK)
+        try:
+            size = 0
+            while True:
+                await self._throttle(CHUNK)
+                if not (n := await loop.run_in_executor(self._pool, _step, f, hashers)):
+                    break
+                size += n
+                hints.advance(size)
+        finally:
+            hints.close()
+            f.close()
+        now = await io_bound(os.stat, path)
+        if size != st.st_size or (now.st_size, now.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+            logger.info("%r changed while being hashed", path)
+            return
+        for name, h in zip(missing, hashers):
+            await io_bound(hashes.set, name, path, st, h.digest())
+        logger.info("Computed %s of %r", ", ".join(missing), path)
+
+    async def _dispatch(self):
+        while True:
+            if self._queue.empty():
+                for path in await io_bound(hashes.pending, QUEUE_SIZE):
+                    if path not in self._pending:
+                        self._pending.add(path)
+                        self._queue.put_nowait(path)
+            await asyncio.sleep(IDLE_POLL)
+
+    async def _worker(self):
+        while True:
+            path = await self._queue.get()
+            try:
+                await self._hash(path, await io_bound(os.stat, path))
+            except asyncio.CancelledError:
+                # left queued for the next start
+                raise
+            except Exception:
+                logger.exception("Hashing %r failed", path)
+            finally:
+                self._pending.discard(path)
+            await io_bound(hashes.done, path)
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self._tasks = [asyncio.create_task(self._dispatch())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def digest_headers(values: dict[str, bytes]) -> dict[str, str]:
+    """
+    RFC 9530 Repr-Digest, and the older RFC 3230 Digest, both describing the whole file even in a 206 response
+    """
+    if (sha256 := values.get("sha256")) is None:
+        return {}
+    encoded = base64.b64encode(sha256).decode()
+    return {"Repr-Digest": f"sha-256=:{encoded}:", "Digest": f"SHA-256={encoded}"}
+
+
+service = ChecksumService(config.checksum_algorithms, config.checksum_workers, config.checksum_rate)
+
+
+def startup():
+    service.start()
+
+
+# the download workers only queue files: one process hashes them, so each file is read once
+app.on_startup(startup)
+
+
+async def shutdown():
+    await service.stop()
+
+
+app.on_shutdown(shutdown)
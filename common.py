@@ -1,8 +1,220 @@
 import asyncio
+import threading
+import time
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
-from functools import partial
 
-executor = ThreadPoolExecutor()
-# todo: use nicegui.run.io_bound when it's released
+from config import config
+import metrics
+
+
+class Overloaded(Exception):
+    """
+    Raised by Pool.run when the pool's queue is full
+    """
+
+
+class Pool:
+    """
+    Named thread pool for blocking calls, so that a slow dependency only holds up the calls waiting on it. Calls
+    beyond max_queue waiting ones are shed with Overloaded, and callers stop waiting after timeout seconds (the
+    thread itself can't be interrupted, it finishes its call in the background).
+    """
+    def __init__(self, name: str, workers: int, max_queue: int = 0, timeout: float = 0):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"plexdlweb-{name}")
+        self._lock = threading.Lock()
+        # calls waiting for a thread and running, and totals since startup (times in seconds)
+        self.queued = 0
+        self.running = 0
+        self.calls = 0
+        self.shed = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+
+    def _call(self, submitted: float, func, args, kwargs):
+        started = time.monotonic()
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_time += started - submitted
+        metrics.waits.observe(started - submitted, self.name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.running -= 1
+                self.calls += 1
+                self.run_time += elapsed
+            metrics.calls.observe(elapsed, self.name, getattr(func, "__qualname__", type(func).__name__))
+
+    async def run(self, func, *args, **kwargs):
+        with self._lock:
+            if self.max_queue and self.queued >= self.max_queue:
+                self.shed += 1
+                raise Overloaded(f"too many calls waiting in the {self.name} pool")
+            self.queued += 1
+        future = self._executor.submit(self._call, time.monotonic(), func, args, kwargs)
+        try:
+            if self.timeout:
+                return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+            return await asyncio.wrap_future(future)
+        except TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise
+        finally:
+            # a call cancelled before it started never reaches _call
+            if future.cancelled():
+                with self._lock:
+                    self.queued -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _pool(name: str, workers: int, max_queue: int, timeout: float) -> Pool:
+    options = {"workers": workers, "max_queue": max_queue, "timeout": timeout, **config.pools.get(name, {})}
+    return Pool(name, **options)
+
+
+# account checks on plex.tv, requests to the Plex server, and local disk and database work
+plextv_pool = _pool("plextv", 8, 64, 30)
+server_pool = _pool("server", 16, 256, 60)
+fs_pool = _pool("fs", 32, 0, 0)
+POOLS = (plextv_pool, server_pool, fs_pool)
+
+metrics.Collected("plexdlweb_pool_calls", "Blocking calls waiting for a thread or running, by pool",
+                  ("pool", "state"),
+                  lambda: [((p.name, "queued"), p.queued) for p in POOLS] + [((p.name, "running"), p.running)
+                                                                              for p in POOLS])
+metrics.Collected("plexdlweb_pool_shed_total", "Blocking calls refused because the pool's queue was full",
+                  ("pool",), lambda: [((p.name,), p.shed) for p in POOLS], type="counter")
+metrics.Collected("plexdlweb_pool_timeouts_total", "Blocking calls given up on after the pool's timeout",
+                  ("pool",), lambda: [((p.name,), p.timeouts) for p in POOLS], type="counter")
+
+
 async def io_bound(func, *args, **kwargs):
-    return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
\ No newline at end of file
+    """
+    Runs blocking filesystem or database work in the fs pool
+    """
+    return await fs_pool.run(func, *args, **kwargs)
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded LRU mapping whose entries expire after a per-entry time-to-live
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float | None = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls: callers asking for a key that is already being
+    computed await the pending result instead of starting the work again
+    """
+    def __init__(self):
+        self._pending: dict[object, asyncio.Future] = {}
+
+    async def run(self, key, func, *args, **kwargs):
+        while (fut := self._pending.get(key)) is not None:
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                # the leader was cancelled, not us: take over the computation
+                if not fut.cancelled() or asyncio.current_task().cancelling():
+                    raise
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[key] = fut
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            # mark the exception as retrieved when nobody else was waiting
+            fut.exception()
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            if self._pending.get(key) is fut:
+                del self._pending[key]
+
+    def forget(self, key):
+        """
+        Detaches a pending computation so the next caller starts a fresh one
+        """
+        self._pending.pop(key, None)
+
+
+class Superseded(Exception):
+    """
+    Raised by LatestOnly.run when a newer call took over
+    """
+
+
+class LatestOnly:
+    """
+    Runs awaitables one at a time: starting a new one cancels the one still in flight,
+    whose caller gets a Superseded exception instead of a stale result
+    """
+    def __init__(self):
+        self._task: asyncio.Future | None = None
+
+    async def run(self, aw):
+        if self._task is not None:
+            self._task.cancel()
+        self._task = task = asyncio.ensure_future(aw)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                raise Superseded() from None
+            raise
+        finally:
+            if self._task is task:
+                self._task = None
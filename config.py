@@ -1,5 +1,6 @@
 from dataclasses import dataclass, field
 from dataclasses_json import dataclass_json
+import json
 import os
 import uuid
 
@@ -14,10 +15,105 @@ class Config:
     port: int = 8766
     uuid: str = field(default_factory=lambda: str(uuid.uuid4()))
     secret: str = field(default_factory=lambda: str(uuid.uuid4()))
+    # seconds during which a successful/failed token validation is remembered
+    auth_cache_ttl: int = 300
+    auth_cache_negative_ttl: int = 30
+    # live PlexServer/MyPlexAccount objects kept around, and how long an unused one survives
+    plex_pool_size: int = 64
+    plex_pool_idle: int = 600
+    plex_pool_connections: int = 32
+    # testing only: where plexapi's plex.tv requests (account and resources) are sent, e.g. to benchmarks/fakeplex.py;
+    # they carry the users' Plex tokens, so never point it at a server you don't control
+    plextv_url: str = "https://plex.tv"
+    # thread pools for blocking calls ("plextv", "server" and "fs"), e.g. {"server": {"workers": 32, "max_queue":
+    # 512, "timeout": 120}}: threads, calls allowed to wait before new ones are refused (0 = no limit), and seconds
+    # before a caller gives up (0 = never)
+    pools: dict = field(default_factory=dict)
+    # local SQLite mirror of the library used for searches, synced with admin_token (required)
+    search_index: bool = False
+    search_index_path: str = "library.db"
+    search_index_limit: int = 60
+    # token of the server owner, used by background tasks such as listening to library change notifications
+    admin_token: str = ""
+    # upper bound of the websocket reconnection backoff, also the polling period while it is down
+    notification_poll_interval: int = 60
+    # resized posters: cache location and size in MiB, and the size requested from Plex's photo transcoder
+    thumb_cache_dir: str = "thumbs"
+    thumb_cache_size: int = 256
+    thumb_width: int = 300
+    thumb_height: int = 450
+    thumb_quality: int = 80
+    # posters the installed web app keeps in the browser, shown at once and refreshed in the background (0 disables it)
+    pwa_image_cache: int = 500
+    # results rendered at once, and children fetched from Plex per request, when browsing (0 = everything)
+    page_size: int = 60
+    # /plex proxy: upstream connection limit, and the in-memory cache of small metadata answers (0 ttl disables it)
+    proxy_max_connections: int = 100
+    proxy_cache_ttl: int = 30
+    proxy_cache_size: int = 256
+    # where the parts of recently downloaded media are, so each Range request of a download doesn't ask Plex again
+    part_cache_ttl: int = 300
+    part_cache_size: int = 1024
+    # persistent per-file CRCs and checksums
+    hash_cache_path: str = "hashes.db"
+    # lifetime in seconds of the signed per-file URLs listed in download manifests, and where the files of signed
+    # bundles (torrent web seeds) are recorded
+    signed_url_ttl: int = 6 * 3600
+    grant_store_path: str = "grants.db"
+    # download admission and pacing, 0 meaning unlimited: concurrent streams overall and per user, and KiB/s
+    max_streams: int = 0
+    max_streams_per_user: int = 0
+    bandwidth_limit: int = 0
+    user_bandwidth_limit: int = 0
+    # share of the bandwidth limit given to each Plex username when several users download at once (default 1)
+    user_weights: dict = field(default_factory=dict)
+    # downloads in progress, shared by the UI and the download workers so that the limits above apply to all of them
+    transfer_store_path: str = "transfers.db"
+    # page cache hints while streaming files: MiB requested ahead of each download (0 disables hints), whether pages
+    # already sent are dropped, and whether a thread reads the window itself when the file system ignores the hints
+    readahead_window: int = 32
+    readahead_drop_behind: bool = True
+    readahead_prefetch: bool = False
+    # copies of popular media on fast storage, in a directory of their own (empty disables it): size in GiB, and the
+    # number of different users that must download a file within the window (seconds) before it is copied
+    hot_tier_dir: str = ""
+    hot_tier_size: int = 100
+    hot_tier_threshold: int = 3
+    hot_tier_window: int = 6 * 3600
+    # Plex path prefix -> local mount of the same files, for when plexdlweb doesn't see the media where Plex does
+    path_map: dict = field(default_factory=dict)
+    # parts that can't be read locally are streamed from Plex: "auto" (only those), "always" or "never"
+    remote_downloads: str = "auto"
+    # where to fetch parts from, if not server_url, and how many can be relayed at once (0 = no limit)
+    remote_url: str = ""
+    remote_max_streams: int = 16
+    # torrents: lifetime in seconds of their web seed URLs, trackers to announce to, and hashing threads (0 = one per
+    # CPU)
+    torrent_ttl: int = 24 * 3600
+    torrent_trackers: list = field(default_factory=list)
+    torrent_workers: int = 0
+    # checksums of downloaded parts, computed in the background while no download is running: algorithms (sha256,
+    # and blake3 or xxh128 when their packages are installed), hashing threads, and speed limit in MiB/s (0 = none)
+    checksum_algorithms: list = field(default_factory=lambda: ["sha256"])
+    checksum_workers: int = 1
+    checksum_rate: int = 0
+    # logins shared with the download workers (python worker.py): session store, session lifetime in seconds, and the
+    # workers' port and process count (0 = one per core)
+    session_store_path: str = "sessions.db"
+    session_ttl: int = 30 * 24 * 3600
+    worker_port: int = 8767
+    worker_processes: int = 0
+    # bearer token Prometheus must send to read /metrics (empty disables it), and where each process writes its values
+    # for the others to sum
+    metrics_token: str = ""
+    metrics_dir: str = "metrics"
 
 def save_config():
-    with open("config.json", "w") as config_file:
+    # worker processes start together and read the file while others write it
+    tmp = f"config.json.{os.getpid()}.tmp"
+    with open(tmp, "w") as config_file:
         config_file.write(config.to_json())
+    os.replace(tmp, "config.json")
 
 if os.path.exists("config.json"):
     try:
@@ -36,8 +132,17 @@ else:
         save_config()
         exit()
 
+def _from_env(current, val: str):
+    if isinstance(current, bool):
+        return val.lower() in ("1", "true", "yes", "on")
+    if isinstance(current, (dict, list)):
+        return json.loads(val)
+    if isinstance(current, (int, float)):
+        return type(current)(val)
+    return val
+
 for key in config.to_dict().keys():
     if val := os.getenv(f"PDW_{key.upper()}"):
-        setattr(config, key, val)
+        setattr(config, key, _from_env(getattr(config, key), val))
 
 save_config()
@@ -0,0 +1,139 @@
+import logging
+from typing import BinaryIO, Optional, Protocol
+
+import anyio
+from fastapi.responses import FileResponse
+from starlette.datastructures import MutableHeaders
+
+from readahead import Readahead
+
+logger = logging.getLogger("plexdlweb.download")
+
+DOWNLOAD_HEADERS = {
+    # Prevent common reverse proxies from buffering large responses to disk.
+    "X-Accel-Buffering": "no",
+    # Tell intermediaries not to compress or otherwise rewrite video downloads.
+    "Cache-Control": "private, no-transform",
+}
+
+
+class Transfer(Protocol):
+    """
+    What a response needs from the download scheduler
+    """
+    throttled: bool
+
+    async def pace(self, n: int): ...
+
+    def record(self, n: int): ...
+
+    def close(self): ...
+
+
+class DownloadFileResponse(FileResponse):
+    """
+    FileResponse that reads and sends the file in chunk_size pieces, full, Range or multi-range responses alike.
+
+    A transfer, when given, paces every piece and is closed once the response is over. With a readahead window,
+    the pages ahead of the stream are requested in advance and the ones behind it dropped (see readahead.py).
+
+    An already open file, when given, is read instead of opening path, except for multi-range responses; it must
+    have the same contents (see hottier.py), and is closed with the response.
+
+    Full responses are handed to the ASGI server through the path send extension when it offers it, so that it can
+    send the file with sendfile, unless the transfer is throttled, page cache hints are enabled or a file is given:
+    the server would then send the file unpaced, without hints or from path.
+    """
+    # Starlette's default is 64 KiB. Larger chunks reduce per-chunk overhead for
+    # multi-gigabyte video downloads while preserving Range support.
+    chunk_size = 1024 * 1024
+
+    def __init__(self, *args, transfer: Optional[Transfer] = None, readahead: int = 0, drop_behind: bool = True,
+                 prefetch: bool = False, file: Optional[BinaryIO] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.file = file
+        self.transfer = transfer
+        self.readahead = readahead
+        self.drop_behind = drop_behind
+        self.prefetch = prefetch
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        except Exception:
+            logger.exception("Download failed while streaming %s", self.path)
+            raise
+        finally:
+            if self.transfer is not None:
+                self.transfer.close()
+            if self.file is not None:
+                self.file.close()
+
+    async def _handle_simple(self, send, send_header_only: bool, send_pathsend: bool) -> None:
+        if send_header_only:
+            return await super()._handle_simple(send, send_header_only, False)
+        if send_pathsend and self._direct():
+            await super()._handle_simple(send, False, True)
+            self._record(int(self.headers["content-length"]))
+            return
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        await self._send_chunks(send, 0, int(self.headers["content-length"]))
+
+    async def _handle_single_range(self, send, start: int, end: int, file_size: int, send_header_only: bool) -> None:
+        if send_header_only:
+            return await super()._handle_single_range(send, start, end, file_size, send_header_only)
+        headers = MutableHeaders(raw=list(self.raw_headers))
+        headers["content-range"] = f"bytes {start}-{end - 1}/{file_size}"
+        headers["content-length"] = str(end - start)
+        await send({"type": "http.response.start", "status": 206, "headers": headers.raw})
+        await self._send_chunks(send, start, end)
+
+    async def _handle_multiple_ranges(self, send, ranges, file_size: int, send_header_only: bool) -> None:
+        async def paced_send(message):
+            n = len(message.get("body", b"")) if message["type"] == "http.response.body" else 0
+            await self._pace(n)
+            await send(message)
+            self._record(n)
+
+        await super()._handle_multiple_ranges(paced_send, ranges, file_size, send_header_only)
+
+    def _direct(self) -> bool:
+        return self.file is None and not self.readahead and (self.transfer is None or not self.transfer.throttled)
+
+    async def _pace(self, n: int) -> None:
+        if self.transfer is not None:
+            await self.transfer.pace(n)
+
+    def _record(self, n: int) -> None:
+        if self.transfer is not None:
+            self.transfer.record(n)
+
+    def _hints(self, fd: int, start: int, end: int) -> Readahead:
+        return Readahead(fd, start, end, self.readahead, self.drop_behind, self.prefetch)
+
+    async def _close_hints(self, hints: Readahead) -> None:
+        if not self.prefetch:
+            hints.close()
+            return
+        with anyio.CancelScope(shield=True):
+            # joins the prefetch thread, which may be in the middle of a read
+            await anyio.to_thread.run_sync(hints.close)
+
+    async def _send_chunks(self, send, start: int, end: int) -> None:
+        file = anyio.wrap_file(self.file) if self.file is not None else await anyio.open_file(self.path, mode="rb")
+        hints = self._hints(file.wrapped.fileno(), start, end)
+        try:
+            await file.seek(start)
+            more_body = True
+            while more_body:
+                hints.advance(start)
+                await self._pace(min(self.chunk_size, end - start))
+                chunk = await file.read(min(self.chunk_size, end - start))
+                start += len(chunk)
+                more_body = bool(chunk) and start < end
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+                self._record(len(chunk))
+        finally:
+            await self._close_hints(hints)
+            with anyio.CancelScope(shield=True):
+                await file.aclose()
@@ -0,0 +1,94 @@
+"""
+Persistent cache of per-file digests (CRCs, checksums, piece hashes), keyed by path, size and mtime so that a
+modified file is never matched with the digest of its previous content.
+
+It also holds the files waiting for their checksums, which any process may ask for and the UI process computes, and
+claims on digests being computed, so that processes don't compute the same ones.
+"""
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from config import config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (kind, path)
+);
+CREATE TABLE IF NOT EXISTS claims (
+    key TEXT PRIMARY KEY,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pending (
+    path TEXT PRIMARY KEY,
+    requested REAL NOT NULL
+);
+"""
+
+
+class HashCache:
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            # shared with the download worker processes
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.executescript(SCHEMA)
+
+    def get(self, kind: str, path: str, st: os.stat_result) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM hashes WHERE kind = ? AND path = ? AND size = ? AND mtime_ns = ?",
+                                   (kind, path, st.st_size, st.st_mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def set(self, kind: str, path: str, st: os.stat_result, value: bytes):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                             (kind, path, st.st_size, st.st_mtime_ns, value))
+
+    def claim(self, key: str, ttl: float) -> bool:
+        """
+        Whether this process may compute key, which no other process claimed within ttl seconds
+        """
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM claims WHERE key = ? AND expires < ?", (key, now))
+            return self._db.execute("INSERT OR IGNORE INTO claims VALUES (?, ?)", (key, now + ttl)).rowcount == 1
+
+    def release(self, key: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM claims WHERE key = ?", (key,))
+
+    def request(self, path: str, limit: int):
+        """
+        Adds a file to the ones waiting to be hashed, unless limit files already are
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR IGNORE INTO pending SELECT ?, ? WHERE (SELECT COUNT(*) FROM pending) < ?",
+                             (path, time.time(), limit))
+
+    def pending(self, limit: int) -> list[str]:
+        """
+        Files waiting to be hashed, oldest request first
+        """
+        with self._lock:
+            return [path for path, in self._db.execute("SELECT path FROM pending ORDER BY requested LIMIT ?",
+                                                       (limit,))]
+
+    def done(self, path: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM pending WHERE path = ?", (path,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+hashes = HashCache(config.hash_cache_path)
@@ -0,0 +1,380 @@
+"""
+Optional copies of popular media on fast storage.
+
+A part downloaded by enough different users within a time window is copied in the background to a size-bounded
+directory, and later downloads of it read the copy instead of the slow source. A copy is only used while the source
+still has the size and mtime it had when it was copied. When space is needed, the least frequently used copies go
+first, the least recently used among equals. Copies are opened before the downloads reading them start, so that
+evicting one doesn't cut the downloads in progress short.
+
+The UI process owns the directory: it copies, evicts and keeps the index. Download workers (worker.py) read copies
+through a Replica, which follows the index, and report their downloads in a SQLite table of the directory, which the
+UI process counts as its own every POLL_INTERVAL. Only files named after the tier's keys are ever deleted, so the
+directory may hold other files, although a dedicated one is best.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, asdict
+from typing import BinaryIO, Optional
+
+from nicegui import app
+
+from config import config
+from common import io_bound
+
+logger = logging.getLogger("plexdlweb.hottier")
+
+INDEX = "index.json"
+DOWNLOADS = "downloads.db"
+# copies and copies in progress: the only files of the directory the tier deletes
+OWN_FILE = re.compile(r"[0-9a-f]{64}(\.tmp)?")
+# seconds between two reads of the workers' downloads by the UI process, and of the index by the workers
+POLL_INTERVAL = 5.0
+REFRESH_INTERVAL = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    source TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    time REAL NOT NULL
+);
+"""
+
+
+@dataclass
+class Entry:
+    source: str
+    size: int
+    mtime_ns: int
+    hits: int = 0
+    last_used: float = 0.0
+
+
+def _key(source: str) -> str:
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def _read_index(directory: str) -> dict[str, Entry]:
+    try:
+        with open(os.path.join(directory, INDEX)) as f:
+            return {k: Entry(**v) for k, v in json.load(f).items()}
+    except (OSError, ValueError, TypeError):
+        return {}
+
+
+def _open_copy(path: str, size: int) -> Optional[BinaryIO]:
+    """
+    The copy at path, opened, unless it is missing or incomplete; blocking
+    """
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    if os.fstat(file.fileno()).st_size != size:
+        file.close()
+        return None
+    return file
+
+
+def _unlink(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _stat_all(paths: list[str]) -> list[Optional[os.stat_result]]:
+    result = []
+    for path in paths:
+        try:
+            result.append(os.stat(path))
+        except OSError:
+            result.append(None)
+    return result
+
+
+class Downloads:
+    """
+    Downloads served by the workers, waiting to be counted by the UI process
+    """
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.executescript(SCHEMA)
+
+    def add(self, source: str, st: os.stat_result, user: str):
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO downloads VALUES (?, ?, ?, ?, ?)",
+                             (source, st.st_size, st.st_mtime_ns, user, time.time()))
+
+    def take(self) -> list[tuple[str, int, int, str, float]]:
+        with self._lock, self._db:
+            rows = self._db.execute("SELECT source, size, mtime_ns, user, time FROM downloads").fetchall()
+            self._db.execute("DELETE FROM downloads")
+        return rows
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class HotTier:
+    def __init__(self, directory: str, max_bytes: int, threshold: int, window: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.threshold = threshold
+        self.window = window
+        os.makedirs(directory, exist_ok=True)
+        self._entries: dict[str, Entry] = {}
+        # source path -> (time, user) of recent downloads
+        self._recent: dict[str, deque[tuple[float, str]]] = {}
+        self._copying: set[str] = set()
+        self._copy_lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task] = set()
+        self.downloads = Downloads(os.path.join(directory, DOWNLOADS))
+        self._load()
+
+    key = staticmethod(_key)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _load(self):
+        for key, entry in _read_index(self.directory).items():
+            try:
+                if os.path.getsize(self.path(key)) == entry.size:
+                    self._entries[key] = entry
+            except OSError:
+                pass
+        # copies interrupted by a restart, or files the index lost track of
+        for entry in os.scandir(self.directory):
+            if OWN_FILE.fullmatch(entry.name) and entry.name not in self._entries \
+                    and entry.is_file(follow_symlinks=False):
+                os.remove(entry.path)
+
+    def _save(self):
+        tmp = os.path.join(self.directory, INDEX + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({k: asdict(v) for k, v in self._entries.items()}, f)
+        os.replace(tmp, os.path.join(self.directory, INDEX))
+
+    @property
+    def used(self) -> int:
+        return sum(e.size for e in self._entries.values())
+
+    async def serve(self, source: str, st: os.stat_result, user: str) -> Optional[BinaryIO]:
+        """
+        The open copy of source as it currently is, if there is one, or None to read source itself, counting the
+        download
+        """
+        key = self.key(source)
+        if (entry := self._entries.get(key)) is not None:
+            if (entry.size, entry.mtime_ns) != (st.st_size, st.st_mtime_ns):
+                logger.info("Dropping stale copy of %r", source)
+                await self._remove(key)
+            elif (file := await io_bound(_open_copy, self.path(key), entry.size)) is not None:
+                entry.hits += 1
+                entry.last_used = time.time()
+                return file
+            else:
+                logger.warning("Copy of %r is missing", source)
+                await self._remove(key)
+        self.record(source, st, user)
+        return None
+
+    def record(self, source: str, st: os.stat_result, user: str):
+        """
+        Counts a download of source, and starts copying it once it is popular enough
+        """
+        key = self.key(source)
+        if key in self._entries or key in self._copying or st.st_size > self.max_bytes:
+            return
+        now = time.monotonic()
+        recent = self._recent.setdefault(source, deque())
+        while recent and recent[0][0] < now - self.window:
+            recent.popleft()
+        recent.append((now, user))
+        if len({u for _, u in recent}) >= self.threshold:
+            del self._recent[source]
+            self._copying.add(key)
+            task = asyncio.create_task(self._promote(key, source, st))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        # forget sources nobody asked for lately
+        for path in [p for p, r in self._recent.items() if r[-1][0] < now - self.window]:
+            del self._recent[path]
+
+    async def _remove(self, key: str):
+        # the file goes first, so that a promotion of the same source can't start before it is gone
+        await io_bound(_unlink, self.path(key))
+        self._entries.pop(key, None)
+
+    async def _make_room(self, size: int) -> bool:
+        victims = sorted(self._entries, key=lambda k: (self._entries[k].hits, self._entries[k].last_used))
+        while self.used + size > self.max_bytes and victims:
+            key = victims.pop(0)
+            if (entry := self._entries.get(key)) is None:
+                continue
+            logger.info("Evicting copy of %r", entry.source)
+            await self._remove(key)
+        return self.used + size <= self.max_bytes
+
+    def _copy(self, key: str, source: str, st: os.stat_result) -> bool:
+        if shutil.disk_usage(self.directory).free < st.st_size:
+            logger.warning("Not enough free space to copy %r", source)
+            return False
+        tmp = self.path(key) + ".tmp"
+        try:
+            shutil.copyfile(source, tmp)
+            os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+            now = os.stat(source)
+            if (now.st_size, now.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+                logger.info("%r changed while being copied", source)
+                os.remove(tmp)
+                return False
+            os.replace(tmp, self.path(key))
+            return True
+        except OSError:
+            logger.exception("Copying %r failed", source)
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            return False
+
+    async def _promote(self, key: str, source: str, st: os.stat_result):
+        try:
+            # one copy at a time, so promotions don't compete with downloads for the source disks
+            async with self._copy_lock:
+                if not await self._make_room(st.st_size):
+                    return
+                logger.info("Copying %r to the hot tier", source)
+                started = time.monotonic()
+                if await io_bound(self._copy, key, source, st):
+                    self._entries[key] = Entry(source, st.st_size, st.st_mtime_ns, last_used=time.time())
+                    logger.info("Copied %r in %.0fs", source, time.monotonic() - started)
+                await io_bound(self._save)
+        finally:
+            self._copying.discard(key)
+
+    async def _count(self, rows: list[tuple[str, int, int, str, float]]):
+        uncopied = []
+        for source, size, mtime_ns, user, when in rows:
+            if (entry := self._entries.get(self.key(source))) is not None:
+                if (entry.size, entry.mtime_ns) == (size, mtime_ns):
+                    entry.hits += 1
+                    entry.last_used = max(entry.last_used, when)
+            else:
+                uncopied.append((source, size, mtime_ns, user))
+        stats = await io_bound(_stat_all, [row[0] for row in uncopied])
+        for (source, size, mtime_ns, user), st in zip(uncopied, stats):
+            if st is not None and (st.st_size, st.st_mtime_ns) == (size, mtime_ns):
+                self.record(source, st, user)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            try:
+                rows = await io_bound(self.downloads.take)
+                if rows:
+                    await self._count(rows)
+                    await io_bound(self._save)
+            except Exception:
+                logger.exception("Counting the workers' downloads failed")
+
+    def start(self):
+        task = asyncio.create_task(self._poll())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._save()
+        self.downloads.close()
+
+
+class Replica:
+    """
+    The tier as download workers see it: the copies in the index of the UI process, reread when it changes
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.downloads = Downloads(os.path.join(directory, DOWNLOADS))
+        self._entries: dict[str, Entry] = {}
+        self._index_mtime = None
+        self._checked = 0.0
+
+    def _refresh(self):
+        if time.monotonic() - self._checked < REFRESH_INTERVAL:
+            return
+        self._checked = time.monotonic()
+        try:
+            mtime = os.stat(os.path.join(self.directory, INDEX)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._index_mtime:
+            self._index_mtime = mtime
+            self._entries = _read_index(self.directory)
+
+    def _serve(self, source: str, st: os.stat_result, user: str) -> Optional[BinaryIO]:
+        self._refresh()
+        # the UI process counts it, as a hit or towards copying source
+        self.downloads.add(source, st, user)
+        key = _key(source)
+        if (entry := self._entries.get(key)) is None or (entry.size, entry.mtime_ns) != (st.st_size, st.st_mtime_ns):
+            return None
+        return _open_copy(os.path.join(self.directory, key), entry.size)
+
+    async def serve(self, source: str, st: os.stat_result, user: str) -> Optional[BinaryIO]:
+        return await io_bound(self._serve, source, st, user)
+
+    async def close(self):
+        self.downloads.close()
+
+
+tier: Optional[HotTier | Replica] = None
+
+
+def startup():
+    global tier
+    # the UI process owns the directory and its index, download workers (worker.py) attach to it instead
+    if config.hot_tier_dir:
+        tier = HotTier(config.hot_tier_dir, config.hot_tier_size * 1024 ** 3, config.hot_tier_threshold,
+                       config.hot_tier_window)
+        tier.start()
+
+
+app.on_startup(startup)
+
+
+def attach():
+    """
+    Startup of the download workers
+    """
+    global tier
+    if config.hot_tier_dir:
+        tier = Replica(config.hot_tier_dir)
+
+
+async def shutdown():
+    if tier is not None:
+        await tier.close()
+
+
+app.on_shutdown(shutdown)
@@ -0,0 +1,203 @@
+"""
+Plain view models of library items, and the batched Plex queries that build them.
+
+The renderer only ever sees these models: everything it displays is read from the XML containers in as few requests
+as possible, instead of from plexapi objects that lazily reload themselves one attribute access at a time.
+"""
+from dataclasses import dataclass, field
+from typing import Optional
+from xml.etree.ElementTree import Element
+
+from plexapi.exceptions import NotFound
+from plexapi.server import PlexServer
+
+KINDS = ("movie", "show", "season", "episode", "collection")
+PLAYABLE = ("movie", "episode")
+
+
+def _int(value) -> Optional[int]:
+    return int(value) if value not in (None, "") else None
+
+
+@dataclass(frozen=True)
+class MediaVersion:
+    """
+    One version of a playable item, described by its first part
+    """
+    width: Optional[int]
+    height: Optional[int]
+    duration: Optional[int]
+    size: Optional[int]
+    file: Optional[str] = None
+    part_key: Optional[str] = None
+
+    @classmethod
+    def from_element(cls, media: Element) -> Optional["MediaVersion"]:
+        part = media.find("Part")
+        if part is None:
+            return None
+        return cls(
+            width=_int(media.get("width")),
+            height=_int(media.get("height")),
+            duration=_int(part.get("duration") or media.get("duration")),
+            size=_int(part.get("size")),
+            file=part.get("file"),
+            part_key=part.get("key"),
+        )
+
+
+@dataclass(frozen=True, eq=False)
+class Item:
+    rating_key: int
+    type: str
+    title: str
+    edition_title: Optional[str] = None
+    guid: Optional[str] = None
+    section_id: Optional[int] = None
+    parent_key: Optional[int] = None
+    parent_title: Optional[str] = None
+    grandparent_key: Optional[int] = None
+    grandparent_title: Optional[str] = None
+    index: Optional[int] = None
+    thumb: Optional[str] = None
+    updated_at: Optional[int] = None
+    media: tuple[MediaVersion, ...] = field(default=())
+
+    # two views of the same item are the same item, even if they were loaded from different endpoints
+    def __eq__(self, other):
+        return isinstance(other, Item) and other.rating_key == self.rating_key
+
+    def __hash__(self):
+        return hash(self.rating_key)
+
+    @property
+    def playable(self) -> bool:
+        return self.type in PLAYABLE
+
+    @classmethod
+    def from_element(cls, e: Element, section_id: Optional[int] = None) -> "Item":
+        return cls(
+            rating_key=int(e.get("ratingKey")),
+            type=e.get("type"),
+            title=e.get("title") or "",
+            edition_title=e.get("editionTitle"),
+            guid=e.get("guid"),
+            section_id=_int(e.get("librarySectionID")) or section_id,
+            parent_key=_int(e.get("parentRatingKey")),
+            parent_title=e.get("parentTitle"),
+            grandparent_key=_int(e.get("grandparentRatingKey")),
+            grandparent_title=e.get("grandparentTitle"),
+            index=_int(e.get("index")),
+            thumb=e.get("thumb") or e.get("parentThumb") or e.get("grandparentThumb"),
+            updated_at=_int(e.get("updatedAt")),
+            media=tuple(m for m in map(MediaVersion.from_element, e.findall("Media")) if m is not None),
+        )
+
+
+def _parse(elements, section_id: Optional[int] = None) -> list[Item]:
+    return [Item.from_element(e, section_id) for e in elements if e.get("ratingKey") and e.get("type") in KINDS]
+
+
+def with_media(server: PlexServer, items: list[Item]) -> list[Item]:
+    """
+    Fills in the media of playable items listed without it, with one request for all of them
+    """
+    missing = [i.rating_key for i in items if i.playable and not i.media]
+    if not missing:
+        return items
+    full = {i.rating_key: i for i in fetch_items(server, missing)}
+    return [full.get(i.rating_key, i) if i.playable and not i.media else i for i in items]
+
+
+def fetch_items(server: PlexServer, rating_keys: list[int]) -> list[Item]:
+    """
+    Loads several items by ratingKey in a single request, in the given order
+    """
+    if not rating_keys:
+        return []
+    try:
+        container = server.query(f"/library/metadata/{','.join(map(str, rating_keys))}")
+    except NotFound:
+        # Plex only answers 404 when none of the keys exist
+        return []
+    found = {i.rating_key: i for i in _parse(container, _int(container.get("librarySectionID")))}
+    return [found[k] for k in rating_keys if k in found]
+
+
+def fetch_item(server: PlexServer, rating_key: int) -> Optional[Item]:
+    items = fetch_items(server, [rating_key])
+    return items[0] if items else None
+
+
+def search(server: PlexServer, query: str) -> list[Item]:
+    container = server.query("/hubs/search", params={"query": query, "includeCollections": 1})
+    items = []
+    for hub in container.iter("Hub"):
+        items.extend(_parse(hub))
+    return with_media(server, items)
+
+
+def editions(server: PlexServer, movie: Item) -> list[Item]:
+    """
+    Returns the other editions of a movie, i.e. the movies of the same section sharing its guid
+    """
+    if not movie.guid or movie.section_id is None:
+        return []
+    container = server.query(f"/library/sections/{movie.section_id}/all", params={"type": 1, "guid": movie.guid})
+    return [i for i in _parse(container, movie.section_id) if i.rating_key != movie.rating_key]
+
+
+def _children_key(item: Item) -> str:
+    if item.type == "collection":
+        return f"/library/collections/{item.rating_key}/children"
+    return f"/library/metadata/{item.rating_key}/children"
+
+
+def children(server: PlexServer, item: Item) -> list[Item]:
+    """
+    Seasons of a show, episodes of a season or items of a collection, with their media
+    """
+    container = server.query(_children_key(item))
+    return with_media(server, _parse(container, item.section_id or _int(container.get("librarySectionID"))))
+
+
+def children_page(server: PlexServer, item: Item, start: int, size: int) -> tuple[list[Item], Optional[int]]:
+    """
+    size children of an item from the start-th one, and where the next page starts (None after the last one)
+    """
+    container = server.query(_children_key(item),
+                             params={"X-Plex-Container-Start": start, "X-Plex-Container-Size": size})
+    items = with_media(server, _parse(container, item.section_id or _int(container.get("librarySectionID"))))
+    end = start + len(container)
+    total = _int(container.get("totalSize"))
+    more = end < total if total is not None else len(container) == size
+    return items, end if more and len(container) else None
+
+
+def leaves(server: PlexServer, item: Item) -> list[Item]:
+    """
+    Every playable item under a show, season or collection
+    """
+    if item.playable:
+        return [item]
+    if item.type == "show":
+        container = server.query(f"/library/metadata/{item.rating_key}/allLeaves")
+        return with_media(server, _parse(container, item.section_id))
+    result = []
+    for child in children(server, item):
+        result.extend([child] if child.playable else leaves(server, child))
+    return result
+
+
+def show_of(episode: Item) -> Item:
+    """
+    A crumb for the episode's show, built from the episode alone
+    """
+    return Item(rating_key=episode.grandparent_key, type="show", title=episode.grandparent_title or "",
+                section_id=episode.section_id)
+
+
+def season_of(episode: Item) -> Item:
+    return Item(rating_key=episode.parent_key, type="season", title=episode.parent_title or "",
+                parent_key=episode.grandparent_key, parent_title=episode.grandparent_title,
+                section_id=episode.section_id)
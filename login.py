@@ -3,18 +3,19 @@ This module uses code from https://github.com/Tautulli/Tautulli for the Plex OAu
 """
 from typing import Optional
 
-import asyncio
 from nicegui import ui, app
 from config import config
 import json
 from fastapi.responses import RedirectResponse
-from plex import check_user_token, check_server_token, get_server_token
+from plex import get_server_token, check_tokens, forget_tokens
 from locales import _
-
+from common import io_bound
+import sessions
+from sessions import Login
 
 async def check_login() -> Optional[tuple[str, str]]:
     if (user_token := app.storage.user.get("user_token")) and (server_token := app.storage.user.get("server_token")) \
-            and all(await asyncio.gather(check_user_token(user_token), check_server_token(server_token))):
+            and await check_tokens(user_token, server_token):
         return user_token, server_token
     else:
         app.storage.user.pop("user_token", None)
@@ -22,11 +23,24 @@ async def check_login() -> Optional[tuple[str, str]]:
         return None
 
 
+async def remember_session(request, response, login: Login):
+    """
+    Hands the browser a session cookie for its login, usable by the download workers, unless it has a valid one
+    """
+    if (session_id := request.cookies.get(sessions.COOKIE)) and await sessions.lookup(session_id) == login:
+        return
+    response.set_cookie(sessions.COOKIE, await io_bound(sessions.store.create, login), max_age=config.session_ttl,
+                        httponly=True, samesite="lax", secure=request.url.scheme == "https")
+
+
 @ui.page("/logout", title=_("logout"))
-def logout():
+async def logout():
+    await forget_tokens(app.storage.user.get("user_token"), app.storage.user.get("server_token"))
     app.storage.user.pop("user_token", None)
     app.storage.user.pop("server_token", None)
-    return RedirectResponse("/login")
+    response = RedirectResponse("/login")
+    response.delete_cookie(sessions.COOKIE)
+    return response
 
 
 @ui.page("/login", title=_("login"))
@@ -0,0 +1,50 @@
+"""
+Download lists for external download managers: aria2 input files, Metalink 4 (RFC 5854) and plain URL lists.
+"""
+from dataclasses import dataclass
+from typing import Optional
+from xml.sax.saxutils import escape, quoteattr
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    name: str
+    url: str
+    size: int
+    sha256: Optional[str] = None
+
+
+def aria2(entries: list[ManifestEntry]) -> str:
+    # aria2c -i manifest.aria2 -j 4 -x 8 -s 8
+    lines = []
+    for e in entries:
+        lines.append(e.url)
+        lines.append(f"  out={e.name}")
+        if e.sha256:
+            lines.append(f"  checksum=sha-256={e.sha256}")
+    return "\n".join(lines) + "\n"
+
+
+def metalink(entries: list[ManifestEntry]) -> str:
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<metalink xmlns="urn:ietf:params:xml:ns:metalink">']
+    for e in entries:
+        lines.append(f"  <file name={quoteattr(e.name)}>")
+        lines.append(f"    <size>{e.size}</size>")
+        if e.sha256:
+            lines.append(f'    <hash type="sha-256">{e.sha256}</hash>')
+        lines.append(f"    <url>{escape(e.url)}</url>")
+        lines.append("  </file>")
+    lines.append("</metalink>")
+    return "\n".join(lines) + "\n"
+
+
+def url_list(entries: list[ManifestEntry]) -> str:
+    # wget -i manifest.txt, files are named after the last path segment of their URL
+    return "".join(e.url + "\n" for e in entries)
+
+
+FORMATS = {
+    "aria2": (aria2, "text/plain"),
+    "meta4": (metalink, "application/metalink4+xml"),
+    "txt": (url_list, "text/plain"),
+}
@@ -0,0 +1,396 @@
+"""
+Routes serving media: single parts, ZIP bundles, download manifests, torrents and their web seeds, and checksums.
+
+They are mounted by the UI, and by the download workers (worker.py) which serve them from several processes; requests
+are authenticated by the login of the UI session or by the shared session cookie, signed URLs by their signature.
+"""
+import hashlib
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import quote
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import Response
+
+import checksums
+import hottier
+import library
+import manifest
+import notifications
+import remote
+import signing
+import torrent
+from bundles import bundle_name, bundle_files, bundle_entries, manifest_entry
+from common import io_bound, server_pool, Overloaded, TTLCache, SingleFlight
+from config import config
+from download import DownloadFileResponse, DOWNLOAD_HEADERS
+from hashcache import hashes
+from library import MediaVersion
+from plex import get_server, get_self, request_login
+from remote import RemotePartResponse, local_path, local_stat
+from scheduler import scheduler, Refused, RETRY_AFTER
+from sessions import Login
+from zipstream import ZipStreamResponse
+
+logger = logging.getLogger("plexdlweb.download")
+
+router = APIRouter()
+
+
+@dataclass(frozen=True)
+class ResolvedPart:
+    part: MediaVersion
+    # stat of the local copy, None when it is streamed from Plex
+    stat: Optional[os.stat_result]
+
+
+# (server token hash, ratingKey, media index) -> ResolvedPart, the token being part of the key since it is what
+# grants access to the item
+_parts = TTLCache(maxsize=config.part_cache_size, ttl=config.part_cache_ttl)
+_resolving = SingleFlight()
+notifications.on_item_changed(lambda rating_key, section_id: _parts.clear())
+notifications.on_section_changed(lambda section_id: _parts.clear())
+
+
+async def admit(request: Request, user: str, name: str, size: int, remote: bool = False):
+    """
+    Registers a download with the scheduler, or answers 429 when the stream limits are reached
+    """
+    if request.method == "HEAD":
+        return None
+    try:
+        return await scheduler.admit(user, name, size, "range" in request.headers, remote)
+    except Refused as e:
+        raise refused(e, user, name)
+
+
+def refused(e: Refused, user: str, name: str) -> HTTPException:
+    logger.info("Refused download user=%r name=%r: %s", user, name, e)
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+async def overloaded(request: Request, e: Overloaded) -> Response:
+    """
+    Exception handler: a thread pool shed the request
+    """
+    logger.warning("Shed %s %s: %s", request.method, request.url.path, e)
+    return Response(str(e), status_code=503, media_type="text/plain", headers={"Retry-After": str(RETRY_AFTER)})
+
+
+async def timed_out(request: Request, e: TimeoutError) -> Response:
+    """
+    Exception handler: a blocking call, usually to Plex, took longer than its pool's timeout
+    """
+    logger.warning("Timed out %s %s", request.method, request.url.path)
+    return Response("timed out", status_code=504, media_type="text/plain")
+
+
+async def remote_download(request: Request, part_key: str, token: str, user: str, filename: str, size: int):
+    """
+    Relays a part from Plex, for media that isn't readable locally
+    """
+    if not token:
+        raise HTTPException(status_code=404)
+    transfer = await admit(request, user, filename, size or 0, remote=True)
+    try:
+        upstream = await remote.open_part(part_key, token, request.method, request.headers)
+    except BaseException:
+        if transfer is not None:
+            transfer.close()
+        raise
+    return RemotePartResponse(upstream, filename, headers=DOWNLOAD_HEADERS, transfer=transfer)
+
+
+def readahead_options() -> dict:
+    return {
+        "readahead": config.readahead_window * 1024 * 1024,
+        "drop_behind": config.readahead_drop_behind,
+        "prefetch": config.readahead_prefetch,
+    }
+
+
+async def local_download(request: Request, path: str, st: os.stat_result, user: str,
+                         filename: str) -> DownloadFileResponse:
+    """
+    Streams a local file, from its hot tier copy when there is one. The copy is opened before the response starts, as
+    the tier may evict it at any time. Responses keep the stat of the source, so their validators don't change and a
+    download can resume from either copy.
+    """
+    headers = await checksum_headers(path, st)
+    transfer = await admit(request, user, filename, st.st_size)
+    try:
+        copy = None if (tier := hottier.tier) is None or request.method == "HEAD" else await tier.serve(path, st, user)
+    except BaseException:
+        if transfer is not None:
+            transfer.close()
+        raise
+    return DownloadFileResponse(path, filename=filename, stat_result=st, headers=headers, transfer=transfer, file=copy,
+                                **readahead_options())
+
+
+async def checksum_headers(path: str, st: os.stat_result) -> dict:
+    """
+    Download headers, with the file's digest when it is known; otherwise it gets computed for the next downloads
+    """
+    values = await io_bound(checksums.service.lookup, path, st)
+    return {**DOWNLOAD_HEADERS, **checksums.digest_headers(values)}
+
+
+@router.api_route("/download/bundle/{media}", methods=["GET", "HEAD"])
+async def download_bundle(request: Request, media: int, index: int = 0, login: Login = Depends(request_login)):
+    """
+    Downloads every episode or movie of a show, season or collection as a single uncompressed ZIP archive
+    """
+    server = await get_server(login)
+    item = await server_pool.run(library.fetch_item, server, media)
+    if item is None:
+        raise HTTPException(status_code=404)
+    leaves = await server_pool.run(library.leaves, server, item)
+    entries = await io_bound(bundle_entries, item, leaves, index)
+    filename = f"{bundle_name(item)}.zip"
+    user = (await get_self(login)).username
+    response = ZipStreamResponse(entries, filename, headers=DOWNLOAD_HEADERS, crc_cache=hashes, **readahead_options())
+    if not await response.prepare(request.scope):
+        # resuming past files whose CRCs are unknown, which would mean reading them all before sending anything
+        logger.info("Computing CRCs for bundle download media=%s index=%s range=%r", media, index,
+                    request.headers.get("range"))
+        return Response("archive being prepared, try again later\n", status_code=503, media_type="text/plain",
+                        headers={"Retry-After": "60"})
+    response.transfer = await admit(request, user, filename, response.size)
+    logger.info(
+        "Starting bundle download media=%s index=%s files=%s size=%s user=%r range=%r",
+        media,
+        index,
+        len(entries),
+        response.size,
+        user,
+        request.headers.get("range"),
+    )
+    return response
+
+
+@router.get("/manifest/{media}.{fmt}")
+async def download_manifest(request: Request, media: int, fmt: str, index: int = 0,
+                            login: Login = Depends(request_login)):
+    """
+    Lists signed per-file URLs for every episode or movie of an item, for aria2c, Metalink clients or wget -i
+    """
+    if fmt not in manifest.FORMATS:
+        raise HTTPException(status_code=404)
+    render, media_type = manifest.FORMATS[fmt]
+    server = await get_server(login)
+    item = await server_pool.run(library.fetch_item, server, media)
+    if item is None:
+        raise HTTPException(status_code=404)
+    leaves = await server_pool.run(library.leaves, server, item)
+    user = (await get_self(login)).username
+    base = str(request.base_url).rstrip("/")
+    lines = [await io_bound(manifest_entry, base, name, version, user, login.server_token)
+             for name, version in bundle_files(item, leaves, index)]
+    logger.info("Issued %s manifest media=%s files=%s user=%r", fmt, media, len(lines), user)
+    return Response(render(lines), media_type=media_type, headers={
+        "Content-Disposition": f"attachment; filename*=utf-8''{quote(bundle_name(item))}.{fmt}",
+        "Cache-Control": "private, no-store",
+    })
+
+
+@router.api_route("/torrent/{media}.torrent", methods=["GET", "HEAD"])
+async def download_torrent(request: Request, media: int, index: int = 0, version: str = "hybrid",
+                           login: Login = Depends(request_login)):
+    """
+    Torrent of a movie or episode, or of every episode or movie of a show, season or collection, web-seeded by
+    signed download URLs
+    """
+    if version not in torrent.VERSIONS:
+        raise HTTPException(status_code=400)
+    server = await get_server(login)
+    item = await server_pool.run(library.fetch_item, server, media)
+    if item is None:
+        raise HTTPException(status_code=404)
+    leaves = await server_pool.run(library.leaves, server, item)
+    files = bundle_files(item, leaves, index)
+    entries = await io_bound(bundle_entries, item, leaves, index)
+    if not entries:
+        raise HTTPException(status_code=404)
+    user = (await get_self(login)).username
+    base = str(request.base_url).rstrip("/")
+    if item.playable:
+        torrent_files = [torrent.TorrentFile([], entries[0].path, entries[0].stat)]
+    else:
+        # paths inside the torrent are relative to its name, which is the bundle's root folder
+        torrent_files = [torrent.TorrentFile(e.name.split("/")[1:], e.path, e.stat) for e in entries]
+    if not await torrent.prepare(torrent_files):
+        logger.info("Hashing for %s torrent media=%s files=%s user=%r", version, media, len(torrent_files), user)
+        return Response("torrent being prepared, try again later\n", status_code=202, media_type="text/plain",
+                        headers={"Retry-After": "60"})
+    if request.method == "HEAD":
+        # the web UI asks whether the torrent is ready before downloading it
+        return Response(media_type="application/x-bittorrent")
+    if item.playable:
+        _, part = files[0]
+        name = os.path.basename(part.file)
+        token = await io_bound(signing.sign, part.file, entries[0].stat.st_size, user, login.server_token,
+                               part.part_key, entries[0].stat.st_mtime_ns, ttl=config.torrent_ttl)
+        web_seed = f"{base}/download/signed/{token}/{quote(name)}"
+    else:
+        name = bundle_name(item)
+        signed = {e.name: (part.file, e.stat.st_size, e.stat.st_mtime_ns, part.part_key)
+                  for e, (_, part) in zip(entries, files)}
+        token = await io_bound(signing.sign_files, signed, user, login.server_token, ttl=config.torrent_ttl)
+        web_seed = f"{base}/webseed/{token}/"
+    started = time.monotonic()
+    data = await torrent.make_torrent(name, torrent_files, version, web_seed, config.torrent_trackers)
+    logger.info("Issued %s torrent media=%s files=%s user=%r in %.1fs", version, media, len(torrent_files), user,
+                time.monotonic() - started)
+    return Response(data, media_type="application/x-bittorrent", headers={
+        "Content-Disposition": f"attachment; filename*=utf-8''{quote(name)}.torrent",
+        "Cache-Control": "private, no-store",
+    })
+
+
+@router.api_route("/download/signed/{token}/{filename}", methods=["GET", "HEAD"])
+async def download_signed(request: Request, token: str, filename: str):
+    """
+    Downloads a file listed in a manifest, authorized by the signature of its URL alone
+    """
+    if (grant := await io_bound(signing.verify, token)) is None:
+        raise HTTPException(status_code=403)
+    return await download_grant(request, grant, filename)
+
+
+@router.api_route("/webseed/{token}/{name:path}", methods=["GET", "HEAD"])
+async def webseed(request: Request, token: str, name: str):
+    """
+    Web seed of a multi-file torrent: clients append the torrent's name and a file's path to the URL
+    """
+    if (grant := await io_bound(signing.verify, token, name)) is None:
+        raise HTTPException(status_code=403)
+    return await download_grant(request, grant, name)
+
+
+async def download_grant(request: Request, grant: signing.Grant, filename: str):
+    basename = os.path.basename(grant.path)
+    try:
+        stat_result = await io_bound(local_stat, grant.path)
+    except OSError:
+        # unreadable with remote_downloads = "never": missing, but also permissions, a file in place of a directory...
+        raise HTTPException(status_code=404)
+    if stat_result is None:
+        logger.info("Starting remote signed download filename=%r user=%r range=%r", filename, grant.user,
+                    request.headers.get("range"))
+        # nobody is logged in here, so the part is fetched as the server owner
+        return await remote_download(request, grant.part_key, config.admin_token, grant.user, basename, grant.size)
+    if stat_result.st_size != grant.size or grant.mtime_ns not in (None, stat_result.st_mtime_ns):
+        # the file was replaced since the grant was issued, don't let a segmented download mix both versions
+        raise HTTPException(status_code=410)
+    logger.info(
+        "Starting signed download filename=%r size=%s user=%r range=%r",
+        filename,
+        stat_result.st_size,
+        grant.user,
+        request.headers.get("range"),
+    )
+    return await local_download(request, local_path(grant.path), stat_result, grant.user, basename)
+
+
+def _resolve(server, media: int, index: int) -> Optional[ResolvedPart]:
+    item = library.fetch_item(server, media)
+    if item is None or not 0 <= index < len(item.media):
+        return None
+    part = item.media[index]
+    try:
+        return ResolvedPart(part, local_stat(part.file))
+    except OSError:
+        return None
+
+
+def _restat(resolved: ResolvedPart) -> Optional[ResolvedPart]:
+    """
+    A cached resolution with the current stat of the file, or None if it changed since
+    """
+    if resolved.stat is None:
+        return resolved
+    try:
+        st = os.stat(local_path(resolved.part.file))
+    except OSError:
+        return None
+    if (st.st_size, st.st_mtime_ns) != (resolved.stat.st_size, resolved.stat.st_mtime_ns):
+        return None
+    return ResolvedPart(resolved.part, st)
+
+
+async def _fetch_part(key, login: Login, media: int, index: int) -> Optional[ResolvedPart]:
+    resolved = await server_pool.run(_resolve, await get_server(login), media, index)
+    if resolved is not None:
+        _parts.set(key, resolved)
+    return resolved
+
+
+async def resolve_part(login: Login, media: int, index: int) -> Optional[ResolvedPart]:
+    """
+    The part of a media version and its stat: only the first request of a download asks Plex, the next ones (ranges
+    of a segmented or resumed download) just check that the file is still the same
+    """
+    key = (hashlib.sha256(login.server_token.encode()).hexdigest(), media, index)
+    if (cached := _parts.get(key)) is not None:
+        if (resolved := await io_bound(_restat, cached)) is not None:
+            return resolved
+        _parts.pop(key)
+    return await _resolving.run(key, _fetch_part, key, login, media, index)
+
+
+@router.api_route("/download/{media}/{index}", methods=["GET", "HEAD"])
+async def download(request: Request, media: int, index: int, login: Login = Depends(request_login)):
+    """
+    Downloads the specified media part from Plex
+    """
+    if (resolved := await resolve_part(login, media, index)) is None:
+        raise HTTPException(status_code=404)
+    part, stat_result = resolved.part, resolved.stat
+    filename = os.path.basename(part.file)
+    user = (await get_self(login)).username
+    if stat_result is None:
+        logger.info("Starting remote download media=%s index=%s filename=%r user=%r range=%r", media, index,
+                    filename, user, request.headers.get("range"))
+        return await remote_download(request, part.part_key, login.server_token, user, filename,
+                                     part.size)
+    logger.info(
+        "Starting download media=%s index=%s filename=%r size=%s user=%r range=%r",
+        media,
+        index,
+        filename,
+        stat_result.st_size,
+        user,
+        request.headers.get("range"),
+    )
+    return await local_download(request, local_path(part.file), stat_result, user, filename)
+
+
+@router.get("/checksum/{media}/{index}.{algorithm}")
+async def checksum(media: int, index: int, algorithm: str, login: Login = Depends(request_login)):
+    """
+    Checksum file of a media part, in the format of sha256sum and similar tools
+    """
+    if algorithm not in checksums.service.algorithms:
+        raise HTTPException(status_code=404)
+    server = await get_server(login)
+    item = await server_pool.run(library.fetch_item, server, media)
+    if item is None or not 0 <= index < len(item.media):
+        raise HTTPException(status_code=404)
+    part = item.media[index]
+    try:
+        stat_result = await io_bound(local_stat, part.file)
+    except OSError:
+        raise HTTPException(status_code=404)
+    if stat_result is None:
+        raise HTTPException(status_code=501, detail="checksums need the media to be readable locally")
+    path = local_path(part.file)
+    if (value := (await io_bound(checksums.service.lookup, path, stat_result)).get(algorithm)) is None:
+        return Response("checksum being computed, try again later\n", status_code=202, media_type="text/plain",
+                        headers={"Retry-After": "60"})
+    return Response(f"{value.hex()}  {os.path.basename(part.file)}\n", media_type="text/plain", headers={
+        "Content-Disposition": f"attachment; filename*=utf-8''{quote(os.path.basename(part.file))}.{algorithm}",
+    })
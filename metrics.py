@@ -0,0 +1,328 @@
+"""
+Prometheus metrics, served in the text exposition format at /metrics.
+
+Metrics are plain in-process counters and histograms with fixed buckets, updated with a dict lookup and a bisect
+under a lock, so they can stay on under full load; gauges (transfers, pools) are read when written out.
+
+Each process (the UI and every download worker) writes its values to {metrics_dir}/{pid}.json every DUMP_INTERVAL, and
+/metrics, whichever process answers it, serves their sum, so that counters never go backwards between scrapes. The
+files of processes that exited keep counting for counters and histograms, not for gauges; the UI process removes
+them when it starts.
+"""
+import asyncio
+import bisect
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterable
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+
+from config import config
+
+# seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# how often the event loop lag is sampled, and the values written out, in seconds
+LAG_INTERVAL = 0.5
+DUMP_INTERVAL = 5.0
+# age in seconds of a process's file past which it counts as exited
+STALE_AFTER = 3 * DUMP_INTERVAL
+
+logger = logging.getLogger("plexdlweb.metrics")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+    def snapshot(self) -> list:
+        """
+        Current values, as JSON
+        """
+        raise NotImplementedError
+
+    def merge(self, values: dict, snapshot: list):
+        """
+        Adds the values of a snapshot to values
+        """
+        for labels, value in snapshot:
+            values[tuple(labels)] = values.get(tuple(labels), 0) + value
+
+    def render(self, values: dict) -> list[str]:
+        return [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in values.items()]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        return [[[str(v) for v in k], value] for k, value in values]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # labels -> [count per bucket (the last one being +Inf), sum]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if (entry := self._values.get(labels)) is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def snapshot(self) -> list:
+        with self._lock:
+            values = [(k, list(counts), total) for k, (counts, total) in self._values.items()]
+        return [[[str(v) for v in k], [counts, total]] for k, counts, total in values]
+
+    def merge(self, values: dict, snapshot: list):
+        for labels, (counts, total) in snapshot:
+            if (entry := values.get(tuple(labels))) is None:
+                entry = values[tuple(labels)] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0] = [a + b for a, b in zip(entry[0], counts)]
+            entry[1] += total
+
+    def render(self, values: dict) -> list[str]:
+        lines = []
+        for labels, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class Collected(_Metric):
+    """
+    Gauge (or counter kept elsewhere) read when written out: collect returns (label values, value) pairs
+    """
+    def __init__(self, name: str, help: str, labels: tuple[str, ...], collect: Callable[[], Iterable[tuple]],
+                 type: str = "gauge"):
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.type = type
+
+    def snapshot(self) -> list:
+        return [[[str(v) for v in k], value] for k, value in self.collect()]
+
+
+_registry: list[_Metric] = []
+
+requests = Histogram("plexdlweb_http_request_duration_seconds",
+                     "Time until the response headers are sent, by route", ("route", "method", "status"))
+calls = Histogram("plexdlweb_blocking_call_duration_seconds", "Run time of blocking calls, by pool and function",
+                  ("pool", "call"))
+waits = Histogram("plexdlweb_blocking_call_wait_seconds", "Time blocking calls wait for a thread, by pool",
+                  ("pool",))
+token_checks = Counter("plexdlweb_token_checks_total", "Plex token validations, by kind and result",
+                       ("kind", "result"))
+download_bytes = Counter("plexdlweb_download_bytes_total", "Bytes sent by downloads", ("range",))
+downloads = Counter("plexdlweb_downloads_finished_total", "Finished downloads, partial (Range) or full",
+                    ("range",))
+thumbnails = Counter("plexdlweb_thumbnail_requests_total", "Thumbnail requests, by cache result", ("result",))
+proxy = Counter("plexdlweb_plex_proxy_requests_total", "Plex proxy requests, by cache result", ("result",))
+loop_lag = Histogram("plexdlweb_event_loop_lag_seconds", "Delay of the event loop in running a timer")
+
+
+def snapshot() -> dict:
+    return {"written": time.time(), "metrics": {m.name: m.snapshot() for m in _registry}}
+
+
+def _path(pid: int) -> str:
+    return os.path.join(config.metrics_dir, f"{pid}.json")
+
+
+def dump():
+    """
+    Writes the values of this process out; blocking
+    """
+    os.makedirs(config.metrics_dir, exist_ok=True)
+    tmp = _path(os.getpid()) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp, _path(os.getpid()))
+
+
+def _snapshots() -> list[dict]:
+    snapshots = [snapshot()]
+    try:
+        names = os.listdir(config.metrics_dir)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not name.endswith(".json") or name == f"{os.getpid()}.json":
+            continue
+        try:
+            with open(os.path.join(config.metrics_dir, name)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            # being replaced, or being removed
+            continue
+    return snapshots
+
+
+def render() -> str:
+    """
+    The values of every process, summed; blocking
+    """
+    snapshots = _snapshots()
+    now = time.time()
+    lines = []
+    for metric in _registry:
+        values = {}
+        for snap in snapshots:
+            if metric.type == "gauge" and now - snap.get("written", 0) > STALE_AFTER:
+                continue
+            metric.merge(values, snap.get("metrics", {}).get(metric.name, []))
+        lines.extend(metric.header())
+        lines.extend(metric.render(values))
+    return "\n".join(lines) + "\n"
+
+
+def clean():
+    """
+    Removes the files of processes that exited; blocking
+    """
+    try:
+        entries = list(os.scandir(config.metrics_dir))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if time.time() - entry.stat().st_mtime > STALE_AFTER:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def _route(scope) -> str:
+    # templates rather than paths, so that the number of series stays bounded
+    if (route := scope.get("route")) is not None and hasattr(route, "path"):
+        return route.path
+    if scope["path"].startswith("/_nicegui/"):
+        return "/_nicegui/*"
+    return "other"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing each HTTP request until its response starts, which for downloads is before the body
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status, started
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                requests.observe(time.perf_counter() - started, _route(scope), scope["method"], status)
+                started = None
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if started is not None:
+                # failed before sending anything
+                requests.observe(time.perf_counter() - started, _route(scope), scope["method"], status)
+
+
+async def _watch_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        before = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        loop_lag.observe(max(0.0, loop.time() - before - LAG_INTERVAL))
+
+
+async def _dump_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, dump)
+        except Exception:
+            logger.exception("Writing metrics out failed")
+        await asyncio.sleep(DUMP_INTERVAL)
+
+
+_tasks: list[asyncio.Task] = []
+
+
+async def startup():
+    _tasks.extend([asyncio.create_task(_watch_loop()), asyncio.create_task(_dump_loop())])
+
+
+async def shutdown():
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    try:
+        # the last values of the counters keep counting
+        dump()
+    except OSError:
+        logger.exception("Writing metrics out failed")
+
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def metrics(request: Request):
+    # off unless a token is set, so that it is never public by mistake
+    if not config.metrics_token:
+        raise HTTPException(status_code=404)
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), config.metrics_token.encode()):
+        raise HTTPException(status_code=401, headers={"WWW-Authenticate": "Bearer"})
+    text = await asyncio.get_running_loop().run_in_executor(None, render)
+    return Response(text, media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,196 @@
+"""
+Listens to the Plex server's notification websocket and turns library changes into cache invalidations.
+
+Caches register with on_item_changed/on_section_changed. When the websocket stays down, section updatedAt values are
+polled instead, so invalidations keep flowing (coarser, per section) until it comes back.
+"""
+import asyncio
+import json
+import logging
+import random
+from typing import Callable, Optional
+
+import httpx
+import websockets
+from nicegui import app
+
+from config import config
+
+logger = logging.getLogger("plexdlweb.notifications")
+
+_item_handlers: list[Callable[[int, Optional[int]], None]] = []
+_section_handlers: list[Callable[[int], None]] = []
+
+# timeline states: 5 = the item is done processing, 9 = the item was deleted
+TIMELINE_DONE = 5
+TIMELINE_DELETED = 9
+LIBRARY_IDENTIFIER = "com.plexapp.plugins.library"
+
+
+def on_item_changed(func: Callable[[int, Optional[int]], None]):
+    """
+    Registers func(rating_key, section_id) to be called when a library item changes or is deleted
+    """
+    _item_handlers.append(func)
+    return func
+
+
+def on_section_changed(func: Callable[[int], None]):
+    """
+    Registers func(section_id) to be called when the content of a library section changes
+    """
+    _section_handlers.append(func)
+    return func
+
+
+def invalidate_item(rating_key: int, section_id: Optional[int] = None):
+    for handler in _item_handlers:
+        try:
+            handler(rating_key, section_id)
+        except Exception:
+            logger.exception("Item invalidation handler %r failed", handler)
+
+
+def invalidate_section(section_id: int):
+    for handler in _section_handlers:
+        try:
+            handler(section_id)
+        except Exception:
+            logger.exception("Section invalidation handler %r failed", handler)
+
+
+def _int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def handle_notification(data: dict):
+    """
+    Translates one decoded notification message into invalidations
+    """
+    container = data.get("NotificationContainer", data)
+    kind = container.get("type")
+    if kind == "timeline":
+        sections = set()
+        for entry in container.get("TimelineEntry", []):
+            if entry.get("identifier") != LIBRARY_IDENTIFIER:
+                continue
+            if entry.get("state") not in (TIMELINE_DONE, TIMELINE_DELETED):
+                continue
+            section_id = _int(entry.get("sectionID"))
+            if (rating_key := _int(entry.get("itemID"))) is not None:
+                invalidate_item(rating_key, section_id)
+            if section_id is not None and section_id >= 0:
+                sections.add(section_id)
+        for section_id in sections:
+            invalidate_section(section_id)
+    elif kind == "activity":
+        for notification in container.get("ActivityNotification", []):
+            activity = notification.get("Activity", {})
+            if notification.get("event") != "ended" or not activity.get("type", "").startswith("library."):
+                continue
+            if (section_id := _int(activity.get("Context", {}).get("librarySectionID"))) is not None:
+                invalidate_section(section_id)
+
+
+class NotificationListener:
+    """
+    Keeps a websocket to the server open, reconnecting with exponential backoff and polling while it is down
+    """
+    def __init__(self, server_url: str, token: str, max_backoff: float = 60):
+        self.server_url = server_url.rstrip("/")
+        self.token = token
+        self.max_backoff = max_backoff
+        self._sections: dict[int, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ws_url(self) -> str:
+        base = self.server_url.replace("https://", "wss://", 1).replace("http://", "ws://", 1)
+        return f"{base}/:/websockets/notifications?X-Plex-Token={self.token}"
+
+    async def _listen(self):
+        async with websockets.connect(self.ws_url, open_timeout=10, ping_interval=30) as ws:
+            logger.info("Connected to Plex notifications")
+            async for message in ws:
+                try:
+                    handle_notification(json.loads(message))
+                except (ValueError, AttributeError):
+                    logger.warning("Ignoring malformed notification %r", message[:200])
+
+    async def poll_sections(self, client: httpx.AsyncClient):
+        """
+        Compares the sections' updatedAt with the last known values, invalidating the ones that moved
+        """
+        resp = await client.get(f"{self.server_url}/library/sections",
+                                headers={"X-Plex-Token": self.token, "Accept": "application/json"})
+        resp.raise_for_status()
+        for directory in resp.json().get("MediaContainer", {}).get("Directory", []):
+            section_id = _int(directory.get("key"))
+            updated_at = max(_int(directory.get("updatedAt")) or 0, _int(directory.get("contentChangedAt")) or 0)
+            if section_id is None:
+                continue
+            if section_id in self._sections and self._sections[section_id] != updated_at:
+                invalidate_section(section_id)
+            self._sections[section_id] = updated_at
+
+    async def _poll_quietly(self, client: httpx.AsyncClient):
+        try:
+            await self.poll_sections(client)
+        except Exception as e:
+            logger.warning("Polling Plex sections failed: %s", e)
+
+    async def run(self):
+        failures = 0
+        async with httpx.AsyncClient(timeout=30) as client:
+            await self._poll_quietly(client)
+            while True:
+                try:
+                    await self._listen()
+                    failures = 0
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    failures += 1
+                    logger.warning("Plex notification websocket failed (%s attempts): %s", failures, e)
+                await asyncio.sleep(min(self.max_backoff, 2 ** failures) * random.uniform(0.5, 1))
+                # notifications were missed while disconnected, cleanly or not, catch up by polling; while the
+                # websocket stays down this polls every max_backoff seconds
+                await self._poll_quietly(client)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+listener: Optional[NotificationListener] = None
+
+
+async def start_listener():
+    global listener
+    if not config.admin_token:
+        logger.info("No admin_token configured, cache invalidation from Plex notifications is disabled")
+        return
+    listener = NotificationListener(config.server_url, config.admin_token, config.notification_poll_interval)
+    listener.start()
+
+
+app.on_startup(start_listener)
+
+
+async def stop_listener():
+    if listener is not None:
+        await listener.stop()
+
+
+app.on_shutdown(stop_listener)
@@ -1,11 +1,28 @@
+import asyncio
+import hashlib
+import importlib.util
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
 from nicegui import app
 from plexapi.server import PlexServer
 from plexapi.myplex import MyPlexAccount
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse, Response
 from starlette.background import BackgroundTask
 import httpx
+import requests
+from requests.adapters import HTTPAdapter
 from config import config
-from common import io_bound
+from common import io_bound, plextv_pool, server_pool, TTLCache, SingleFlight
+import metrics
+import notifications
+import sessions
+import signing
+from sessions import Login
+
+logger = logging.getLogger("plexdlweb.plex")
 
 
 def _clean_token(token: str | None, name: str) -> str:
@@ -14,66 +31,308 @@ def _clean_token(token: str | None, name: str) -> str:
     return token.strip()
 
 
-@app.on_startup
+PLEXTV = "https://plex.tv"
+
+
+class _PlexTvAdapter(HTTPAdapter):
+    """
+    Sends the requests plexapi makes to plex.tv, whose URLs it hardcodes, to config.plextv_url instead
+    """
+    def send(self, request, **kwargs):
+        request.url = config.plextv_url.rstrip("/") + request.url[len(PLEXTV):]
+        return super().send(request, **kwargs)
+
+
+def _new_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=config.plex_pool_connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if config.plextv_url.rstrip("/") != PLEXTV:
+        logger.warning("Sending plex.tv requests, and the users' tokens, to %s: plextv_url is meant for testing only",
+                       config.plextv_url)
+        session.mount(PLEXTV + "/", _PlexTvAdapter(pool_connections=4, pool_maxsize=config.plex_pool_connections))
+    return session
+
+
+# keep-alive connections shared by every pooled PlexServer and MyPlexAccount
+session = _new_session()
+# live plexapi objects, keyed by a hash of their token, evicted after plex_pool_idle seconds without use
+_servers = TTLCache(maxsize=config.plex_pool_size, ttl=config.plex_pool_idle)
+_accounts = TTLCache(maxsize=config.plex_pool_size, ttl=config.plex_pool_idle)
+_connecting = SingleFlight()
+
+
+def _token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
 async def startup():
-    app.state.httpx_client = httpx.AsyncClient()
+    app.state.httpx_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=config.proxy_max_connections, max_keepalive_connections=config.proxy_max_connections),
+        # HTTP/2 is only negotiated over TLS, and needs the optional h2 package
+        http2=importlib.util.find_spec("h2") is not None,
+    )
+
+
+app.on_startup(startup)
 
 
-@app.on_shutdown
 async def shutdown():
     await app.state.httpx_client.aclose()
+    _servers.clear()
+    _accounts.clear()
+    session.close()
+
+
+app.on_shutdown(shutdown)
 
 
-@app.get("/plex/{path:path}")
-async def streaming(path: str) -> StreamingResponse:
+# validated (user_token, server_token) pairs, keyed by a hash so raw tokens don't sit in memory as keys
+_token_cache = TTLCache(maxsize=1024, ttl=config.auth_cache_ttl)
+_token_checks = SingleFlight()
+# number of times each pair was forgotten lately, so that a check started before a logout doesn't cache its result
+_forgotten = TTLCache(maxsize=1024, ttl=config.auth_cache_ttl)
+
+
+def _token_key(user_token: str, server_token: str) -> str:
+    return hashlib.sha256(f"{user_token}\0{server_token}".encode()).hexdigest()
+
+
+async def _validate_tokens(key: str, user_token: str, server_token: str) -> bool:
+    generation = _forgotten.get(key, 0)
+    valid = all(await asyncio.gather(check_user_token(user_token), check_server_token(server_token)))
+    if _forgotten.get(key, 0) == generation:
+        _token_cache.set(key, valid, None if valid else config.auth_cache_negative_ttl)
+    return valid
+
+
+async def check_tokens(user_token: str, server_token: str) -> bool:
+    """
+    Validates a token pair against plex.tv and the server, remembering the outcome for a while
+    """
+    key = _token_key(user_token, server_token)
+    if (valid := _token_cache.get(key)) is None:
+        valid = await _token_checks.run(key, _validate_tokens, key, user_token, server_token)
+    return valid
+
+
+async def forget_tokens(user_token: Optional[str], server_token: Optional[str]):
+    if user_token and server_token:
+        key = _token_key(user_token, server_token)
+        _token_cache.pop(key)
+        _forgotten.set(key, _forgotten.get(key, 0) + 1)
+        _token_checks.forget(key)
+        await sessions.forget(Login(user_token, server_token))
+        await io_bound(signing.revoke, server_token)
+    forget_token(user_token)
+    forget_token(server_token)
+
+
+async def request_login(request: Request) -> Login:
+    """
+    Tokens of the user making an HTTP request: set by the UI's middleware, else found from the shared session cookie
+    """
+    if (login := getattr(request.state, "login", None)) is not None:
+        return login
+    if (session_id := request.cookies.get(sessions.COOKIE)) \
+            and (login := await sessions.lookup(session_id)) is not None \
+            and await check_tokens(login.user_token, login.server_token):
+        return login
+    raise HTTPException(status_code=401)
+
+
+# the Plex proxy, mounted by the UI and by the download workers
+router = APIRouter()
+
+
+# headers that only make sense for a single connection, and must not be forwarded by a proxy
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+              "transfer-encoding", "upgrade"}
+# client headers passed on to Plex, so that it can answer conditional and partial requests itself
+FORWARDED = ("accept", "accept-encoding", "accept-language", "range", "if-range", "if-none-match", "if-modified-since")
+CONDITIONAL = ("range", "if-range", "if-none-match", "if-modified-since")
+# small metadata answers, as opposed to images and media which are streamed
+CACHEABLE_PREFIXES = ("library/metadata/", "library/sections", "library/collections/", "hubs/", "identity")
+CACHEABLE_MAX_SIZE = 256 * 1024
+
+
+@dataclass(frozen=True)
+class _Buffered:
+    status_code: int
+    headers: list[tuple[str, str]]
+    content: bytes
+
+
+_responses = TTLCache(maxsize=config.proxy_cache_size, ttl=config.proxy_cache_ttl)
+_forwarding = SingleFlight()
+# answers found too large to cache
+_oversized = TTLCache(maxsize=config.proxy_cache_size, ttl=config.proxy_cache_ttl)
+# metadata changes aren't mapped to their URLs, and entries only live proxy_cache_ttl seconds anyway
+notifications.on_item_changed(lambda rating_key, section_id: _responses.clear())
+notifications.on_section_changed(lambda section_id: _responses.clear())
+
+
+def response_headers(headers: httpx.Headers) -> list[tuple[str, str]]:
+    """
+    Upstream headers minus the hop-by-hop ones, including those listed in Connection
+    """
+    dropped = HOP_BY_HOP | {h.strip().lower() for h in headers.get("connection", "").split(",")}
+    return [(k, v) for k, v in headers.multi_items() if k.lower() not in dropped]
+
+
+def _is_cacheable(path: str, request: Request) -> bool:
+    return config.proxy_cache_ttl > 0 and path.startswith(CACHEABLE_PREFIXES) \
+        and not any(part in path for part in ("/thumb", "/art", "/composite")) \
+        and not any(h in request.headers for h in CONDITIONAL)
+
+
+async def _fetch_buffered(client: httpx.AsyncClient, req: httpx.Request, key) -> Optional[_Buffered]:
+    """
+    Reads a small answer whole, caching it if successful; returns None, having read at most CACHEABLE_MAX_SIZE bytes,
+    when it is too large to cache
+    """
+    resp = await client.send(req, stream=True)
+    try:
+        length = resp.headers.get("content-length")
+        if length and length.isdigit() and int(length) > CACHEABLE_MAX_SIZE:
+            return None
+        content = bytearray()
+        async for chunk in resp.aiter_raw():
+            content += chunk
+            if len(content) > CACHEABLE_MAX_SIZE:
+                return None
+    finally:
+        await resp.aclose()
+    buffered = _Buffered(resp.status_code, response_headers(resp.headers), bytes(content))
+    if resp.status_code == 200:
+        _responses.set(key, buffered)
+    return buffered
+
+
+@router.get("/plex/{path:path}")
+async def streaming(path: str, request: Request, login: Login = Depends(request_login)) -> Response:
     """
     Forwards a request to the Plex server
     """
     # https://stackoverflow.com/a/74556972/2196124
     client = app.state.httpx_client
-    url = httpx.URL(config.server_url + "/" + path)
-    req = httpx.Request("GET", url, headers={"X-Plex-Token": app.storage.user.get("server_token")})
+    token = login.server_token
+    url = httpx.URL(config.server_url + "/" + path, query=request.url.query.encode())
+    headers = {h: request.headers[h] for h in FORWARDED if h in request.headers}
+    # the body is relayed as is, so it must be in an encoding the client accepts
+    headers.setdefault("accept-encoding", "identity")
+    req = httpx.Request("GET", url, headers={**headers, "X-Plex-Token": token})
+    if _is_cacheable(path, request):
+        key = (_token_hash(token or ""), str(url), headers.get("accept"), headers["accept-encoding"])
+        if (buffered := _responses.get(key)) is not None:
+            metrics.proxy.inc("hit")
+            return Response(buffered.content, status_code=buffered.status_code, headers=dict(buffered.headers))
+        if not _oversized.get(key):
+            metrics.proxy.inc("miss")
+            if (buffered := await _forwarding.run(key, _fetch_buffered, client, req, key)) is not None:
+                return Response(buffered.content, status_code=buffered.status_code, headers=dict(buffered.headers))
+            # streamed from now on, without buffering the start of it again first
+            _oversized.set(key, True)
+        else:
+            metrics.proxy.inc("oversized")
     resp = await client.send(req, stream=True)
     return StreamingResponse(
         resp.aiter_raw(),
         status_code=resp.status_code,
-        headers=resp.headers,
+        headers=dict(response_headers(resp.headers)),
         background=BackgroundTask(resp.aclose)
     )
 
 
-async def get_server():
-    token = _clean_token(app.storage.user.get("server_token"), "server token")
-    return await io_bound(PlexServer, config.server_url, token)
+async def _connect_server(key: str, token: str) -> PlexServer:
+    server = await server_pool.run(PlexServer, config.server_url, token, session=session)
+    _servers.set(key, server)
+    return server
 
 
-async def get_self():
-    token = _clean_token(app.storage.user.get("user_token"), "user token")
-    return await io_bound(MyPlexAccount, token=token)
+async def _connect_account(key: str, token: str) -> MyPlexAccount:
+    account = await plextv_pool.run(MyPlexAccount, token=token, session=session)
+    _accounts.set(key, account)
+    return account
+
+
+async def server_for_token(token: str) -> PlexServer:
+    """
+    Returns a pooled PlexServer for the token, connecting on first use
+    """
+    key = _token_hash(token)
+    if (server := _servers.get(key)) is None:
+        server = await _connecting.run(("server", key), _connect_server, key, token)
+    else:
+        _servers.set(key, server)
+    return server
+
+
+async def account_for_token(token: str) -> MyPlexAccount:
+    """
+    Returns a pooled MyPlexAccount for the token, connecting on first use
+    """
+    key = _token_hash(token)
+    if (account := _accounts.get(key)) is None:
+        account = await _connecting.run(("account", key), _connect_account, key, token)
+    else:
+        _accounts.set(key, account)
+    return account
+
+
+async def get_server(login: Login = None):
+    """
+    The server as seen by the logged-in user: of the current UI client, or of the given login
+    """
+    token = _clean_token(login.server_token if login else app.storage.user.get("server_token"), "server token")
+    return await server_for_token(token)
+
+
+async def get_self(login: Login = None):
+    token = _clean_token(login.user_token if login else app.storage.user.get("user_token"), "user token")
+    return await account_for_token(token)
 
 
 async def get_server_token(user_token: str) -> str:
     user_token = _clean_token(user_token, "user token")
-    acc = await io_bound(MyPlexAccount, token=user_token)
-    srv = [r for r in await io_bound(acc.resources) if r.clientIdentifier == config.server_id][0]
+    acc = await account_for_token(user_token)
+    srv = [r for r in await plextv_pool.run(acc.resources) if r.clientIdentifier == config.server_id][0]
     return _clean_token(srv.accessToken, "server token")
 
 
+def forget_token(token: str | None):
+    """
+    Drops the pooled objects built from a token, e.g. when its owner logs out
+    """
+    if token:
+        key = _token_hash(token)
+        _servers.pop(key)
+        _accounts.pop(key)
+
+
 async def check_user_token(token: str) -> bool:
+    # always hits plex.tv: the pool only saves the connection setup, it doesn't vouch for the token
     try:
         token = _clean_token(token, "user token")
-        await io_bound(MyPlexAccount, token=token)
+        await _connect_account(_token_hash(token), token)
+        metrics.token_checks.inc("user", "valid")
         return True
     except Exception as e:
-        print(e)
+        logger.warning("User token check failed: %s", e)
+        metrics.token_checks.inc("user", "invalid")
+        forget_token(token)
         return False
 
 
 async def check_server_token(token: str) -> bool:
     try:
         token = _clean_token(token, "server token")
-        await io_bound(PlexServer, config.server_url, token=token)
+        await _connect_server(_token_hash(token), token)
+        metrics.token_checks.inc("server", "valid")
         return True
     except Exception as e:
-        print(e)
+        logger.warning("Server token check failed: %s", e)
+        metrics.token_checks.inc("server", "invalid")
+        forget_token(token)
         return False
@@ -0,0 +1,169 @@
+"""
+The installable web app: its manifest, and the service worker making repeat visits fast.
+
+The worker precaches NiceGUI's static files (Quasar, Vue, socket.io...), whose URLs carry NiceGUI's version so they
+can be served from the cache without asking, under a cache named after a hash of the list, which is dropped when it
+changes. Posters go in a second, size-capped cache: resized thumbnails, whose URL changes with the image, are served
+from it without asking, and images proxied from Plex are served from it while being refreshed in the background
+(stale-while-revalidate). Only successful, non-redirected image answers are kept, so a login redirect or an error page
+never stands in for a poster. Nothing else is touched: pages, the websocket, the API and downloads (Range requests and
+all) go straight to the network.
+"""
+import functools
+import hashlib
+import json
+import os
+
+import nicegui
+from fastapi import APIRouter
+from fastapi.responses import Response
+from nicegui import app
+
+from config import config
+
+STATIC_DIR = os.path.join(os.path.dirname(nicegui.__file__), "static")
+# bumped when the poster cache's contents change meaning, so browsers drop it (2: redirects and error pages were kept)
+IMAGES_VERSION = 2
+
+SCRIPT = """
+const SHELL = 'plexdlweb-shell-' + CONFIG.version;
+const IMAGES = 'plexdlweb-images-' + CONFIG.imagesVersion;
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(SHELL).then(cache => cache.addAll(CONFIG.shell)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(caches.keys()
+        .then(names => Promise.all(names
+            .filter(name => name.startsWith('plexdlweb-') && name !== SHELL && name !== IMAGES)
+            .map(name => caches.delete(name))))
+        .then(() => self.clients.claim()));
+});
+
+async function cacheFirst(request) {
+    const cache = await caches.open(SHELL);
+    const cached = await cache.match(request);
+    if (cached) {
+        return cached;
+    }
+    const response = await fetch(request);
+    if (response.ok && !response.redirected) {
+        await cache.put(request, response.clone());
+    }
+    return response;
+}
+
+function isImage(response) {
+    return response.ok && !response.redirected && (response.headers.get('content-type') || '').startsWith('image/');
+}
+
+async function trim(cache) {
+    // oldest first: a refreshed poster is put again, which moves it to the end; thumbnails leave in the order they came
+    const keys = await cache.keys();
+    await Promise.all(keys.slice(0, Math.max(0, keys.length - CONFIG.maxImages)).map(key => cache.delete(key)));
+}
+
+async function staleWhileRevalidate(event) {
+    const cache = await caches.open(IMAGES);
+    const cached = await cache.match(event.request);
+    const network = fetch(event.request).then(response => {
+        if (isImage(response)) {
+            event.waitUntil(cache.put(event.request, response.clone()).then(() => trim(cache)));
+        }
+        return response;
+    });
+    if (!cached) {
+        return network;
+    }
+    event.waitUntil(network.catch(() => undefined));
+    return cached;
+}
+
+async function imageCacheFirst(event) {
+    const cache = await caches.open(IMAGES);
+    const cached = await cache.match(event.request);
+    if (cached) {
+        return cached;
+    }
+    const response = await fetch(event.request);
+    if (isImage(response)) {
+        event.waitUntil(cache.put(event.request, response.clone()).then(() => trim(cache)));
+    }
+    return response;
+}
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (request.method !== 'GET' || url.origin !== self.location.origin || request.headers.has('range')) {
+        return;
+    }
+    if (CONFIG.immutable.some(prefix => url.pathname.startsWith(prefix))) {
+        event.respondWith(cacheFirst(request));
+    } else if (CONFIG.maxImages && url.pathname.startsWith('/thumb/')) {
+        event.respondWith(imageCacheFirst(event));
+    } else if (CONFIG.maxImages && url.pathname.startsWith('/plex/') && request.destination === 'image') {
+        event.respondWith(staleWhileRevalidate(event));
+    }
+    // anything else, downloads and the websocket included, isn't intercepted at all
+});
+"""
+
+router = APIRouter()
+
+
+def shell() -> list[str]:
+    """
+    The static files every page loads, as the index template of NiceGUI lists them
+    """
+    prod = ".prod" if app.config.prod_js else ""
+    files = ["fonts.css", f"quasar.unimportant{prod}.css", f"quasar.important{prod}.css", "nicegui.css",
+             "socket.io.min.js", f"vue.esm-browser{prod}.js", f"quasar.umd{prod}.js", "nicegui.js"]
+    if app.config.language:
+        files.append(f"lang/{app.config.language}.umd.prod.js")
+    if app.config.tailwind:
+        files.append("tailwindcss.min.js")
+    if app.config.unocss:
+        files += [f"unocss/preset-{app.config.unocss}.global.js", "unocss/core.global.js"]
+    prefix = f"/_nicegui/{nicegui.__version__}/static/"
+    return [prefix + f for f in files if os.path.isfile(os.path.join(STATIC_DIR, f))]
+
+
+@functools.cache
+def script() -> str:
+    versioned = f"/_nicegui/{nicegui.__version__}/"
+    settings = {
+        "shell": shell(),
+        # the dynamic resources are generated by the app, the rest only changes with NiceGUI
+        "immutable": [versioned + d for d in ("static/", "libraries/", "components/", "esm/", "resources/")],
+        "maxImages": config.pwa_image_cache,
+        "imagesVersion": IMAGES_VERSION,
+    }
+    settings["version"] = hashlib.sha256((json.dumps(settings) + SCRIPT).encode()).hexdigest()[:16]
+    return f"const CONFIG = {json.dumps(settings)};\n{SCRIPT}"
+
+
+@router.get("/sw.js")
+def service_worker():
+    # browsers check for a new worker on each visit; no-cache makes that a cheap revalidation
+    return Response(script(), media_type="application/javascript", headers={"Cache-Control": "no-cache"})
+
+
+@router.get("/plexdlweb.webmanifest")
+def manifest():
+    return {
+        "name": "PlexDLWeb",
+        "short_name": "Volume",
+        "start_url": "/",
+        "display": "standalone",
+        "background_color": "#282a2d",
+        "theme_color": "#000",
+        "icons": [
+            {
+                "src": "https://app.plex.tv/desktop/static/icon-ipad@2x.png",
+                "sizes": "512x512",
+                "type": "image/png"
+            }
+        ]
+    }
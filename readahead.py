@@ -0,0 +1,96 @@
+"""
+Page cache hints for files streamed from start to end, mostly for media on spinning disks.
+
+Ahead of the stream, the kernel is asked to read a window of the file in the background (POSIX_FADV_WILLNEED) so
+sends don't wait on small synchronous reads; behind it, pages already sent are dropped (POSIX_FADV_DONTNEED) so that
+a multi-GB download doesn't evict the rest of the page cache. Where the kernel ignores these hints (e.g. network or
+FUSE file systems), a prefetch thread can read the window itself.
+"""
+import logging
+import os
+import threading
+from typing import Optional
+
+logger = logging.getLogger("plexdlweb.download")
+
+HAS_FADVISE = hasattr(os, "posix_fadvise")
+PREFETCH_CHUNK = 1024 * 1024
+
+
+class Readahead:
+    """
+    Hints for reading fd from start to end; call advance() with the offset about to be sent
+    """
+    def __init__(self, fd: int, start: int, end: int, window: int, drop_behind: bool = True, prefetch: bool = False):
+        self.fd = fd
+        self.end = end
+        self.window = window
+        self.drop_behind = drop_behind
+        self._advised = start  # hints were given up to here
+        self._dropped = start  # pages before this were dropped
+        self._position = start
+        self._prefetcher: Optional[threading.Thread] = None
+        self._wakeup = threading.Condition()
+        self._closed = False
+        if not window:
+            return
+        self._fadvise(start, end - start, "POSIX_FADV_SEQUENTIAL")
+        self.advance(start)
+        if prefetch:
+            self._prefetcher = threading.Thread(target=self._prefetch, args=(start,), name="plexdlweb-prefetch",
+                                                daemon=True)
+            self._prefetcher.start()
+
+    def _fadvise(self, offset: int, length: int, advice: str):
+        if not HAS_FADVISE or length <= 0:
+            return
+        try:
+            os.posix_fadvise(self.fd, offset, length, getattr(os, advice))
+        except OSError as e:
+            logger.debug("posix_fadvise(%s) failed: %s", advice, e)
+
+    def advance(self, offset: int):
+        if not self.window:
+            return
+        self._position = offset
+        # hint again once half of the window was consumed, rather than on every chunk
+        if self._advised < self.end and offset + self.window // 2 >= self._advised:
+            until = min(self.end, offset + self.window)
+            self._fadvise(self._advised, until - self._advised, "POSIX_FADV_WILLNEED")
+            self._advised = until
+        if self.drop_behind and offset - self._dropped >= self.window:
+            self._fadvise(self._dropped, offset - self._dropped, "POSIX_FADV_DONTNEED")
+            self._dropped = offset
+        if self._prefetcher is not None:
+            with self._wakeup:
+                self._wakeup.notify()
+
+    def _prefetch(self, offset: int):
+        try:
+            while offset < self.end:
+                with self._wakeup:
+                    while not self._closed and offset >= self._position + self.window:
+                        self._wakeup.wait()
+                    if self._closed:
+                        return
+                    # the stream may have jumped ahead of us
+                    offset = max(offset, self._position)
+                data = os.pread(self.fd, min(PREFETCH_CHUNK, self.end - offset), offset)
+                if not data:
+                    return
+                offset += len(data)
+        except OSError as e:
+            # the file was closed under us
+            logger.debug("Prefetch stopped: %s", e)
+
+    def close(self):
+        """
+        Stops the prefetch thread; must be called before the file is closed
+        """
+        if self._prefetcher is not None:
+            with self._wakeup:
+                self._closed = True
+                self._wakeup.notify()
+            self._prefetcher.join()
+        if self.window and self.drop_behind:
+            self._fadvise(self._dropped, self._position - self._dropped, "POSIX_FADV_DONTNEED")
@@ -0,0 +1,108 @@
+"""
+Downloads of media that isn't readable locally, streamed from Plex's own part URLs.
+
+Plex paths are first translated to local mounts with config.path_map; parts still not found on disk (or all of
+them, with remote_downloads = "always") are relayed from Plex through the shared HTTP client, Range requests
+included, so plexdlweb can run on a host without the media.
+"""
+import logging
+import os
+from typing import Optional
+from urllib.parse import quote
+
+import anyio
+import httpx
+from fastapi import HTTPException
+from nicegui import app
+from starlette.datastructures import Headers
+from starlette.responses import Response
+
+from config import config
+from download import Transfer
+
+logger = logging.getLogger("plexdlweb.download")
+
+# client headers passed on to Plex, which answers partial and conditional requests itself
+FORWARDED = ("range", "if-range", "if-match", "if-none-match", "if-modified-since", "if-unmodified-since")
+# Plex headers relayed to the client
+RELAYED = ("content-length", "content-range", "accept-ranges", "last-modified", "etag")
+
+
+def local_path(plex_path: str) -> str:
+    """
+    Translates a path as seen by Plex to the local mount it is available at, by the longest matching prefix
+    """
+    for prefix in sorted(config.path_map, key=len, reverse=True):
+        if plex_path == prefix or plex_path.startswith(prefix.rstrip("/") + "/"):
+            return config.path_map[prefix] + plex_path[len(prefix):]
+    return plex_path
+
+
+def local_stat(plex_path: str) -> Optional[os.stat_result]:
+    """
+    Stat of the local copy of a part, or None when it must be streamed from Plex
+    """
+    if config.remote_downloads == "always":
+        return None
+    try:
+        return os.stat(local_path(plex_path))
+    except OSError:
+        if config.remote_downloads == "never":
+            raise
+        return None
+
+
+class RemotePartResponse(Response):
+    """
+    Relays an upstream response opened with stream=True, closing it once sent
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, upstream: httpx.Response, filename: str, headers: dict | None = None,
+                 transfer: Optional[Transfer] = None):
+        self.upstream = upstream
+        self.transfer = transfer
+        self.status_code = upstream.status_code
+        self.background = None
+        self.init_headers(headers)
+        for h in RELAYED:
+            if h in upstream.headers:
+                self.headers[h] = upstream.headers[h]
+        self.headers["content-type"] = upstream.headers.get("content-type", "application/octet-stream")
+        self.headers.setdefault("content-disposition", f"attachment; filename*=utf-8''{quote(filename)}")
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if scope["method"].upper() != "HEAD":
+                async for chunk in self.upstream.aiter_raw(self.chunk_size):
+                    if self.transfer is not None:
+                        await self.transfer.pace(len(chunk))
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                    if self.transfer is not None:
+                        self.transfer.record(len(chunk))
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        except Exception:
+            logger.exception("Remote download failed while streaming %s", self.upstream.url)
+            raise
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self.upstream.aclose()
+            if self.transfer is not None:
+                self.transfer.close()
+
+
+async def open_part(part_key: str, token: str, method: str, request_headers: Headers) -> httpx.Response:
+    """
+    Starts fetching a part from Plex; the caller must hand the response to a RemotePartResponse
+    """
+    client: httpx.AsyncClient = app.state.httpx_client
+    headers = {h: request_headers[h] for h in FORWARDED if h in request_headers}
+    req = client.build_request(method, (config.remote_url or config.server_url) + part_key, params={"download": 1},
+                               headers={**headers, "Accept-Encoding": "identity", "X-Plex-Token": token})
+    resp = await client.send(req, stream=True)
+    if resp.status_code not in (200, 206, 304, 412, 416):
+        await resp.aclose()
+        logger.warning("Plex returned %s for part %s", resp.status_code, part_key)
+        raise HTTPException(status_code=502 if resp.status_code >= 500 else resp.status_code)
+    return resp
@@ -0,0 +1,367 @@
+"""
+Admission control and bandwidth scheduling for downloads.
+
+A download is admitted only while the global and per-user stream limits allow it. Its bytes are then paced by token
+buckets: one per user, and a global one shared between users by weighted fair queueing, so a user with many streams
+gets the same share as a user with one (times their weight) and bandwidth nobody uses goes to whoever is downloading.
+
+The UI and the download workers serve downloads from several processes, so every transfer is recorded in a SQLite
+table they share (transfer_store_path): admission counts its rows in a write transaction, and each process flushes the
+progress of its own transfers to it every SYNC_INTERVAL, which is what the Transfers page shows. Token buckets can't
+be shared without a round trip per chunk, so each process keeps its own, with the share of each limit that matches
+its share of the streams concerned (a process serving 2 of a user's 4 streams gets half of user_bandwidth_limit).
+Rows of processes that died are dropped when the table is next written to, which assumes all of them run on the same
+host.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Optional
+
+from config import config
+from common import io_bound
+import metrics
+
+logger = logging.getLogger("plexdlweb.scheduler")
+
+# seconds suggested to a refused client
+RETRY_AFTER = 30
+# seconds between two flushes of a process's progress to the shared table, and two updates of its share of the limits
+SYNC_INTERVAL = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pid INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    ranged INTEGER NOT NULL,
+    remote INTEGER NOT NULL,
+    started REAL NOT NULL,
+    sent INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class Refused(Exception):
+    def __init__(self, reason: str, retry_after: int = RETRY_AFTER):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Allows rate bytes per second with bursts of up to burst bytes; a reservation may overdraw the bucket, and the
+    caller then waits for the debt to be paid back
+    """
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self, n: int) -> float:
+        self._refill()
+        self.tokens -= n
+        return max(0.0, -self.tokens / self.rate)
+
+    def set_rate(self, rate: float):
+        """
+        Changes the rate, and the burst with it, from now on
+        """
+        if rate == self.rate:
+            return
+        self._refill()
+        self.rate = self.burst = rate
+        self.tokens = min(self.tokens, self.burst)
+
+
+class FairShare:
+    """
+    Hands out a token bucket's bandwidth to waiting users in order of their virtual finish time (start-time fair
+    queueing), each request counting for n / weight
+    """
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        # (finish tag, sequence, start tag, bytes, waiter)
+        self._queue: list[tuple[float, int, float, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._vtime = 0.0
+        self._finish: dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def acquire(self, user: str, n: int, weight: float = 1):
+        start = max(self._vtime, self._finish.get(user, 0.0))
+        finish = self._finish[user] = start + n / weight
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (finish, next(self._seq), start, n, fut))
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+        await fut
+
+    def forget(self, user: str):
+        self._finish.pop(user, None)
+
+    async def _dispatch(self):
+        try:
+            while self._queue:
+                _, _, start, n, fut = heapq.heappop(self._queue)
+                if fut.done():
+                    # the waiting download was cancelled
+                    continue
+                self._vtime = start
+                fut.set_result(None)
+                # the next request waits until this one is paid for, which also lets the waiter just served queue its
+                # next request before the queue is looked at again
+                await asyncio.sleep(self.bucket.reserve(n))
+        finally:
+            self._task = None
+
+
+def _range_label(ranged: bool) -> str:
+    return "true" if ranged else "false"
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@dataclass(frozen=True)
+class TransferRow:
+    id: int
+    pid: int
+    user: str
+    name: str
+    size: int
+    ranged: bool
+    remote: bool
+    # wall clock time
+    started: float
+    sent: int
+
+
+class TransferTable:
+    """
+    Transfers in progress in every process
+    """
+    def __init__(self, path: str):
+        # transactions are opened explicitly, admission needing a write lock before it counts
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.executescript(SCHEMA)
+            # left by a previous process that had the same pid
+            self._db.execute("DELETE FROM transfers WHERE pid = ?", (os.getpid(),))
+
+    def _reap(self):
+        pids = [pid for pid, in self._db.execute("SELECT DISTINCT pid FROM transfers")]
+        for pid in pids:
+            if not _alive(pid):
+                logger.info("Dropping the transfers of process %s, which exited", pid)
+                self._db.execute("DELETE FROM transfers WHERE pid = ?", (pid,))
+
+    def _streams(self) -> Counter:
+        return Counter(dict(self._db.execute("SELECT user, COUNT(*) FROM transfers GROUP BY user")))
+
+    def insert(self, user: str, name: str, size: int, ranged: bool, remote: bool) -> tuple[int, Counter]:
+        """
+        Records a transfer, or raises Refused when a stream limit is reached; returns its id and the streams of each
+        user, itself included
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._reap()
+                streams = self._streams()
+                if config.max_streams and streams.total() >= config.max_streams:
+                    raise Refused("too many downloads in progress")
+                if config.max_streams_per_user and streams[user] >= config.max_streams_per_user:
+                    raise Refused(f"too many downloads in progress for {user}")
+                if remote and config.remote_max_streams:
+                    remotes, = self._db.execute("SELECT COUNT(*) FROM transfers WHERE remote").fetchone()
+                    if remotes >= config.remote_max_streams:
+                        raise Refused("too many remote downloads in progress")
+                cursor = self._db.execute(
+                    "INSERT INTO transfers (pid, user, name, size, ranged, remote, started) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (os.getpid(), user, name, size, ranged, remote, time.time()))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        streams[user] += 1
+        return cursor.lastrowid, streams
+
+    def delete(self, transfer_id: int):
+        with self._lock:
+            self._db.execute("DELETE FROM transfers WHERE id = ?", (transfer_id,))
+
+    def sync(self, sent: dict[int, int]) -> Counter:
+        """
+        Records the bytes sent by transfers of this process, returning the streams of each user
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany("UPDATE transfers SET sent = ? WHERE id = ?",
+                                     [(n, transfer_id) for transfer_id, n in sent.items()])
+                streams = self._streams()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return streams
+
+    def busy(self) -> bool:
+        """
+        Whether any process is serving a download
+        """
+        return bool(self.rows())
+
+    def rows(self) -> list[TransferRow]:
+        with self._lock:
+            rows = self._db.execute("SELECT id, pid, user, name, size, ranged, remote, started, sent FROM transfers "
+                                    "ORDER BY started").fetchall()
+        alive = {pid: _alive(pid) for pid in {row[1] for row in rows}}
+        return [TransferRow(*row) for row in rows if alive[row[1]]]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+@dataclass(eq=False)
+class Transfer:
+    scheduler: "Scheduler" = field(repr=False)
+    # row in the shared table
+    id: int
+    user: str
+    name: str
+    size: int
+    # answers a Range request
+    ranged: bool = False
+    # relayed from Plex
+    remote: bool = False
+    started: float = field(default_factory=time.monotonic)
+    sent: int = 0
+
+    @property
+    def throttled(self) -> bool:
+        return bool(config.bandwidth_limit or config.user_bandwidth_limit)
+
+    async def pace(self, n: int):
+        """
+        Waits until n more bytes may be sent
+        """
+        await self.scheduler.pace(self, n)
+
+    def record(self, n: int):
+        self.sent += n
+        metrics.download_bytes.inc(_range_label(self.ranged), amount=n)
+
+    def close(self):
+        self.scheduler.release(self)
+
+
+class Scheduler:
+    def __init__(self, table: TransferTable):
+        self.table = table
+        # transfers served by this process
+        self.transfers: list[Transfer] = []
+        self._user_buckets: dict[str, TokenBucket] = {}
+        self._fair: Optional[FairShare] = None
+        # streams of each user in every process, as of the last sync
+        self._streams: Counter = Counter()
+        self._sync_task: Optional[asyncio.Task] = None
+        self._deleting: set[asyncio.Task] = set()
+
+    def active(self, user: str = None) -> list[Transfer]:
+        return [t for t in self.transfers if user is None or t.user == user]
+
+    async def admit(self, user: str, name: str, size: int, ranged: bool = False, remote: bool = False) -> Transfer:
+        """
+        Registers a new transfer, or raises Refused when a stream limit is reached
+        """
+        transfer_id, self._streams = await io_bound(self.table.insert, user, name, size, ranged, remote)
+        transfer = Transfer(self, transfer_id, user, name, size, ranged, remote)
+        self.transfers.append(transfer)
+        self._rebalance()
+        if self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync())
+        return transfer
+
+    def release(self, transfer: Transfer):
+        if transfer not in self.transfers:
+            return
+        self.transfers.remove(transfer)
+        task = asyncio.create_task(io_bound(self.table.delete, transfer.id))
+        self._deleting.add(task)
+        task.add_done_callback(self._deleting.discard)
+        metrics.downloads.inc(_range_label(transfer.ranged))
+        if not self.active(transfer.user):
+            self._user_buckets.pop(transfer.user, None)
+            if self._fair is not None:
+                self._fair.forget(transfer.user)
+
+    async def _sync(self):
+        try:
+            while self.transfers:
+                await asyncio.sleep(SYNC_INTERVAL)
+                try:
+                    self._streams = await io_bound(self.table.sync, {t.id: t.sent for t in self.transfers})
+                except Exception:
+                    logger.exception("Syncing transfers failed")
+                    continue
+                self._rebalance()
+        finally:
+            self._sync_task = None
+
+    def _rebalance(self):
+        """
+        Gives this process the share of each bandwidth limit that matches its share of the streams
+        """
+        local = Counter(t.user for t in self.transfers)
+        if self._fair is not None and local:
+            self._fair.bucket.set_rate(config.bandwidth_limit * 1024 * local.total()
+                                       / max(self._streams.total(), local.total()))
+        for user, bucket in self._user_buckets.items():
+            if local[user]:
+                bucket.set_rate(config.user_bandwidth_limit * 1024 * local[user] / max(self._streams[user], local[user]))
+
+    async def pace(self, transfer: Transfer, n: int):
+        if config.user_bandwidth_limit:
+            bucket = self._user_buckets.get(transfer.user)
+            if bucket is None:
+                bucket = self._user_buckets[transfer.user] = TokenBucket(config.user_bandwidth_limit * 1024)
+                self._rebalance()
+            await asyncio.sleep(bucket.reserve(n))
+        if config.bandwidth_limit:
+            if self._fair is None:
+                self._fair = FairShare(TokenBucket(config.bandwidth_limit * 1024))
+                self._rebalance()
+            await self._fair.acquire(transfer.user, n, config.user_weights.get(transfer.user, 1))
+
+
+scheduler = Scheduler(TransferTable(config.transfer_store_path))
+
+metrics.Collected("plexdlweb_downloads_active", "Downloads in progress, partial (Range) or full", ("range",),
+                  lambda: [((_range_label(r),), sum(t.ranged == r for t in scheduler.transfers)) for r in (False, True)])
@@ -0,0 +1,377 @@
+"""
+Local SQLite/FTS5 mirror of the Plex library, used to answer searches without querying the server on every keystroke.
+
+Sections are synced lazily with the owner's admin_token, so the mirror holds the whole library whoever triggered the
+sync. Searches only look at the sections the searcher's server lists, and the hits are then checked against what the
+searcher's token can load, since shares can also be restricted by label or rating. A section nobody has synced yet falls
+back to the live search. Without an admin_token, the index is disabled.
+"""
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from nicegui import app
+from plexapi.exceptions import NotFound
+from plexapi.server import PlexServer
+
+import library
+import notifications
+import plex
+from config import config
+from common import io_bound, server_pool, TTLCache, SingleFlight
+from library import Item, MediaVersion
+
+logger = logging.getLogger("plexdlweb.index")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sections (
+    id INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    rating_key INTEGER PRIMARY KEY,
+    section_id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    title TEXT NOT NULL,
+    edition_title TEXT,
+    guid TEXT,
+    parent_key INTEGER,
+    parent_title TEXT,
+    grandparent_key INTEGER,
+    grandparent_title TEXT,
+    idx INTEGER,
+    year INTEGER,
+    thumb TEXT,
+    updated_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS items_section ON items (section_id, type);
+CREATE INDEX IF NOT EXISTS items_guid ON items (guid);
+CREATE INDEX IF NOT EXISTS items_parent ON items (parent_key);
+CREATE TABLE IF NOT EXISTS media (
+    rating_key INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    duration INTEGER,
+    size INTEGER,
+    file TEXT,
+    part_key TEXT,
+    PRIMARY KEY (rating_key, idx)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+    title, edition_title,
+    content='items', content_rowid='rating_key', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS items_ai AFTER INSERT ON items BEGIN
+    INSERT INTO items_fts (rowid, title, edition_title) VALUES (new.rating_key, new.title, new.edition_title);
+END;
+CREATE TRIGGER IF NOT EXISTS items_ad AFTER DELETE ON items BEGIN
+    INSERT INTO items_fts (items_fts, rowid, title, edition_title) VALUES ('delete', old.rating_key, old.title, old.edition_title);
+    DELETE FROM media WHERE rating_key = old.rating_key;
+END;
+CREATE TRIGGER IF NOT EXISTS items_au AFTER UPDATE ON items BEGIN
+    INSERT INTO items_fts (items_fts, rowid, title, edition_title) VALUES ('delete', old.rating_key, old.title, old.edition_title);
+    INSERT INTO items_fts (rowid, title, edition_title) VALUES (new.rating_key, new.title, new.edition_title);
+END;
+"""
+
+# Plex metadata type numbers to mirror for each kind of section
+SECTION_TYPES = {
+    "movie": (1, 18),
+    "show": (2, 3, 4, 18),
+}
+
+ITEM_TYPES = {1: "movie", 2: "show", 3: "season", 4: "episode", 18: "collection"}
+
+PAGE_SIZE = 500
+# how long a user's access to an item is remembered
+ACCESS_TTL = 300
+
+
+def _int(value):
+    return int(value) if value not in (None, "") else None
+
+
+class LibraryIndex:
+    def __init__(self, path: str, limit: int = 60):
+        self.limit = limit
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            # INSERT OR REPLACE must fire the delete trigger to keep the FTS table in sync
+            self._db.execute("PRAGMA recursive_triggers = ON")
+            self._db.executescript(SCHEMA)
+        self._syncing = SingleFlight()
+        self._tasks = set()
+        # sections visible to a server token: (section id, type, updatedAt)
+        self._visible = TTLCache(maxsize=256, ttl=60)
+        # whether a server token can load an item: (token hash, ratingKey) -> bool
+        self._access = TTLCache(maxsize=65536, ttl=ACCESS_TTL)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _execute(self, sql: str, params=()) -> list:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    # ---- sync
+
+    @staticmethod
+    def _section_listing(server: PlexServer) -> list[tuple[int, str, int]]:
+        return [
+            (int(d.get("key")), d.get("type"), max(_int(d.get("updatedAt")) or 0, _int(d.get("contentChangedAt")) or 0))
+            for d in server.query("/library/sections")
+            if d.get("type") in SECTION_TYPES
+        ]
+
+    @staticmethod
+    def _fetch(server: PlexServer, key: str, params: dict):
+        start = 0
+        while True:
+            page = server.query(key, params={**params, "X-Plex-Container-Start": start, "X-Plex-Container-Size": PAGE_SIZE})
+            elements = list(page)
+            yield from elements
+            start += len(elements)
+            if not elements or start >= int(page.get("totalSize", page.get("size", 0))):
+                return
+
+    @staticmethod
+    def _count(server: PlexServer, section_id: int, libtype: int) -> int:
+        page = server.query(f"/library/sections/{section_id}/all",
+                            params={"type": libtype, "X-Plex-Container-Start": 0, "X-Plex-Container-Size": 0})
+        return int(page.get("totalSize", 0))
+
+    def _store(self, section_id: int, elements) -> int:
+        items, media = [], []
+        for e in elements:
+            key = _int(e.get("ratingKey"))
+            if key is None:
+                continue
+            items.append((
+                key, section_id, e.get("type"), e.get("title") or "", e.get("editionTitle"), e.get("guid"),
+                _int(e.get("parentRatingKey")), e.get("parentTitle"),
+                _int(e.get("grandparentRatingKey")), e.get("grandparentTitle"),
+                _int(e.get("index")), _int(e.get("year")), e.get("thumb") or e.get("parentThumb"),
+                _int(e.get("updatedAt")),
+            ))
+            for i, m in enumerate(e.iter("Media")):
+                part = m.find("Part")
+                if part is None:
+                    continue
+                media.append((
+                    key, i, _int(m.get("width")), _int(m.get("height")),
+                    _int(part.get("duration") or m.get("duration")), _int(part.get("size")),
+                    part.get("file"), part.get("key"),
+                ))
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM media WHERE rating_key = ?", [(i[0],) for i in items])
+            self._db.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", items)
+            self._db.executemany("INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?, ?)", media)
+        return len(items)
+
+    def _sync_section(self, server: PlexServer, section_id: int, section_type: str, updated_at: int):
+        row = self._execute("SELECT updated_at FROM sections WHERE id = ?", (section_id,))
+        since = row[0][0] if row else 0
+        started = time.monotonic()
+        if not since:
+            with self._lock, self._db:
+                self._db.execute("DELETE FROM items WHERE section_id = ?", (section_id,))
+        stored = 0
+        for libtype in SECTION_TYPES[section_type]:
+            params = {"type": libtype}
+            if since:
+                params["updatedAt>>"] = since
+            stored += self._store(section_id, self._fetch(server, f"/library/sections/{section_id}/all", params))
+            # incremental fetches don't report deletions: fall back to a full pass when the counts disagree
+            plex_type = ITEM_TYPES[libtype]
+            count = self._execute("SELECT COUNT(*) FROM items WHERE section_id = ? AND type = ?", (section_id, plex_type))[0][0]
+            if since and count != self._count(server, section_id, libtype):
+                with self._lock, self._db:
+                    self._db.execute("DELETE FROM items WHERE section_id = ? AND type = ?", (section_id, plex_type))
+                stored += self._store(section_id, self._fetch(server, f"/library/sections/{section_id}/all", {"type": libtype}))
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO sections VALUES (?, ?, ?)", (section_id, section_type, updated_at))
+        logger.info("Synced section %s (%s items) in %.1fs", section_id, stored, time.monotonic() - started)
+
+    async def sync_section(self, server: PlexServer, section_id: int, section_type: str, updated_at: int):
+        try:
+            await self._syncing.run(section_id, io_bound, self._sync_section, server, section_id, section_type, updated_at)
+        except Exception:
+            logger.exception("Failed to sync section %s", section_id)
+
+    def _in_background(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _refresh_item(self, server: PlexServer, rating_key: int):
+        try:
+            container = server.query(f"/library/metadata/{rating_key}")
+        except NotFound:
+            container = []
+        elements = [e for e in container if e.get("type") in ITEM_TYPES.values()]
+        if not elements:
+            with self._lock, self._db:
+                self._db.execute("DELETE FROM items WHERE rating_key = ?", (rating_key,))
+            return
+        section_id = _int(elements[0].get("librarySectionID") or container.get("librarySectionID"))
+        mirrored = self._execute("SELECT 1 FROM sections WHERE id = ?", (section_id,))
+        if section_id is not None and mirrored:
+            self._store(section_id, elements)
+
+    async def refresh_item(self, rating_key: int):
+        try:
+            admin = await plex.server_for_token(config.admin_token)
+            await self._syncing.run(("item", rating_key), io_bound, self._refresh_item, admin, rating_key)
+        except Exception:
+            logger.exception("Failed to refresh item %s", rating_key)
+
+    def invalidate_section(self, section_id: int):
+        """
+        Makes the next search re-read the section listing, so a changed updatedAt triggers an incremental sync
+        """
+        self._visible.clear()
+
+    def invalidate_item(self, rating_key: int, section_id: int | None = None):
+        """
+        Re-reads a changed item from Plex in the background, dropping it if it is gone, so it stays searchable meanwhile
+        """
+        self._in_background(self.refresh_item(rating_key))
+
+    # ---- search
+
+    @staticmethod
+    def _token_key(server: PlexServer) -> str:
+        return hashlib.sha256(server._token.encode()).hexdigest()
+
+    async def _visible_sections(self, server: PlexServer) -> list[tuple[int, str, int]]:
+        key = self._token_key(server)
+        if (sections := self._visible.get(key)) is None:
+            sections = await server_pool.run(self._section_listing, server)
+            self._visible.set(key, sections)
+        return sections
+
+    def _search(self, query: str, sections: list[int]) -> list[int]:
+        terms = re.findall(r"\w+", query)
+        if not terms:
+            return []
+        match = "{title edition_title} : " + " ".join(f'"{t}"*' for t in terms)
+        in_sections = ",".join("?" * len(sections))
+        hits = self._execute(
+            f"SELECT i.rating_key, i.type, i.guid, i.section_id FROM items_fts JOIN items i ON i.rating_key = items_fts.rowid "
+            f"WHERE items_fts MATCH ? AND i.section_id IN ({in_sections}) ORDER BY bm25(items_fts) LIMIT ?",
+            (match, *sections, self.limit))
+        keys = []
+        for rating_key, kind, guid, section_id in hits:
+            if rating_key in keys:
+                continue
+            keys.append(rating_key)
+            if kind == "movie" and guid:
+                # group the other editions of the movie right after it
+                keys.extend(k for (k,) in self._execute(
+                    "SELECT rating_key FROM items WHERE guid = ? AND section_id = ? AND rating_key != ? ORDER BY rating_key",
+                    (guid, section_id, rating_key)) if k not in keys)
+        return keys
+
+    @staticmethod
+    def _loadable(server: PlexServer, keys: list[int]) -> set[int]:
+        container = server.query(f"/library/metadata/{','.join(map(str, keys))}", params={"includeFields": "ratingKey"})
+        return {k for e in container if (k := _int(e.get("ratingKey"))) is not None}
+
+    async def _accessible(self, server: PlexServer, keys: list[int]) -> list[int]:
+        """
+        The keys the server's token can load, asking Plex in one request about the ones not checked recently
+        """
+        if not keys or server._token == config.admin_token:
+            return keys
+        token = self._token_key(server)
+        unknown = [k for k in keys if self._access.get((token, k)) is None]
+        if unknown:
+            loadable = await server_pool.run(self._loadable, server, unknown)
+            for k in unknown:
+                self._access.set((token, k), k in loadable)
+        return [k for k in keys if self._access.get((token, k), False)]
+
+    async def search_keys(self, server: PlexServer, query: str) -> list[int] | None:
+        """
+        Returns the ratingKeys matching the query that the server's token can load, or None if a section visible to
+        the server is not mirrored yet
+        """
+        sections = await self._visible_sections(server)
+        synced = dict(await io_bound(self._execute, "SELECT id, updated_at FROM sections"))
+        stale = [s for s in sections if synced.get(s[0], -1) < s[2]]
+        if stale:
+            admin = await plex.server_for_token(config.admin_token)
+            for section_id, section_type, updated_at in stale:
+                self._in_background(self.sync_section(admin, section_id, section_type, updated_at))
+        if any(s[0] not in synced for s in sections):
+            return None
+        return await self._accessible(server, await io_bound(self._search, query, [s[0] for s in sections]))
+
+    def _items(self, keys: list[int]) -> list[Item]:
+        if not keys:
+            return []
+        in_keys = ",".join("?" * len(keys))
+        media = {}
+        for rating_key, *version in self._execute(
+                f"SELECT rating_key, width, height, duration, size, file, part_key FROM media "
+                f"WHERE rating_key IN ({in_keys}) ORDER BY rating_key, idx", keys):
+            media.setdefault(rating_key, []).append(MediaVersion(*version))
+        items = {}
+        for (rating_key, section_id, kind, title, edition_title, guid, parent_key, parent_title, grandparent_key,
+             grandparent_title, index, _year, thumb, updated_at) in self._execute(
+                f"SELECT * FROM items WHERE rating_key IN ({in_keys})", keys):
+            items[rating_key] = Item(
+                rating_key=rating_key, type=kind, title=title, edition_title=edition_title, guid=guid,
+                section_id=section_id, parent_key=parent_key, parent_title=parent_title,
+                grandparent_key=grandparent_key, grandparent_title=grandparent_title, index=index, thumb=thumb,
+                updated_at=updated_at, media=tuple(media.get(rating_key, ())))
+        return [items[k] for k in keys if k in items]
+
+    async def search(self, server: PlexServer, query: str) -> list[Item] | None:
+        """
+        Returns the items matching the query with their editions grouped, or None when the live search should be used
+        """
+        keys = await self.search_keys(server, query)
+        if keys is None:
+            return None
+        return await io_bound(self._items, keys)
+
+
+if config.search_index and not config.admin_token:
+    logger.warning("The search index needs admin_token to mirror the whole library, using the live search")
+index = LibraryIndex(config.search_index_path, config.search_index_limit) \
+    if config.search_index and config.admin_token else None
+if index:
+    notifications.on_item_changed(index.invalidate_item)
+    notifications.on_section_changed(index.invalidate_section)
+
+
+async def search(server: PlexServer, query: str) -> list[Item]:
+    """
+    Items matching a query, other editions of movies included, from the index when it can answer
+    """
+    results = await index.search(server, query) if index else None
+    if results is None:
+        results = await server_pool.run(library.search, server, query)
+        async def all_editions(x):
+            if x.type == "movie":
+                return [x, *(await server_pool.run(library.editions, server, x))]
+            return [x]
+        results = list(dict.fromkeys(item for editions in (await asyncio.gather(*[all_editions(res) for res in results])) for item in editions))
+    return results
+
+
+def shutdown():
+    if index:
+        index.close()
+
+
+app.on_shutdown(shutdown)
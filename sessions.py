@@ -0,0 +1,109 @@
+"""
+Logins shared by every process serving the app.
+
+NiceGUI keeps app.storage.user in the UI process, which download workers can't read. So when a logged-in browser
+loads a page, the UI also records its Plex tokens in a SQLite store under a random id, sent back in an HttpOnly
+cookie; workers look that id up (the store only keeps a hash of it) and check the tokens as the UI does.
+
+Lookups are remembered for auth_cache_ttl seconds, as token checks are, so that the UI's middleware and the workers
+don't query the store on every request; a session ended in one process may still be accepted by the others for that
+long.
+"""
+import hashlib
+import secrets
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from common import io_bound, TTLCache
+from config import config
+
+COOKIE = "plexdlweb_session"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    user_token TEXT NOT NULL,
+    server_token TEXT NOT NULL,
+    expires INTEGER NOT NULL
+);
+"""
+
+
+@dataclass(frozen=True)
+class Login:
+    user_token: str
+    server_token: str
+
+
+def _hash(session_id: str) -> str:
+    return hashlib.sha256(session_id.encode()).hexdigest()
+
+
+class SessionStore:
+    def __init__(self, path: str, ttl: int):
+        self.ttl = ttl
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            # workers read while the UI writes
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.executescript(SCHEMA)
+
+    def create(self, login: Login) -> str:
+        """
+        Records a login, returning the id to send to the browser
+        """
+        session_id = secrets.token_urlsafe(32)
+        now = int(time.time())
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM sessions WHERE expires < ?", (now,))
+            self._db.execute("INSERT INTO sessions VALUES (?, ?, ?, ?)",
+                             (_hash(session_id), login.user_token, login.server_token, now + self.ttl))
+        return session_id
+
+    def get(self, session_id: str) -> Optional[Login]:
+        with self._lock:
+            row = self._db.execute("SELECT user_token, server_token FROM sessions WHERE id = ? AND expires >= ?",
+                                   (_hash(session_id), int(time.time()))).fetchone()
+        return Login(*row) if row else None
+
+    def forget(self, login: Login):
+        """
+        Ends every session of a login, e.g. when its owner logs out
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM sessions WHERE user_token = ? AND server_token = ?",
+                             (login.user_token, login.server_token))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+store = SessionStore(config.session_store_path, config.session_ttl)
+# hashed session id -> Login, or None for unknown ids
+_logins = TTLCache(maxsize=4096, ttl=config.auth_cache_ttl)
+_UNKNOWN = object()
+
+
+async def lookup(session_id: str) -> Optional[Login]:
+    """
+    The login of a session, from the store or remembered from a recent lookup
+    """
+    key = _hash(session_id)
+    if (login := _logins.get(key, _UNKNOWN)) is not _UNKNOWN:
+        return login
+    login = await io_bound(store.get, session_id)
+    _logins.set(key, login, None if login else config.auth_cache_negative_ttl)
+    return login
+
+
+async def forget(login: Login):
+    """
+    Ends every session of a login
+    """
+    await io_bound(store.forget, login)
+    _logins.clear()
@@ -0,0 +1,166 @@
+"""
+Short-lived download grants that can be checked without the session cookie or a call to Plex.
+
+A grant names one or several media parts (their paths as seen by Plex, sizes and modification times, and their keys
+for remote downloads), recorded in a SQLite table shared by every process. URLs only carry the grant's random id and
+expiry, signed with a key derived from the app secret: whoever holds one may fetch those files until it expires, e.g.
+a download manager running outside the browser, but learns nothing about where they are stored. Grants are revoked
+when the user who asked for them logs out.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from config import config
+
+_key = hashlib.sha256(b"plexdlweb signed downloads\0" + config.secret.encode()).digest()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS grant_files (
+    grant_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER,
+    part_key TEXT,
+    user TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    expires INTEGER NOT NULL,
+    PRIMARY KEY (grant_id, name)
+);
+CREATE INDEX IF NOT EXISTS grant_files_owner ON grant_files (owner);
+"""
+
+
+@dataclass(frozen=True)
+class Grant:
+    path: str
+    size: int
+    expires: int
+    user: str
+    part_key: Optional[str] = None
+    # None when the part wasn't readable locally as the grant was issued
+    mtime_ns: Optional[int] = None
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _signature(payload: str) -> str:
+    return _b64encode(hmac.digest(_key, payload.encode(), "sha256"))
+
+
+def _expiry(ttl: int = None) -> int:
+    return int(time.time()) + (ttl or config.signed_url_ttl)
+
+
+def _encode(claims: dict, expires: int) -> str:
+    claims = {**claims, "e": expires}
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return f"{payload}.{_signature(payload)}"
+
+
+def _decode(token: str) -> Optional[dict]:
+    payload, _, signature = token.partition(".")
+    # as bytes, since compare_digest refuses str with non-ASCII characters
+    if not hmac.compare_digest(signature.encode(), _signature(payload).encode()):
+        return None
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict) or claims.get("e", 0) < time.time():
+        return None
+    return claims
+
+
+class GrantStore:
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.executescript(SCHEMA)
+
+    def add(self, files: dict[str, tuple[str, int, Optional[int], Optional[str]]], user: str, owner: str,
+            expires: int) -> str:
+        grant_id = secrets.token_urlsafe(16)
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM grant_files WHERE expires < ?", (int(time.time()),))
+            self._db.executemany("INSERT INTO grant_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 [(grant_id, name, path, size, mtime_ns, part_key, user, owner, expires)
+                                  for name, (path, size, mtime_ns, part_key) in files.items()])
+        return grant_id
+
+    def get(self, grant_id: str, name: str) -> Optional[tuple]:
+        with self._lock:
+            return self._db.execute(
+                "SELECT path, size, mtime_ns, part_key, user, expires FROM grant_files WHERE grant_id = ? AND name = ?",
+                (grant_id, name)).fetchone()
+
+    def revoke(self, owner: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM grant_files WHERE owner = ?", (owner,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+grants = GrantStore(config.grant_store_path)
+
+
+def _owner(server_token: str) -> str:
+    return hashlib.sha256(server_token.encode()).hexdigest()
+
+
+def sign_files(files: dict[str, tuple[str, int, Optional[int], Optional[str]]], user: str, server_token: str,
+               ttl: int = None) -> str:
+    """
+    Returns a token granting access to several parts, by name: name -> (path, size, mtime_ns, part key), as long as
+    they keep that size and modification time; blocking
+    """
+    expires = _expiry(ttl)
+    return _encode({"g": grants.add(files, user, _owner(server_token), expires)}, expires)
+
+
+def sign(path: str, size: int, user: str, server_token: str, part_key: str = None, mtime_ns: int = None,
+         ttl: int = None) -> str:
+    """
+    Returns a token granting access to the part at path; blocking
+    """
+    return sign_files({"": (path, size, mtime_ns, part_key)}, user, server_token, ttl)
+
+
+def verify(token: str, name: str = "") -> Optional[Grant]:
+    """
+    The grant for a file of a token's parts, by name for those of sign_files; blocking
+    """
+    if (claims := _decode(token)) is None:
+        return None
+    try:
+        if (row := grants.get(claims["g"], name)) is None:
+            return None
+    except (KeyError, TypeError, sqlite3.Error):
+        return None
+    path, size, mtime_ns, part_key, user, expires = row
+    return Grant(path=path, size=size, expires=expires, user=user, part_key=part_key, mtime_ns=mtime_ns)
+
+
+def revoke(server_token: str):
+    """
+    Revokes the grants issued to a login, when it logs out; blocking
+    """
+    grants.revoke(_owner(server_token))
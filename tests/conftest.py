@@ -0,0 +1,55 @@
+"""
+The modules read config.json from the working directory and create their databases there when imported: the tests
+are collected from a temporary directory, with the defaults the Docker image uses.
+"""
+import os
+import sys
+import tempfile
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_sessionstart(session):
+    os.environ["IS_DOCKER"] = "1"
+    os.chdir(tempfile.mkdtemp(prefix="plexdlweb-tests-"))
+
+
+class FakePlexServer:
+    """
+    Plex stand-in answering in process: routes map a path to (status, headers, body), and the requests it received
+    are kept as (path, headers)
+    """
+    def __init__(self):
+        self.routes: dict[str, tuple[int, dict, bytes]] = {}
+        self.requests: list[tuple[str, dict]] = []
+
+    async def __call__(self, scope, receive, send):
+        headers = {k.decode(): v.decode() for k, v in scope["headers"]}
+        self.requests.append((scope["path"], headers))
+        status, extra, body = self.routes.get(scope["path"], (404, {}, b"not found"))
+        raw = [(b"content-length", str(len(body)).encode())] + [(k.encode(), v.encode()) for k, v in extra.items()]
+        await send({"type": "http.response.start", "status": status, "headers": raw})
+        await send({"type": "http.response.body", "body": body})
+
+
+@pytest.fixture
+def plex_server(monkeypatch):
+    """
+    A FakePlexServer behind the proxy's HTTP client, with the proxy caches emptied
+    """
+    from nicegui import app
+    from config import config
+    import plex
+
+    server = FakePlexServer()
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server))
+    monkeypatch.setattr(app.state, "httpx_client", client, raising=False)
+    monkeypatch.setattr(config, "server_url", "http://plex.test")
+    plex._responses.clear()
+    plex._oversized.clear()
+    yield server
+    plex._responses.clear()
+    plex._oversized.clear()
@@ -0,0 +1,24 @@
+import pytest
+from fastapi import HTTPException
+
+import api
+
+
+def test_search_cursor_round_trip():
+    keys = list(range(1000, 1500))
+    cursor = api._search_cursor(keys)
+    assert api._search_keys(cursor) == keys
+    assert api._search_cursor([]) is None
+
+
+@pytest.mark.parametrize("cursor", ["zzz", "", api._search_cursor([1])[:-3], "eJwrSS0uAQAEXQHB"])
+def test_invalid_search_cursor(cursor):
+    with pytest.raises(HTTPException) as e:
+        api._search_keys(cursor)
+    assert e.value.status_code == 400
+
+
+def test_oversized_search_cursor(monkeypatch):
+    monkeypatch.setattr(api, "MAX_SEARCH_CURSOR", 100)
+    with pytest.raises(HTTPException):
+        api._search_keys(api._search_cursor(list(range(1000))))
@@ -0,0 +1,236 @@
+import asyncio
+import threading
+
+import pytest
+
+import common
+from common import LatestOnly, SingleFlight, Superseded, TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(common.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_ttl_cache_expires_entries(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=5)
+    clock[0] += 10
+    assert cache.get("a") == 1
+    assert cache.get("b") is None and "b" not in cache
+    clock[0] += 50
+    assert cache.get("a", "gone") == "gone"
+    assert len(cache) == 0
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "a" in cache and "c" in cache and "b" not in cache
+    assert cache.pop("a") == 1 and cache.pop("a") is None
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    calls = []
+
+    async def work(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value * 2
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.run("k", work, 21) for _ in range(5)), flight.run("other", work, 1))
+        assert results == [42] * 5 + [2]
+        # finished computations aren't remembered
+        assert await flight.run("k", work, 5) == 10
+
+    asyncio.run(run())
+    assert calls == [21, 1, 5]
+
+
+def test_single_flight_shares_exceptions():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(flight.run("k", fail), flight.run("k", fail), return_exceptions=True)
+        assert [type(r) for r in results] == [ValueError, ValueError]
+
+    asyncio.run(run())
+
+
+def test_single_flight_follower_takes_over_from_a_cancelled_leader():
+    async def work():
+        await asyncio.sleep(0.01)
+        return "done"
+
+    async def run():
+        flight = SingleFlight()
+        leader = asyncio.create_task(flight.run("k", work))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.run("k", work))
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await follower == "done"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+
+    asyncio.run(run())
+
+
+def test_single_flight_forget_starts_a_fresh_computation():
+    started = []
+
+    async def work(n):
+        started.append(n)
+        await asyncio.sleep(0.01)
+        return n
+
+    async def run():
+        flight = SingleFlight()
+        first = asyncio.create_task(flight.run("k", work, 1))
+        await asyncio.sleep(0)
+        flight.forget("k")
+        assert await flight.run("k", work, 2) == 2
+        assert await first == 1
+
+    asyncio.run(run())
+    assert started == [1, 2]
+
+
+def test_latest_only_supersedes_the_previous_call():
+    async def run():
+        latest = LatestOnly()
+        first = asyncio.create_task(latest.run(asyncio.sleep(1, "first")))
+        await asyncio.sleep(0)
+        assert await latest.run(asyncio.sleep(0, "second")) == "second"
+        with pytest.raises(Superseded):
+            await first
+
+    asyncio.run(run())
+
+
+def test_latest_only_drops_a_search_answered_after_a_newer_one():
+    shown = []
+
+    async def search(query, delay):
+        await asyncio.sleep(delay)
+        return query
+
+    async def show(latest, query, delay):
+        try:
+            shown.append(await latest.run(search(query, delay)))
+        except Superseded:
+            pass
+
+    async def run():
+        latest = LatestOnly()
+        # the slow search for "bac" would come back after the one for "back"
+        first = asyncio.create_task(show(latest, "bac", 0.05))
+        await asyncio.sleep(0)
+        await show(latest, "back", 0.01)
+        await first
+        await asyncio.sleep(0.06)
+
+    asyncio.run(run())
+    assert shown == ["back"]
+
+
+def test_latest_only_cancelling_the_caller_is_not_superseding():
+    async def run():
+        latest = LatestOnly()
+        caller = asyncio.create_task(latest.run(asyncio.sleep(1)))
+        await asyncio.sleep(0)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        # the slot is free again, and failures reach the caller
+        with pytest.raises(ZeroDivisionError):
+            await latest.run(asyncio.to_thread(lambda: 1 / 0))
+        assert latest._task is None
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def pool():
+    pool = common.Pool("test", workers=1, max_queue=1, timeout=0.2)
+    yield pool
+    pool.shutdown()
+
+
+def test_pool_sheds_calls_beyond_its_queue(pool):
+    release = threading.Event()
+
+    async def run():
+        busy = asyncio.create_task(pool.run(release.wait))
+        await asyncio.sleep(0.05)
+        waiting = asyncio.create_task(pool.run(lambda: "queued"))
+        await asyncio.sleep(0)
+        with pytest.raises(common.Overloaded):
+            await pool.run(lambda: "shed")
+        release.set()
+        assert await busy and await waiting == "queued"
+
+    asyncio.run(run())
+    assert (pool.calls, pool.shed, pool.queued, pool.running) == (2, 1, 0, 0)
+    assert pool.wait_time > 0 and pool.run_time > 0
+
+
+def test_pool_gives_up_waiting_after_its_timeout(pool):
+    release = threading.Event()
+
+    async def run():
+        with pytest.raises(TimeoutError):
+            await pool.run(release.wait)
+        release.set()
+
+    asyncio.run(run())
+    assert pool.timeouts == 1
+
+
+def test_cancelled_call_leaves_the_queue(pool):
+    release = threading.Event()
+
+    async def run():
+        busy = asyncio.create_task(pool.run(release.wait))
+        await asyncio.sleep(0.05)
+        waiting = asyncio.create_task(pool.run(lambda: "never"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert pool.queued == 0
+        release.set()
+        await busy
+
+    asyncio.run(run())
+
+
+def test_a_slow_pool_does_not_hold_up_the_others(pool):
+    release = threading.Event()
+
+    async def run():
+        busy = asyncio.create_task(pool.run(release.wait))
+        await asyncio.sleep(0.05)
+        assert await asyncio.wait_for(common.fs_pool.run(lambda: "fast"), 1) == "fast"
+        release.set()
+        await busy
+
+    asyncio.run(run())
+
+
+def test_pools_are_configured_by_name(monkeypatch):
+    monkeypatch.setattr(common.config, "pools", {"plextv": {"workers": 2, "timeout": 5}})
+    configured = common._pool("plextv", 8, 64, 30)
+    assert (configured.workers, configured.max_queue, configured.timeout) == (2, 64, 5)
+    configured.shutdown()
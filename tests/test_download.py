@@ -0,0 +1,104 @@
+import asyncio
+import os
+
+import pytest
+
+from download import DownloadFileResponse
+
+PATHSEND = "http.response.pathsend"
+
+
+class FakeTransfer:
+    def __init__(self, throttled: bool = False):
+        self.throttled = throttled
+        self.paced = self.recorded = 0
+        self.closed = False
+
+    async def pace(self, n: int):
+        self.paced += n
+
+    def record(self, n: int):
+        self.recorded += n
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def media(tmp_path):
+    path = tmp_path / "movie.mkv"
+    path.write_bytes(os.urandom(3 * 1024 * 1024 + 123))
+    return path
+
+
+def _get(response: DownloadFileResponse, headers: dict = None, pathsend: bool = False) -> list[dict]:
+    scope = {"type": "http", "method": "GET", "path": "/", "extensions": {PATHSEND: {}} if pathsend else {},
+             "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]}
+    messages = []
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(response(scope, receive, send))
+    return messages
+
+
+def _body(messages: list[dict]) -> bytes:
+    return b"".join(m.get("body", b"") for m in messages if m["type"] == "http.response.body")
+
+
+def test_full_download_is_paced_in_chunks(media):
+    transfer = FakeTransfer()
+    messages = _get(DownloadFileResponse(media, transfer=transfer))
+    assert messages[0]["status"] == 200
+    assert _body(messages) == media.read_bytes()
+    assert len(messages) == 1 + 4
+    assert transfer.paced == transfer.recorded == media.stat().st_size
+    assert transfer.closed
+
+
+def test_full_download_is_handed_to_the_server_when_unthrottled(media):
+    transfer = FakeTransfer()
+    messages = _get(DownloadFileResponse(media, transfer=transfer), pathsend=True)
+    assert [m["type"] for m in messages] == ["http.response.start", PATHSEND]
+    assert messages[1]["path"] == str(media)
+    assert transfer.recorded == media.stat().st_size
+
+
+@pytest.mark.parametrize("options", [{"transfer": FakeTransfer(throttled=True)}, {"readahead": 1024 * 1024}])
+def test_pathsend_is_skipped_when_paced_or_hinted(media, options):
+    messages = _get(DownloadFileResponse(media, **options), pathsend=True)
+    assert PATHSEND not in [m["type"] for m in messages]
+    assert _body(messages) == media.read_bytes()
+
+
+def test_range_is_sent_in_chunks_even_with_pathsend(media):
+    messages = _get(DownloadFileResponse(media), {"Range": "bytes=100-199"}, pathsend=True)
+    assert messages[0]["status"] == 206
+    assert _body(messages) == media.read_bytes()[100:200]
+
+
+def test_multiple_ranges_are_answered_with_paced_multipart(media):
+    transfer = FakeTransfer()
+    messages = _get(DownloadFileResponse(media, transfer=transfer), {"Range": "bytes=0-9,2000000-2000009"})
+    headers = dict(messages[0]["headers"])
+    assert messages[0]["status"] == 206
+    assert headers[b"content-type"].startswith(b"multipart/byteranges; boundary=")
+    body = _body(messages)
+    data = media.read_bytes()
+    assert len(body) == int(headers[b"content-length"])
+    assert data[:10] in body and data[2000000:2000010] in body
+    assert transfer.paced == transfer.recorded == len(body)
+
+
+def test_open_file_is_read_instead_of_path_and_closed(media, tmp_path):
+    copy = tmp_path / "copy.mkv"
+    copy.write_bytes(media.read_bytes())
+    file = open(copy, "rb")
+    copy.unlink()
+    messages = _get(DownloadFileResponse(media, file=file), {"Range": "bytes=10-19"}, pathsend=True)
+    assert _body(messages) == media.read_bytes()[10:20]
+    assert file.closed
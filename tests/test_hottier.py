@@ -0,0 +1,119 @@
+import asyncio
+import os
+
+import pytest
+
+from hottier import HotTier, Replica
+
+
+@pytest.fixture
+def sources(tmp_path):
+    directory = tmp_path / "media"
+    directory.mkdir()
+    paths = {}
+    for name in "abcd":
+        path = directory / f"{name}.mkv"
+        path.write_bytes(name.encode() * 10)
+        paths[name] = str(path)
+    return paths
+
+
+def _tier(tmp_path, max_bytes: int = 30) -> HotTier:
+    return HotTier(str(tmp_path / "tier"), max_bytes, threshold=1, window=60)
+
+
+async def _serve(tier: HotTier, source: str, user: str = "alice"):
+    """
+    Serves a download of source, returning what the copy read or None, and waits for the copy it may start
+    """
+    file = await tier.serve(source, os.stat(source), user)
+    await asyncio.gather(*tier._tasks)
+    if file is None:
+        return None
+    with file:
+        return file.read()
+
+
+def _copied(tier: HotTier, sources: dict) -> set[str]:
+    return {name for name, path in sources.items() if tier.key(path) in tier._entries}
+
+
+def test_popular_source_is_copied_then_served_from_the_copy(tmp_path, sources):
+    async def run():
+        tier = _tier(tmp_path)
+        assert await _serve(tier, sources["a"]) is None
+        assert os.path.isfile(tier.path(tier.key(sources["a"])))
+        assert await _serve(tier, sources["a"]) == b"a" * 10
+        assert tier._entries[tier.key(sources["a"])].hits == 1
+
+    asyncio.run(run())
+
+
+def test_least_frequently_then_least_recently_used_copy_is_evicted(tmp_path, sources):
+    async def run():
+        tier = _tier(tmp_path)
+        for name in "abc":
+            await _serve(tier, sources[name])
+        for name in "aabc":
+            await _serve(tier, sources[name])
+        assert _copied(tier, sources) == {"a", "b", "c"}
+        # b and c were used once each, b before c
+        await _serve(tier, sources["d"])
+        assert _copied(tier, sources) == {"a", "c", "d"}
+        assert not os.path.exists(tier.path(tier.key(sources["b"])))
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("change", ["size", "mtime"])
+def test_changed_source_drops_its_copy(tmp_path, sources, change):
+    async def run():
+        tier = _tier(tmp_path)
+        await _serve(tier, sources["a"])
+        if change == "size":
+            with open(sources["a"], "ab") as f:
+                f.write(b"more")
+        else:
+            st = os.stat(sources["a"])
+            os.utime(sources["a"], ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+        assert await tier.serve(sources["a"], os.stat(sources["a"]), "alice") is None
+        # the stale copy is gone, and this download counted towards copying the new version
+        await asyncio.gather(*tier._tasks)
+        assert await _serve(tier, sources["a"]) == open(sources["a"], "rb").read()
+
+    asyncio.run(run())
+
+
+def test_eviction_does_not_cut_a_download_in_progress(tmp_path, sources):
+    async def run():
+        tier = _tier(tmp_path)
+        await _serve(tier, sources["a"])
+        file = await tier.serve(sources["a"], os.stat(sources["a"]), "alice")
+        assert await tier._make_room(tier.max_bytes)
+        assert not tier._entries and not os.path.exists(tier.path(tier.key(sources["a"])))
+        with file:
+            assert file.read() == b"a" * 10
+
+    asyncio.run(run())
+
+
+def test_replica_serves_the_copies_of_the_index(tmp_path, sources):
+    async def run():
+        tier = _tier(tmp_path)
+        await _serve(tier, sources["a"])
+        replica = Replica(tier.directory)
+        file = await replica.serve(sources["a"], os.stat(sources["a"]), "bob")
+        with file:
+            assert file.read() == b"a" * 10
+        assert await replica.serve(sources["b"], os.stat(sources["b"]), "bob") is None
+        # the UI process counts the replica's downloads
+        rows = tier.downloads.take()
+        assert [(row[0], row[3]) for row in rows] == [(sources["a"], "bob"), (sources["b"], "bob")]
+        await tier._count(rows)
+        await asyncio.gather(*tier._tasks)
+        assert _copied(tier, sources) == {"a", "b"}
+        assert tier._entries[tier.key(sources["a"])].hits == 1
+        await replica.close()
+        await tier.close()
+
+    asyncio.run(run())
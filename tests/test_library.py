@@ -0,0 +1,96 @@
+from xml.etree import ElementTree
+
+import pytest
+from plexapi.exceptions import NotFound
+
+import library
+
+
+def _episode(key: int, media: bool = True) -> str:
+    part = f'<Media width="1920" height="1080"><Part key="/library/parts/{key}/1/file.mkv" ' \
+           f'file="/media/S01E{key:02}.mkv" size="{key * 1000}" duration="{key * 60000}"/></Media>' if media else ""
+    return f'<Video ratingKey="{key}" type="episode" title="Episode {key}" index="{key}" parentRatingKey="200" ' \
+           f'parentTitle="Season 1" grandparentRatingKey="100" grandparentTitle="Show" ' \
+           f'grandparentThumb="/library/metadata/100/thumb/1" updatedAt="{key}">{part}</Video>'
+
+
+class FakeServer:
+    """
+    Answers queries from a path -> XML mapping, recording them; children lists are paged like Plex pages them
+    """
+    def __init__(self, answers: dict[str, str], total_size: bool = True):
+        self.answers = answers
+        self.total_size = total_size
+        self.queries = []
+
+    def query(self, path: str, params: dict = None):
+        self.queries.append(path)
+        if path.endswith("/children") and params:
+            container = ElementTree.fromstring(self.answers[path])
+            children = list(container)
+            start, size = params["X-Plex-Container-Start"], params["X-Plex-Container-Size"]
+            for child in children[:start] + children[start + size:]:
+                container.remove(child)
+            if self.total_size:
+                container.set("totalSize", str(len(children)))
+            return container
+        if path.startswith("/library/metadata/") and "/" not in path[len("/library/metadata/"):]:
+            # batched item loads answer with the existing items, or 404 if there are none
+            keys = path.rsplit("/", 1)[1].split(",")
+            found = [self.answers[f"/library/metadata/{k}"] for k in keys if f"/library/metadata/{k}" in self.answers]
+            if not found:
+                raise NotFound("404")
+            return ElementTree.fromstring(f'<MediaContainer librarySectionID="2">{"".join(found)}</MediaContainer>')
+        return ElementTree.fromstring(self.answers[path])
+
+
+@pytest.fixture
+def season():
+    answers = {f"/library/metadata/{k}": _episode(k) for k in range(1, 101)}
+    # children are listed without their media, as Plex does for large containers
+    episodes = "".join(_episode(k, media=False) for k in range(1, 101))
+    answers["/library/metadata/200/children"] = f'<MediaContainer librarySectionID="2">{episodes}</MediaContainer>'
+    return FakeServer(answers)
+
+
+def test_children_load_their_media_in_one_batch(season):
+    item = library.Item(rating_key=200, type="season", title="Season 1")
+    episodes = library.children(season, item)
+    assert len(season.queries) == 2
+    assert [e.rating_key for e in episodes] == list(range(1, 101))
+    assert all(e.media for e in episodes)
+
+
+def test_view_model_holds_what_the_renderer_reads(season):
+    [episode] = library.fetch_items(season, [7])
+    assert (episode.title, episode.index, episode.section_id) == ("Episode 7", 7, 2)
+    assert (episode.grandparent_key, episode.grandparent_title, episode.parent_title) == (100, "Show", "Season 1")
+    # episodes without a thumbnail of their own show their show's
+    assert episode.thumb == "/library/metadata/100/thumb/1"
+    assert episode.media == (library.MediaVersion(1920, 1080, 420000, 7000, "/media/S01E07.mkv",
+                                                  "/library/parts/7/1/file.mkv"),)
+    assert library.show_of(episode).rating_key == 100 and library.season_of(episode).parent_key == 100
+
+
+def test_fetch_items_keeps_the_order_and_skips_missing_items(season):
+    assert [i.rating_key for i in library.fetch_items(season, [9, 500, 3])] == [9, 3]
+    assert library.fetch_item(season, 500) is None
+    assert library.fetch_items(season, []) == [] and len(season.queries) == 2
+
+
+@pytest.mark.parametrize("size, total_size, pages", [
+    (40, True, [range(1, 41), range(41, 81), range(81, 101)]),
+    (40, False, [range(1, 41), range(41, 81), range(81, 101)]),
+    (50, True, [range(1, 51), range(51, 101)]),
+    # without the total, a full last page can't be told from the others
+    (50, False, [range(1, 51), range(51, 101), range(0)]),
+])
+def test_children_are_fetched_one_page_at_a_time(season, size, total_size, pages):
+    season.total_size = total_size
+    item = library.Item(rating_key=200, type="season", title="Season 1")
+    fetched, start = [], 0
+    while start is not None:
+        items, start = library.children_page(season, item, start, size)
+        assert all(e.media for e in items)
+        fetched.append([e.rating_key for e in items])
+    assert fetched == [list(p) for p in pages]
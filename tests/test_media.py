@@ -0,0 +1,125 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import media
+import signing
+from config import config
+from sessions import Login
+
+
+def _request() -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/download/signed", "headers": [], "query_string": b""})
+
+
+def _grant(path: str, size: int = 1) -> signing.Grant:
+    return signing.Grant(path=path, size=size, expires=0, user="alice")
+
+
+@pytest.fixture
+def never_remote(monkeypatch):
+    monkeypatch.setattr(config, "remote_downloads", "never")
+
+
+def test_missing_file_is_not_found(never_remote, tmp_path):
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(media.download_grant(_request(), _grant(str(tmp_path / "gone.mkv")), "gone.mkv"))
+    assert e.value.status_code == 404
+
+
+def test_unreadable_path_is_not_found(never_remote, tmp_path):
+    # stat fails with NotADirectoryError rather than FileNotFoundError
+    (tmp_path / "file").write_bytes(b"x")
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(media.download_grant(_request(), _grant(str(tmp_path / "file" / "movie.mkv")), "movie.mkv"))
+    assert e.value.status_code == 404
+
+
+def test_changed_file_is_gone(never_remote, tmp_path):
+    path = tmp_path / "movie.mkv"
+    path.write_bytes(b"abc")
+    st = os.stat(path)
+    grant = signing.Grant(path=str(path), size=3, expires=0, user="alice", mtime_ns=st.st_mtime_ns - 1)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(media.download_grant(_request(), grant, "movie.mkv"))
+    assert e.value.status_code == 410
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(media.download_grant(_request(), _grant(str(path), size=4), "movie.mkv"))
+    assert e.value.status_code == 410
+
+
+@pytest.mark.parametrize("index", [-1, 1])
+def test_checksum_of_a_missing_version_is_not_found(monkeypatch, tmp_path, index):
+    path = tmp_path / "movie.mkv"
+    path.write_bytes(b"abc")
+    item = SimpleNamespace(media=[SimpleNamespace(file=str(path))])
+
+    async def get_server(login):
+        return None
+
+    monkeypatch.setattr(media, "get_server", get_server)
+    monkeypatch.setattr(media.library, "fetch_item", lambda server, key: item)
+    algorithm = media.checksums.service.algorithms[0]
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(media.checksum(1, index, algorithm, Login("user-token", "server-token")))
+    assert e.value.status_code == 404
+
+
+@pytest.fixture
+def plex_items(monkeypatch, tmp_path):
+    """
+    Item 1 with one version at tmp_path/movie.mkv, counting the times Plex is asked for it
+    """
+    path = tmp_path / "movie.mkv"
+    path.write_bytes(b"abc")
+    asked = []
+
+    async def get_server(login):
+        return login.server_token
+
+    def fetch_item(server, key):
+        asked.append(server)
+        return SimpleNamespace(media=[media.MediaVersion(1920, 1080, 1000, 3, str(path), "/library/parts/1/file.mkv")])
+
+    monkeypatch.setattr(media, "get_server", get_server)
+    monkeypatch.setattr(media.library, "fetch_item", fetch_item)
+    monkeypatch.setattr(config, "remote_downloads", "auto")
+    media._parts.clear()
+    yield path, asked
+    media._parts.clear()
+
+
+def test_parts_are_resolved_once_per_download(plex_items):
+    path, asked = plex_items
+    login = Login("user-token", "server-token")
+
+    async def run():
+        resolved = await asyncio.gather(*(media.resolve_part(login, 1, 0) for _ in range(5)))
+        assert {r.part.file for r in resolved} == {str(path)} and resolved[0].stat.st_size == 3
+        # later ranges of the download only stat the file
+        assert (await media.resolve_part(login, 1, 0)).stat.st_size == 3
+        # other users ask Plex themselves
+        await media.resolve_part(Login("other-token", "other-server-token"), 1, 0)
+
+    asyncio.run(run())
+    assert asked == ["server-token", "other-server-token"]
+
+
+def test_changed_file_is_resolved_again(plex_items):
+    path, asked = plex_items
+    login = Login("user-token", "server-token")
+
+    async def run():
+        await media.resolve_part(login, 1, 0)
+        path.write_bytes(b"abcd")
+        assert (await media.resolve_part(login, 1, 0)).stat.st_size == 4
+        # and so is a changed item
+        media.notifications.invalidate_item(1)
+        await media.resolve_part(login, 1, 0)
+
+    asyncio.run(run())
+    assert len(asked) == 3
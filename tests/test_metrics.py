@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import metrics
+from config import config
+
+
+def _request(authorization: str) -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/metrics", "query_string": b"",
+                    "headers": [(b"authorization", authorization.encode("latin-1"))]})
+
+
+@pytest.fixture
+def token(monkeypatch):
+    monkeypatch.setattr(config, "metrics_token", "s3cret")
+
+
+@pytest.mark.parametrize("authorization", ["Bearer wrong", "Basic s3cret", "Bearer sécret"])
+def test_wrong_token_is_unauthorized(token, authorization):
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(metrics.metrics(_request(authorization)))
+    assert e.value.status_code == 401
+
+
+def test_bearer_token_reads_the_metrics(token):
+    response = asyncio.run(metrics.metrics(_request("Bearer s3cret")))
+    assert b"plexdlweb_" in response.body
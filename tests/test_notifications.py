@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+import pytest
+from websockets.asyncio.server import serve
+
+import notifications
+
+
+class FakePlex:
+    """
+    Serves /library/sections and the notification websocket; the websocket can refuse connections, or close them
+    cleanly right after sending the queued messages
+    """
+    def __init__(self):
+        self.updated_at = 1
+        self.refuse = False
+        self.messages = []
+        self.polls = 0
+        self.connections = 0
+
+    def process_request(self, connection, request):
+        if request.path.startswith("/library/sections"):
+            self.polls += 1
+            body = {"MediaContainer": {"Directory": [{"key": "1", "type": "movie", "updatedAt": self.updated_at}]}}
+            return connection.respond(200, json.dumps(body))
+        if self.refuse:
+            return connection.respond(503, "unavailable")
+        return None
+
+    async def handler(self, ws):
+        self.connections += 1
+        for message in self.messages:
+            await ws.send(json.dumps(message))
+        self.messages.clear()
+
+
+@pytest.fixture
+def changes(monkeypatch):
+    items, sections = [], []
+    monkeypatch.setattr(notifications, "_item_handlers", [lambda key, section: items.append((key, section))])
+    monkeypatch.setattr(notifications, "_section_handlers", [sections.append])
+    return items, sections
+
+
+async def _until(condition, timeout=5):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+
+def _run(fake: FakePlex, scenario):
+    async def main():
+        async with serve(fake.handler, "127.0.0.1", 0, process_request=fake.process_request) as server:
+            port = server.sockets[0].getsockname()[1]
+            listener = notifications.NotificationListener(f"http://127.0.0.1:{port}", "token", max_backoff=0.05)
+            listener.start()
+            try:
+                await scenario(listener)
+            finally:
+                await listener.stop()
+
+    asyncio.run(main())
+
+
+def test_timeline_invalidates_item_and_section(changes):
+    items, sections = changes
+    fake = FakePlex()
+    fake.messages.append({"NotificationContainer": {"type": "timeline", "TimelineEntry": [
+        {"identifier": notifications.LIBRARY_IDENTIFIER, "state": notifications.TIMELINE_DONE,
+         "itemID": "42", "sectionID": "1"}]}})
+
+    async def scenario(listener):
+        await _until(lambda: items)
+
+    _run(fake, scenario)
+    assert items[0] == (42, 1)
+    assert 1 in sections
+
+
+def test_clean_disconnect_polls_for_missed_changes(changes):
+    _, sections = changes
+    fake = FakePlex()
+
+    async def scenario(listener):
+        await _until(lambda: fake.connections >= 1)
+        # changed while the websocket was closed: only the poll after the reconnection can see it
+        fake.updated_at = 2
+        await _until(lambda: sections)
+
+    _run(fake, scenario)
+    assert sections == [1]
+
+
+def test_refused_websocket_keeps_polling_and_reconnects(changes):
+    _, sections = changes
+    fake = FakePlex()
+    fake.refuse = True
+
+    async def scenario(listener):
+        await _until(lambda: fake.polls >= 3)
+        assert fake.connections == 0
+        fake.updated_at = 2
+        await _until(lambda: sections)
+        fake.refuse = False
+        await _until(lambda: fake.connections >= 1)
+
+    _run(fake, scenario)
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+import plex
+
+
+@pytest.fixture
+def plextv(monkeypatch):
+    """
+    Token checks that block until released, counting the calls
+    """
+    state = {"calls": 0, "release": None}
+
+    async def check(token):
+        state["calls"] += 1
+        await state["release"].wait()
+        return True
+
+    monkeypatch.setattr(plex, "check_user_token", check)
+    monkeypatch.setattr(plex, "check_server_token", check)
+    plex._token_cache.clear()
+    plex._forgotten.clear()
+    yield state
+    plex._token_cache.clear()
+    plex._forgotten.clear()
+
+
+def test_valid_tokens_are_remembered(plextv):
+    async def run():
+        plextv["release"] = asyncio.Event()
+        plextv["release"].set()
+        assert await plex.check_tokens("user", "server")
+        assert await plex.check_tokens("user", "server")
+
+    asyncio.run(run())
+    assert plextv["calls"] == 2
+
+
+def test_check_started_before_logout_is_not_cached(plextv):
+    async def run():
+        plextv["release"] = asyncio.Event()
+        check = asyncio.create_task(plex.check_tokens("user", "server"))
+        await asyncio.sleep(0)
+        await plex.forget_tokens("user", "server")
+        plextv["release"].set()
+        # the check in flight still answers its caller
+        assert await check
+        assert plex._token_cache.get(plex._token_key("user", "server")) is None
+        # the next one asks again, and is remembered
+        assert await plex.check_tokens("user", "server")
+        assert plex._token_cache.get(plex._token_key("user", "server")) is True
+
+    asyncio.run(run())
+    assert plextv["calls"] == 4
@@ -0,0 +1,127 @@
+import asyncio
+
+from starlette.requests import Request
+
+import metrics
+import notifications
+import plex
+from sessions import Login
+
+LOGIN = Login("user-token", "server-token")
+
+
+async def _get(path: str, headers: dict = None, login: Login = LOGIN) -> tuple[int, dict, bytes]:
+    """
+    Sends a request through the /plex proxy, returning the status, headers and body the client gets
+    """
+    request = Request({"type": "http", "method": "GET", "scheme": "http", "server": ("ui.test", 80),
+                       "path": f"/plex/{path}", "query_string": b"",
+                       "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]})
+    response = await plex.streaming(path, request, login)
+    messages = []
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    await response({"type": "http", "method": "GET", "asgi": {"spec_version": "2.4"}}, receive, send)
+    headers = {k.decode(): v.decode() for k, v in messages[0]["headers"]}
+    return messages[0]["status"], headers, b"".join(m.get("body", b"") for m in messages[1:])
+
+
+HOP_HEADERS = {"Connection": "keep-alive, X-Session-Hop", "Keep-Alive": "timeout=5", "X-Session-Hop": "1",
+               "X-Plex-Protocol": "1.0"}
+
+
+def test_hop_by_hop_headers_are_dropped(plex_server):
+    plex_server.routes["/photo/:/transcode"] = (200, HOP_HEADERS, b"jpeg")
+    plex_server.routes["/library/metadata/1"] = (200, HOP_HEADERS, b"<MediaContainer/>")
+
+    async def run():
+        # streamed and buffered answers alike
+        for path in ("photo/:/transcode", "library/metadata/1"):
+            status, headers, body = await _get(path)
+            assert status == 200
+            assert headers["x-plex-protocol"] == "1.0"
+            assert not {"connection", "keep-alive", "x-session-hop"} & set(headers)
+
+    asyncio.run(run())
+
+
+def test_conditional_requests_are_forwarded_and_not_cached(plex_server):
+    plex_server.routes["/library/metadata/1"] = (304, {"ETag": '"v1"'}, b"")
+
+    async def run():
+        status, headers, body = await _get("library/metadata/1", {"If-None-Match": '"v1"', "Cookie": "secret"})
+        assert (status, headers["etag"], body) == (304, '"v1"', b"")
+        _, sent = plex_server.requests[-1]
+        assert sent["if-none-match"] == '"v1"' and sent["x-plex-token"] == "server-token"
+        assert "cookie" not in sent
+        plex_server.routes["/library/metadata/1"] = (200, {}, b"<MediaContainer/>")
+        assert (await _get("library/metadata/1"))[0] == 200
+        assert (await _get("library/metadata/1"))[2] == b"<MediaContainer/>"
+
+    asyncio.run(run())
+    # the 304 wasn't cached, the 200 was
+    assert len(plex_server.requests) == 2
+
+
+def test_large_answers_are_streamed_without_buffering_again(plex_server):
+    large = b"x" * (plex.CACHEABLE_MAX_SIZE + 1)
+    plex_server.routes["/library/sections/1/all"] = (200, {}, large)
+    oversized = metrics.proxy._values.get(("oversized",), 0)
+
+    async def run():
+        for _ in range(2):
+            status, _, body = await _get("library/sections/1/all")
+            assert status == 200 and body == large
+
+    asyncio.run(run())
+    # the first request stops buffering and streams a new answer, the second one streams right away
+    assert len(plex_server.requests) == 3
+    assert metrics.proxy._values.get(("oversized",), 0) == oversized + 1
+
+
+def test_metadata_is_cached_per_token_and_fetched_once(plex_server):
+    plex_server.routes["/library/metadata/1"] = (200, {"Content-Type": "text/xml"}, b"<MediaContainer/>")
+
+    async def run():
+        answers = await asyncio.gather(*(_get("library/metadata/1") for _ in range(5)))
+        assert {a[2] for a in answers} == {b"<MediaContainer/>"}
+        assert len(plex_server.requests) == 1
+        assert (await _get("library/metadata/1"))[1]["content-type"] == "text/xml"
+        assert len(plex_server.requests) == 1
+        # another user's token gets its own answer
+        await _get("library/metadata/1", login=Login("other-user", "other-server-token"))
+        assert len(plex_server.requests) == 2
+
+    asyncio.run(run())
+
+
+def test_ranges_and_images_are_relayed_uncached(plex_server):
+    plex_server.routes["/library/metadata/1/thumb/5"] = (206, {"Content-Range": "bytes 0-1/4"}, b"jp")
+
+    async def run():
+        for _ in range(2):
+            status, headers, body = await _get("library/metadata/1/thumb/5", {"Range": "bytes=0-1"})
+            assert (status, headers["content-range"], body) == (206, "bytes 0-1/4", b"jp")
+
+    asyncio.run(run())
+    assert [sent["range"] for _, sent in plex_server.requests] == ["bytes=0-1"] * 2
+    # the body is relayed as is, so Plex must not compress it unless the client accepts it
+    assert plex_server.requests[0][1]["accept-encoding"] == "identity"
+
+
+def test_library_changes_clear_the_cache(plex_server):
+    plex_server.routes["/library/sections/1/all"] = (200, {}, b"v1")
+
+    async def run():
+        assert (await _get("library/sections/1/all"))[2] == b"v1"
+        plex_server.routes["/library/sections/1/all"] = (200, {}, b"v2")
+        assert (await _get("library/sections/1/all"))[2] == b"v1"
+        notifications.invalidate_section(1)
+        assert (await _get("library/sections/1/all"))[2] == b"v2"
+
+    asyncio.run(run())
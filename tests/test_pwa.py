@@ -0,0 +1,147 @@
+import json
+import shutil
+import subprocess
+
+import pytest
+
+import pwa
+from config import config
+
+# Loaded before the service worker in Node: in-memory caches and a fake network, then, once the worker registered its
+# listeners, its installation and the requests given on stdin
+HARNESS = """
+const listeners = {}, stores = {}, fetched = [];
+class FakeCache {
+    constructor() { this.entries = new Map(); }
+    async match(request) { const r = this.entries.get(request.url || request); return r && r.clone(); }
+    async put(request, response) { this.entries.delete(request.url); this.entries.set(request.url, response); }
+    async keys() { return [...this.entries.keys()]; }
+    async delete(key) { return this.entries.delete(key); }
+    async addAll(urls) { for (const url of urls) this.entries.set(url, new Response('shell')); }
+}
+globalThis.caches = {
+    open: async name => stores[name] ??= new FakeCache(),
+    keys: async () => Object.keys(stores),
+    delete: async name => delete stores[name],
+};
+globalThis.self = {
+    location: {origin: 'http://app.test'},
+    addEventListener: (type, listener) => { listeners[type] = listener; },
+    skipWaiting: async () => {},
+    clients: {claim: async () => {}},
+};
+let network = {};
+globalThis.fetch = async request => {
+    fetched.push(request.url);
+    const [status, type, body] = network[new URL(request.url).pathname];
+    return new Response(body, {status, headers: {'content-type': type}});
+};
+
+async function lifecycle(type) {
+    const waits = [];
+    listeners[type]({waitUntil: p => waits.push(p)});
+    await Promise.all(waits);
+}
+
+async function get(path, {method = 'GET', headers = {}, destination = 'image'} = {}) {
+    const waits = [];
+    let response;
+    const request = {url: 'http://app.test' + path, method, headers: new Headers(headers), destination};
+    listeners.fetch({request, respondWith: p => { response = p; }, waitUntil: p => waits.push(p)});
+    const result = response ? {intercepted: true, body: await (await response).text()} : {intercepted: false};
+    await Promise.all(waits);
+    return result;
+}
+
+setTimeout(async () => {
+    const scenario = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+    stores['plexdlweb-images-0'] = new (FakeCache)();
+    await lifecycle('install');
+    await lifecycle('activate');
+    const results = [];
+    for (const step of scenario) {
+        network = step.network || network;
+        const before = fetched.length;
+        results.push({...await get(step.path, step), fetched: fetched.length - before});
+    }
+    const caches = Object.fromEntries(Object.entries(stores).map(([k, v]) => [k, [...v.entries.keys()]]));
+    console.log(JSON.stringify({results, caches}));
+});
+"""
+
+
+@pytest.fixture
+def worker(monkeypatch, tmp_path):
+    """
+    Replays requests through the service worker: returns the outcome of each one, and the caches afterwards
+    """
+    if shutil.which("node") is None:
+        pytest.skip("needs Node.js")
+    monkeypatch.setattr(config, "pwa_image_cache", 2)
+    # what ui.run sets, as __main__ calls it
+    for option, value in {"prod_js": True, "language": "en-US", "tailwind": True, "unocss": None}.items():
+        monkeypatch.setattr(pwa.app.config, option, value, raising=False)
+    pwa.script.cache_clear()
+    path = tmp_path / "sw.js"
+    path.write_text(HARNESS + pwa.script())
+
+    def run(scenario: list[dict]):
+        out = subprocess.run(["node", str(path)], input=json.dumps(scenario), capture_output=True, text=True,
+                             check=True, timeout=30)
+        return json.loads(out.stdout)
+
+    yield run
+    pwa.script.cache_clear()
+
+
+POSTER = [200, "image/jpeg", "poster"]
+
+
+def test_shell_is_precached_and_old_caches_dropped(worker):
+    caches = worker([])["caches"]
+    shell = [name for name in caches if name.startswith("plexdlweb-shell-")]
+    assert len(shell) == 1 and caches[shell[0]] == pwa.shell()
+    assert "plexdlweb-images-0" not in caches
+
+
+def test_thumbnails_are_served_from_the_cache(worker):
+    network = {"/thumb/300/450/library/metadata/1/thumb/5": POSTER}
+    results = worker([{"path": "/thumb/300/450/library/metadata/1/thumb/5", "network": network}] * 2)["results"]
+    assert [(r["body"], r["fetched"]) for r in results] == [("poster", 1), ("poster", 0)]
+
+
+def test_login_pages_and_errors_are_not_kept_as_posters(worker):
+    path = "/thumb/300/450/library/metadata/1/thumb/5"
+    results = worker([{"path": path, "network": {path: [200, "text/html", "login"]}},
+                      {"path": path, "network": {path: [404, "image/jpeg", ""]}},
+                      {"path": path, "network": {path: POSTER}}])["results"]
+    assert [r["fetched"] for r in results] == [1, 1, 1]
+
+
+def test_plex_images_are_refreshed_in_the_background(worker):
+    path = "/plex/library/metadata/1/art/5"
+    results = worker([{"path": path, "network": {path: POSTER}},
+                      {"path": path, "network": {path: [200, "image/jpeg", "new poster"]}},
+                      {"path": path}])["results"]
+    assert [(r["body"], r["fetched"]) for r in results] == [("poster", 1), ("poster", 1), ("new poster", 1)]
+
+
+def test_image_cache_keeps_the_latest_posters(worker):
+    paths = [f"/thumb/300/450/library/metadata/{k}/thumb/5" for k in range(3)]
+    network = {path: POSTER for path in paths}
+    out = worker([{"path": path, "network": network} for path in paths])
+    [images] = [keys for name, keys in out["caches"].items() if name.startswith("plexdlweb-images-")]
+    assert images == ["http://app.test" + path for path in paths[1:]]
+
+
+@pytest.mark.parametrize("request_", [
+    {"path": "/download/1/0"},
+    {"path": "/download/bundle/1"},
+    {"path": "/_nicegui_ws/socket.io/?EIO=4", "destination": ""},
+    {"path": "/thumb/300/450/library/metadata/1/thumb/5", "headers": {"Range": "bytes=0-1"}},
+    {"path": "/thumb/300/450/library/metadata/1/thumb/5", "method": "POST"},
+    {"path": "/", "destination": "document"},
+])
+def test_downloads_pages_and_websocket_go_to_the_network(worker, request_):
+    [result] = worker([request_])["results"]
+    assert not result["intercepted"]
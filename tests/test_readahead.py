@@ -0,0 +1,82 @@
+import os
+import threading
+
+import pytest
+
+import readahead
+from readahead import Readahead
+
+MiB = 1024 * 1024
+
+
+@pytest.fixture
+def hints(monkeypatch):
+    """
+    The hints given, as (advice, offset, length)
+    """
+    calls = []
+    monkeypatch.setattr(readahead, "HAS_FADVISE", True)
+    # the advice constants stand for themselves, so that this also runs where os lacks them
+    for advice in ("SEQUENTIAL", "WILLNEED", "DONTNEED"):
+        monkeypatch.setattr(os, f"POSIX_FADV_{advice}", advice, raising=False)
+    monkeypatch.setattr(os, "posix_fadvise", lambda fd, offset, length, advice: calls.append((advice, offset, length)),
+                        raising=False)
+    return calls
+
+
+def test_window_is_requested_ahead_and_dropped_behind(hints):
+    r = Readahead(fd=3, start=0, end=100 * MiB, window=8 * MiB)
+    assert hints == [("SEQUENTIAL", 0, 100 * MiB), ("WILLNEED", 0, 8 * MiB)]
+    hints.clear()
+    # nothing new until half of the window is consumed
+    r.advance(3 * MiB)
+    assert hints == []
+    r.advance(4 * MiB)
+    assert hints == [("WILLNEED", 8 * MiB, 4 * MiB)]
+    hints.clear()
+    r.advance(8 * MiB)
+    assert hints == [("WILLNEED", 12 * MiB, 4 * MiB), ("DONTNEED", 0, 8 * MiB)]
+    hints.clear()
+    r.advance(10 * MiB)
+    r.close()
+    assert hints == [("DONTNEED", 8 * MiB, 2 * MiB)]
+
+
+def test_hints_stop_at_the_end_of_the_range(hints):
+    r = Readahead(fd=3, start=5 * MiB, end=7 * MiB, window=8 * MiB, drop_behind=False)
+    r.advance(6 * MiB)
+    r.close()
+    assert hints == [("SEQUENTIAL", 5 * MiB, 2 * MiB), ("WILLNEED", 5 * MiB, 2 * MiB)]
+
+
+def test_no_window_no_hints(hints):
+    r = Readahead(fd=3, start=0, end=100 * MiB, window=0)
+    r.advance(50 * MiB)
+    r.close()
+    assert hints == []
+
+
+def test_prefetch_reads_the_window_ahead_of_the_stream(tmp_path, hints, monkeypatch):
+    path = tmp_path / "movie.mkv"
+    path.write_bytes(b"\0" * 8 * MiB)
+    reads = []
+    # set once the prefetcher read this far
+    reached = {2 * MiB: threading.Event(), 4 * MiB: threading.Event()}
+    pread = os.pread
+
+    def recording_pread(fd, n, offset):
+        reads.append(offset)
+        if offset + n in reached:
+            reached[offset + n].set()
+        return pread(fd, n, offset)
+
+    monkeypatch.setattr(os, "pread", recording_pread)
+    with open(path, "rb") as f:
+        r = Readahead(f.fileno(), 0, 8 * MiB, window=2 * MiB, prefetch=True)
+        assert reached[2 * MiB].wait(5)
+        r.advance(2 * MiB)
+        assert reached[4 * MiB].wait(5)
+        r.close()
+        assert not r._prefetcher.is_alive()
+    # the prefetcher stays within the window ahead of the stream
+    assert reads == [0, MiB, 2 * MiB, 3 * MiB]
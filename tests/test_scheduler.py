@@ -0,0 +1,71 @@
+import asyncio
+import subprocess
+import sys
+
+import pytest
+
+from config import config
+from scheduler import FairShare, Refused, TokenBucket, TransferTable
+
+
+@pytest.fixture
+def table(tmp_path):
+    table = TransferTable(str(tmp_path / "transfers.db"))
+    yield table
+    table.close()
+
+
+def test_stream_limits(table, monkeypatch):
+    monkeypatch.setattr(config, "max_streams", 3)
+    monkeypatch.setattr(config, "max_streams_per_user", 2)
+    monkeypatch.setattr(config, "remote_max_streams", 1)
+    table.insert("alice", "a.mkv", 1, False, False)
+    _, streams = table.insert("alice", "b.mkv", 1, True, True)
+    assert streams == {"alice": 2}
+    with pytest.raises(Refused):
+        table.insert("alice", "c.mkv", 1, False, False)
+    with pytest.raises(Refused):
+        table.insert("bob", "c.mkv", 1, False, True)
+    bob, _ = table.insert("bob", "c.mkv", 1, False, False)
+    with pytest.raises(Refused):
+        table.insert("carol", "d.mkv", 1, False, False)
+    table.delete(bob)
+    table.insert("carol", "d.mkv", 1, False, False)
+    assert sorted(row.user for row in table.rows()) == ["alice", "alice", "carol"]
+
+
+def test_transfers_of_exited_processes_are_dropped(table, monkeypatch):
+    monkeypatch.setattr(config, "max_streams", 1)
+    exited = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    with table._lock:
+        table._db.execute("INSERT INTO transfers (pid, user, name, size, ranged, remote, started) "
+                          "VALUES (?, 'alice', 'a.mkv', 1, 0, 0, 0)", (int(exited.stdout),))
+    assert table.rows() == []
+    assert not table.busy()
+    table.insert("bob", "b.mkv", 1, False, False)
+    assert table.busy()
+
+
+def test_token_bucket_debt():
+    bucket = TokenBucket(1000)
+    assert bucket.reserve(1000) == 0
+    assert bucket.reserve(500) == pytest.approx(0.5, abs=0.05)
+    bucket.set_rate(2000)
+    assert bucket.reserve(0) == pytest.approx(0.25, abs=0.05)
+
+
+def test_fair_share_follows_weights():
+    async def main():
+        fair = FairShare(TokenBucket(1e9))
+        served = []
+
+        async def download(user: str, weight: float):
+            for _ in range(40):
+                await fair.acquire(user, 1000, weight)
+                served.append(user)
+
+        await asyncio.gather(download("alice", 1), download("bob", 3))
+        return served[:40]
+
+    first = asyncio.run(main())
+    assert first.count("bob") == pytest.approx(30, abs=3)
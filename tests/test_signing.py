@@ -0,0 +1,41 @@
+import time
+
+import signing
+
+
+def test_single_file_grant():
+    token = signing.sign("/media/Movie.mkv", 1234, "alice", "server-token", "/library/parts/1/file.mkv", 42)
+    grant = signing.verify(token)
+    assert (grant.path, grant.size, grant.user, grant.part_key, grant.mtime_ns) == \
+        ("/media/Movie.mkv", 1234, "alice", "/library/parts/1/file.mkv", 42)
+    assert grant.expires > time.time()
+    # the URL carries an id, not the path
+    assert "Movie" not in signing._b64decode(token.partition(".")[0]).decode()
+
+
+def test_bundle_grant_by_name():
+    token = signing.sign_files({"Show/S01/a.mkv": ("/media/a.mkv", 1, 10, None),
+                                "Show/S01/b.mkv": ("/media/b.mkv", 2, None, "/library/parts/2/b.mkv")},
+                               "bob", "server-token")
+    assert signing.verify(token, "Show/S01/b.mkv").path == "/media/b.mkv"
+    assert signing.verify(token, "Show/S01/c.mkv") is None
+    assert signing.verify(token) is None
+
+
+def test_tampered_and_expired_tokens():
+    token = signing.sign("/media/a.mkv", 1, "carol", "server-token")
+    payload, _, signature = token.partition(".")
+    assert signing.verify(f"{payload}.{signature[:-2]}AA") is None
+    assert signing.verify("garbage") is None
+    assert signing.verify(f"{payload}.é{signature}") is None
+    assert signing.verify(f"é{payload}.{signature}") is None
+    expired = signing._encode({"g": signing._decode(token)["g"]}, int(time.time()) - 1)
+    assert signing.verify(expired) is None
+
+
+def test_revoked_on_logout():
+    mine = signing.sign("/media/a.mkv", 1, "dave", "dave-token")
+    theirs = signing.sign("/media/a.mkv", 1, "erin", "erin-token")
+    signing.revoke("dave-token")
+    assert signing.verify(mine) is None
+    assert signing.verify(theirs) is not None
@@ -0,0 +1,69 @@
+import asyncio
+from xml.etree import ElementTree
+
+import pytest
+from fastapi import HTTPException
+from plexapi.exceptions import NotFound
+from starlette.requests import Request
+
+import thumbs
+from sessions import Login
+
+PATH = "/library/metadata/7/thumb/1700000000"
+
+
+class FakeServer:
+    """
+    Answers metadata queries with item 7 for the tokens that can see it
+    """
+    def __init__(self, visible: bool):
+        self.visible = visible
+        self.queries = 0
+
+    def query(self, path: str, params: dict = None):
+        self.queries += 1
+        if not self.visible:
+            raise NotFound("404")
+        return ElementTree.fromstring(f'<MediaContainer><Video ratingKey="7" thumb="{PATH}"/></MediaContainer>')
+
+
+@pytest.fixture
+def servers(monkeypatch):
+    servers = {"alice-token": FakeServer(True), "bob-token": FakeServer(False)}
+
+    async def server_for_token(token):
+        return servers[token]
+
+    monkeypatch.setattr(thumbs, "server_for_token", server_for_token)
+    thumbs._access.clear()
+    key = thumbs._cache_key(PATH, 100, 150)
+    thumbs.cache._write(key, b"jpeg")
+    yield servers
+    thumbs._access.clear()
+
+
+def _get(token: str, headers: dict = None):
+    request = Request({"type": "http", "method": "GET", "path": "/thumb", "query_string": b"",
+                       "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]})
+    return asyncio.run(thumbs.thumbnail(request, 100, 150, PATH.lstrip("/"), Login("user", token)))
+
+
+def test_cached_thumbnail_is_served_to_users_who_can_load_the_item(servers):
+    assert _get("alice-token").body == b"jpeg"
+    assert _get("alice-token").body == b"jpeg"
+    # the access is remembered
+    assert servers["alice-token"].queries == 1
+
+
+def test_cached_thumbnail_is_hidden_from_other_users(servers):
+    with pytest.raises(HTTPException) as e:
+        _get("bob-token")
+    assert e.value.status_code == 404
+
+
+def test_not_modified_needs_access_too(servers):
+    etag = _get("alice-token").headers["etag"]
+    assert _get("alice-token", {"If-None-Match": etag}).status_code == 304
+    with pytest.raises(HTTPException) as e:
+        _get("bob-token", {"If-None-Match": etag})
+    assert e.value.status_code == 404
@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+import torrent
+from hashcache import hashes
+from torrent import BLOCK, MIN_PIECE, TorrentFile
+
+
+def bdecode(data: bytes, i: int = 0):
+    kind = data[i:i + 1]
+    if kind == b"i":
+        end = data.index(b"e", i)
+        return int(data[i + 1:end]), end + 1
+    if kind in (b"l", b"d"):
+        items, i = [], i + 1
+        while data[i:i + 1] != b"e":
+            item, i = bdecode(data, i)
+            items.append(item)
+        return (dict(zip(items[::2], items[1::2])) if kind == b"d" else items), i + 1
+    colon = data.index(b":", i)
+    end = colon + 1 + int(data[i:colon])
+    return data[colon + 1:end], end
+
+
+def merkle_root(data: bytes, leaves: int = 0) -> bytes:
+    # BEP 52: SHA-256 of each 16 KiB block, then zero hashes up to a power of two
+    layer = [hashlib.sha256(data[i:i + BLOCK]).digest() for i in range(0, len(data), BLOCK)]
+    layer += [bytes(32)] * ((leaves or torrent._next_pow2(len(layer))) - len(layer))
+    while len(layer) > 1:
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+    return layer[0]
+
+
+@pytest.fixture
+def files(tmp_path):
+    result = []
+    for name, size in (("a.mkv", 600_000), ("b.mkv", MIN_PIECE), ("c.mkv", 100_000)):
+        path = tmp_path / name
+        path.write_bytes(os.urandom(size))
+        result.append(TorrentFile([name], str(path), os.stat(path)))
+    return result
+
+
+def test_bencode():
+    assert torrent.bencode({"b": [1, "x"], "a": b"\x00"}) == b"d1:a1:\x001:bli1e1:xee"
+
+
+def test_hybrid_torrent_hashes(files):
+    meta, _ = bdecode(asyncio.run(torrent.make_torrent("Show", files, "hybrid", "http://seed/")))
+    info = meta[b"info"]
+    assert info[b"piece length"] == MIN_PIECE
+    # v1: the files back to back, each but the last padded to a piece boundary
+    stream = b""
+    for i, f in enumerate(files):
+        stream += open(f.local_path, "rb").read()
+        if i < len(files) - 1:
+            stream += bytes(-len(stream) % MIN_PIECE)
+    pieces = b"".join(hashlib.sha1(stream[i:i + MIN_PIECE]).digest() for i in range(0, len(stream), MIN_PIECE))
+    assert info[b"pieces"] == pieces
+    # v2: each file's merkle root, and the piece layer of files longer than a piece
+    for f in files:
+        data = open(f.local_path, "rb").read()
+        node = info[b"file tree"][f.path[0].encode()][b""]
+        assert node[b"pieces root"] == merkle_root(data)
+        if len(data) > MIN_PIECE:
+            layer = b"".join(merkle_root(data[i:i + MIN_PIECE], MIN_PIECE // BLOCK)
+                             for i in range(0, len(data), MIN_PIECE))
+            assert meta[b"piece layers"][node[b"pieces root"]] == layer
+    assert meta[b"url-list"] == [b"http://seed/"]
+
+
+def test_hashes_are_cached(files):
+    f = files[0]
+    computed = asyncio.run(torrent.file_hashes(f.local_path, f.stat, MIN_PIECE))
+    assert hashes.get(f"torrent:{MIN_PIECE}", f.local_path, f.stat) == computed.encode()
+    assert asyncio.run(torrent.file_hashes(f.local_path, f.stat, MIN_PIECE)) == computed
+
+
+def test_large_torrents_are_hashed_in_the_background(files, monkeypatch):
+    monkeypatch.setattr(torrent, "INLINE_BYTES", 0)
+
+    async def main():
+        assert not await torrent.prepare(files)
+        await asyncio.gather(*torrent._jobs)
+        return await torrent.prepare(files)
+
+    assert asyncio.run(main())
@@ -0,0 +1,99 @@
+import asyncio
+import io
+import os
+import zipfile
+
+import pytest
+
+import zipstream
+from zipstream import ZipEntry, ZipStreamResponse
+
+
+class DictCache:
+    def __init__(self):
+        self.values, self.claims = {}, set()
+
+    def get(self, kind, path, st):
+        return self.values.get((kind, path))
+
+    def set(self, kind, path, st, value):
+        self.values[(kind, path)] = value
+
+    def claim(self, key, ttl):
+        if key in self.claims:
+            return False
+        self.claims.add(key)
+        return True
+
+    def release(self, key):
+        self.claims.discard(key)
+
+
+@pytest.fixture
+def entries(tmp_path):
+    files = {"Show/S01/a.mkv": os.urandom(300_000), "Show/S01/b.mkv": b"", "Show/S02/c.mkv": os.urandom(70_000)}
+    result = []
+    for name, data in files.items():
+        path = tmp_path / os.path.basename(name)
+        path.write_bytes(data)
+        result.append(ZipEntry(name, str(path), os.stat(path)))
+    return result
+
+
+def _scope(headers: dict = None) -> dict:
+    return {"type": "http", "method": "GET",
+            "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]}
+
+
+async def _get(response: ZipStreamResponse, headers: dict = None) -> tuple[int, bytes]:
+    messages = []
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    await response(_scope(headers), receive, send)
+    return messages[0]["status"], b"".join(m.get("body", b"") for m in messages[1:])
+
+
+def test_archive_is_valid(entries):
+    status, body = asyncio.run(_get(ZipStreamResponse(entries, "show.zip")))
+    assert status == 200
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == [e.name for e in entries]
+        assert archive.read("Show/S02/c.mkv") == open(entries[2].path, "rb").read()
+
+
+@pytest.mark.parametrize("spec", ["0-99", "100-300000", "299990-", "-50"])
+def test_ranges_match_the_archive(entries, spec):
+    _, full = asyncio.run(_get(ZipStreamResponse(entries, "show.zip")))
+    status, body = asyncio.run(_get(ZipStreamResponse(entries, "show.zip"), {"Range": f"bytes={spec}"}))
+    first, _, last = spec.partition("-")
+    expected = full[-int(last):] if not first else full[int(first):int(last) + 1 if last else None]
+    assert status == 206
+    assert body == expected
+
+
+def test_unknown_crcs_are_computed_in_the_background(entries, monkeypatch):
+    monkeypatch.setattr(zipstream, "INLINE_CRC_BYTES", 0)
+    cache = DictCache()
+
+    async def main():
+        response = ZipStreamResponse(entries, "show.zip", crc_cache=cache)
+        # the whole archive computes its CRCs while streaming
+        assert await response.prepare(_scope())
+        central = {"Range": f"bytes={response._central_offset + 5}-"}
+        assert not await response.prepare(_scope(central))
+        await asyncio.gather(*zipstream._jobs)
+        assert not cache.claims
+        response = ZipStreamResponse(entries, "show.zip", crc_cache=cache)
+        assert await response.prepare(_scope(central))
+        return response._central_offset + 5, await _get(response, central)
+
+    start, (status, body) = asyncio.run(main())
+    _, full = asyncio.run(_get(ZipStreamResponse(entries, "show.zip")))
+    assert status == 206
+    assert body == full[start:]
@@ -0,0 +1,230 @@
+"""
+Poster thumbnails resized by Plex's photo transcoder, kept in a size-bounded on-disk LRU cache.
+
+Entries are keyed by the image path and the requested size. Plex ends image paths with the time the image changed, so
+a changed poster gets a new key instead of needing an invalidation, and responses can be marked immutable. Before
+transcoding, the path is checked to be one of the item's current images as the user's token sees it, so the cache
+only holds images some user could load, under the path Plex gave them. Every request, cached or not, is first checked
+to come from a token that can load the item.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+from typing import Optional
+
+import httpx
+from fastapi import APIRouter, Depends, Request, Response, HTTPException
+from nicegui import app
+from plexapi.exceptions import NotFound, Unauthorized
+from plexapi.server import PlexServer
+
+from config import config
+from common import io_bound, server_pool, SingleFlight, TTLCache
+from library import Item
+import metrics
+from plex import request_login, server_for_token
+from sessions import Login
+
+logger = logging.getLogger("plexdlweb.thumbs")
+
+MAX_DIMENSION = 2000
+# /library/metadata/<ratingKey>/thumb/<changed at>, or /composite/ for collections
+IMAGE_PATH = re.compile(r"/library/(?:metadata|collections)/(\d+)/\w+/\d+")
+# seconds between two sweeps of the cache directory, and between two mtime bumps of a cached thumbnail
+SWEEP_INTERVAL = 60
+TOUCH_INTERVAL = 3600
+# how long a user's access to an item is remembered
+ACCESS_TTL = 300
+CACHE_HEADERS = {
+    # thumbnails are only served to logged-in users, but their URL changes whenever the image does
+    "Cache-Control": "private, max-age=31536000, immutable",
+}
+
+
+class ThumbCache:
+    """
+    Directory of thumbnails shared by every process: any of them adds files, and the least recently used ones (by
+    mtime, bumped on hits) are evicted by the UI process alone, which sweeps the directory every SWEEP_INTERVAL. The
+    cache can therefore exceed its size by what is added between two sweeps.
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".jpg")
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        A cached thumbnail, marking it as recently used; blocking
+        """
+        # read at once, since a sweep may remove the file right after
+        try:
+            with open(self.path(key), "rb") as f:
+                if time.time() - os.fstat(f.fileno()).st_mtime > TOUCH_INTERVAL:
+                    os.utime(f.fileno())
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key: str, data: bytes):
+        # processes may transcode the same thumbnail at once
+        tmp = f"{self.path(key)}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path(key))
+
+    async def put(self, key: str, data: bytes) -> bytes:
+        await io_bound(self._write, key, data)
+        return data
+
+    def sweep(self):
+        """
+        Removes the least recently used thumbnails until the cache fits in its size; blocking
+        """
+        files, total = [], 0
+        for entry in os.scandir(self.directory):
+            if not (entry.is_file() and entry.name.endswith(".jpg")):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, entry.name, st.st_size))
+            total += st.st_size
+        files.sort()
+        evicted = 0
+        for _, name, size in files[:-1]:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        if evicted:
+            logger.debug("Evicted %s thumbnails", evicted)
+
+
+cache = ThumbCache(config.thumb_cache_dir, config.thumb_cache_size * 1024 * 1024)
+_fetching = SingleFlight()
+# whether a server token can load an item: (token hash, ratingKey) -> bool
+_access = TTLCache(maxsize=65536, ttl=ACCESS_TTL)
+_sweeper: Optional[asyncio.Task] = None
+
+
+async def _sweep():
+    while True:
+        try:
+            await io_bound(cache.sweep)
+        except Exception:
+            logger.exception("Sweeping the thumbnail cache failed")
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+
+def startup():
+    global _sweeper
+    _sweeper = asyncio.create_task(_sweep())
+
+
+# the download workers don't evict, so that one process accounts for the whole directory
+app.on_startup(startup)
+
+
+def shutdown():
+    if _sweeper is not None:
+        _sweeper.cancel()
+
+
+app.on_shutdown(shutdown)
+
+
+def thumb_url(item: Item, width: int = None, height: int = None) -> Optional[str]:
+    if not item.thumb:
+        return None
+    return f"/thumb/{width or config.thumb_width}/{height or config.thumb_height}{item.thumb}"
+
+
+def _cache_key(path: str, width: int, height: int) -> str:
+    return hashlib.sha256(f"{path}|{width}x{height}|{config.thumb_quality}".encode()).hexdigest()
+
+
+def _can_load(server: PlexServer, rating_key: str) -> bool:
+    """
+    Whether the server's token can load the item; blocking
+    """
+    try:
+        return len(server.query(f"/library/metadata/{rating_key}", params={"includeFields": "ratingKey"})) > 0
+    except (NotFound, Unauthorized):
+        return False
+
+
+async def _check_access(path: str, token: str):
+    rating_key = IMAGE_PATH.fullmatch(path).group(1)
+    key = (hashlib.sha256(token.encode()).hexdigest(), rating_key)
+    if (allowed := _access.get(key)) is None:
+        allowed = await server_pool.run(_can_load, await server_for_token(token), rating_key)
+        _access.set(key, allowed)
+    if not allowed:
+        raise HTTPException(status_code=404)
+
+
+def _is_current(server: PlexServer, path: str) -> bool:
+    """
+    Whether the path is one of its item's current images, as the server's token sees the item; blocking
+    """
+    try:
+        container = server.query(f"/library/metadata/{IMAGE_PATH.fullmatch(path).group(1)}")
+    except (NotFound, Unauthorized):
+        return False
+    return any(path in e.attrib.values() for e in container)
+
+
+async def _transcode(key: str, path: str, width: int, height: int, token: str) -> bytes:
+    if not await server_pool.run(_is_current, await server_for_token(token), path):
+        raise HTTPException(status_code=404)
+    client: httpx.AsyncClient = app.state.httpx_client
+    resp = await client.get(config.server_url + "/photo/:/transcode", params={
+        "url": path,
+        "width": width,
+        "height": height,
+        "quality": config.thumb_quality,
+        "minSize": 1,
+        "upscale": 1,
+        "format": "jpeg",
+    }, headers={"X-Plex-Token": token})
+    if resp.status_code != 200:
+        logger.warning("Photo transcoder returned %s for %s", resp.status_code, path)
+        raise HTTPException(status_code=502 if resp.status_code >= 500 else resp.status_code)
+    return await cache.put(key, resp.content)
+
+
+router = APIRouter()
+
+
+@router.get("/thumb/{width}/{height}/{path:path}")
+async def thumbnail(request: Request, width: int, height: int, path: str, login: Login = Depends(request_login)):
+    """
+    Serves a library image resized to width x height
+    """
+    path = "/" + path
+    if not IMAGE_PATH.fullmatch(path) or not (0 < width <= MAX_DIMENSION and 0 < height <= MAX_DIMENSION):
+        raise HTTPException(status_code=400)
+    await _check_access(path, login.server_token)
+    key = _cache_key(path, width, height)
+    etag = f'"{key}"'
+    headers = {**CACHE_HEADERS, "ETag": etag}
+    if etag in request.headers.get("if-none-match", ""):
+        metrics.thumbnails.inc("not_modified")
+        return Response(status_code=304, headers=headers)
+    if (data := await io_bound(cache.get, key)) is None:
+        metrics.thumbnails.inc("miss")
+        data = await _fetching.run(key, _transcode, key, path, width, height, login.server_token)
+    else:
+        metrics.thumbnails.inc("hit")
+    return Response(data, media_type="image/jpeg", headers=headers)
@@ -0,0 +1,261 @@
+"""
+Torrent files for media parts and whole bundles, with BitTorrent v1, v2 (BEP 52) or hybrid metainfo.
+
+Each file is aligned on piece boundaries (BEP 47 padding files in multi-file v1 and hybrid torrents), so the piece
+hashes of a file don't depend on the other files of the torrent: they are computed once per file and piece length,
+on several threads at once (hashlib releases the GIL), and kept in the hash cache keyed by path, size and mtime.
+Torrents list a web seed (BEP 19) pointing back at signed download URLs, so clients can fetch from HTTP and peers.
+
+Hashing a whole show can take hours, so beyond INLINE_BYTES of files without known hashes, it runs in the background
+(in one process, the others seeing its claim in the hash cache) while clients are told to come back later.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from nicegui import app
+
+from config import config
+from common import io_bound, SingleFlight
+from hashcache import hashes
+
+logger = logging.getLogger("plexdlweb.torrent")
+
+VERSIONS = ("v1", "v2", "hybrid")
+BLOCK = 16 * 1024
+MIN_PIECE = 256 * 1024
+MAX_PIECE = 16 * 1024 * 1024
+TARGET_PIECES = 2000
+# a range hashed by one thread, in pieces
+MIN_TASK_PIECES = 32
+# bytes still to hash that a torrent request waits for, and seconds before another process may take over a file
+# claimed by a process that died
+INLINE_BYTES = 1024 ** 3
+CLAIM_TTL = 3600
+
+_hashers = ThreadPoolExecutor(max_workers=config.torrent_workers or os.cpu_count(),
+                              thread_name_prefix="plexdlweb-hash")
+_hashing = SingleFlight()
+_jobs: set[asyncio.Task] = set()
+
+
+def bencode(value) -> bytes:
+    if isinstance(value, bool):
+        raise TypeError("booleans can't be bencoded")
+    if isinstance(value, int):
+        return b"i%de" % value
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b"%d:%s" % (len(value), value)
+    if isinstance(value, list):
+        return b"l" + b"".join(map(bencode, value)) + b"e"
+    if isinstance(value, dict):
+        items = sorted((k.encode() if isinstance(k, str) else k, v) for k, v in value.items())
+        return b"d" + b"".join(bencode(k) + bencode(v) for k, v in items) + b"e"
+    raise TypeError(f"can't bencode {type(value).__name__}")
+
+
+def piece_length_for(total: int) -> int:
+    length = MIN_PIECE
+    while total // length > TARGET_PIECES and length < MAX_PIECE:
+        length *= 2
+    return length
+
+
+def _next_pow2(n: int) -> int:
+    return 1 << max(0, n - 1).bit_length()
+
+
+def _merkle_root(hashes: list[bytes], leaves: int, pad: bytes = bytes(32)) -> bytes:
+    """
+    Root of a SHA-256 tree with leaves leaves (a power of two): the given hashes, then pad
+    """
+    layer = hashes + [pad] * (leaves - len(hashes))
+    while len(layer) > 1:
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+    return layer[0]
+
+
+@dataclass(frozen=True)
+class FileHashes:
+    # SHA-1 of each piece, the last one as is, and the last one padded with zeros to the piece length
+    sha1: list[bytes]
+    sha1_padded: bytes
+    # v2 merkle root of the file, and the hashes of its piece layer (empty for files of at most one piece)
+    root: bytes
+    layer: list[bytes]
+
+    def encode(self) -> bytes:
+        return self.root + self.sha1_padded + b"".join(self.sha1) + b"".join(self.layer)
+
+    @classmethod
+    def decode(cls, data: bytes, pieces: int, layered: bool) -> "FileHashes":
+        sha1 = data[52:52 + 20 * pieces]
+        layer = data[52 + 20 * pieces:]
+        return cls(sha1=[sha1[i:i + 20] for i in range(0, len(sha1), 20)], sha1_padded=data[32:52], root=data[:32],
+                   layer=[layer[i:i + 32] for i in range(0, len(layer), 32)] if layered else [])
+
+
+def _hash_pieces(path: str, size: int, piece_length: int, first: int, last: int):
+    """
+    SHA-1 and v2 piece-layer hashes of pieces first to last - 1, and the hashes of the final piece's blocks when it
+    is among them
+    """
+    sha1, layer, final_blocks, padded = [], [], None, None
+    blocks_per_piece = piece_length // BLOCK
+    with open(path, "rb", buffering=0) as f:
+        f.seek(first * piece_length)
+        buf = bytearray(piece_length)
+        for piece in range(first, last):
+            n = f.readinto(buf)
+            expected = min(piece_length, size - piece * piece_length)
+            if n != expected:
+                raise OSError(f"{path} changed while being hashed")
+            data = memoryview(buf)[:n]
+            sha1.append(hashlib.sha1(data).digest())
+            blocks = [hashlib.sha256(data[i:i + BLOCK]).digest() for i in range(0, n, BLOCK)]
+            layer.append(_merkle_root(blocks, blocks_per_piece))
+            if piece == last - 1 and last * piece_length >= size:
+                final_blocks = blocks
+                padded = hashlib.sha1(bytes(data) + bytes(piece_length - n)).digest() if n < piece_length else sha1[-1]
+    return sha1, layer, final_blocks, padded
+
+
+async def _compute(path: str, st: os.stat_result, piece_length: int) -> FileHashes:
+    loop = asyncio.get_running_loop()
+    size = st.st_size
+    pieces = math.ceil(size / piece_length)
+    per_task = max(MIN_TASK_PIECES, math.ceil(pieces / (config.torrent_workers or os.cpu_count())))
+    results = await asyncio.gather(*(
+        loop.run_in_executor(_hashers, _hash_pieces, path, size, piece_length, first, min(first + per_task, pieces))
+        for first in range(0, pieces, per_task)
+    ))
+    sha1 = [h for r in results for h in r[0]]
+    layer = [h for r in results for h in r[1]]
+    _, _, final_blocks, padded = results[-1]
+    if pieces == 1:
+        # a file of one piece has no piece layer, its tree only spans its own blocks
+        root, layer = _merkle_root(final_blocks, _next_pow2(len(final_blocks))), []
+    else:
+        root = _merkle_root(layer, _next_pow2(pieces), _merkle_root([], piece_length // BLOCK))
+    result = FileHashes(sha1=sha1, sha1_padded=padded, root=root, layer=layer)
+    await io_bound(hashes.set, f"torrent:{piece_length}", path, st, result.encode())
+    return result
+
+
+async def file_hashes(path: str, st: os.stat_result, piece_length: int) -> FileHashes:
+    """
+    Piece hashes of a file, from the cache when it hasn't changed since they were computed
+    """
+    pieces = math.ceil(st.st_size / piece_length)
+    cached = await io_bound(hashes.get, f"torrent:{piece_length}", path, st)
+    if cached is not None:
+        return FileHashes.decode(cached, pieces, pieces > 1)
+    return await _hashing.run((path, st.st_size, st.st_mtime_ns, piece_length), _compute, path, st, piece_length)
+
+
+@dataclass(frozen=True)
+class TorrentFile:
+    # path inside the torrent, without the torrent's name for multi-file torrents
+    path: list[str]
+    local_path: str
+    stat: os.stat_result
+
+
+def _missing(files: list[TorrentFile], piece_length: int) -> list[TorrentFile]:
+    return [f for f in files if hashes.get(f"torrent:{piece_length}", f.local_path, f.stat) is None]
+
+
+async def _hash_in_background(f: TorrentFile, piece_length: int, claim: str):
+    started = time.monotonic()
+    try:
+        await file_hashes(f.local_path, f.stat, piece_length)
+        logger.info("Hashed %r in %.0fs", f.local_path, time.monotonic() - started)
+    except Exception:
+        logger.exception("Hashing %r failed", f.local_path)
+    finally:
+        # also when cancelled by a shutdown, so that the next start takes over at once
+        hashes.release(claim)
+
+
+async def prepare(files: list[TorrentFile]) -> bool:
+    """
+    Whether a torrent of files can be made at once; otherwise the missing piece hashes are being computed in the
+    background
+    """
+    files = [f for f in files if f.stat.st_size]
+    piece_length = piece_length_for(sum(f.stat.st_size for f in files))
+    missing = await io_bound(_missing, files, piece_length)
+    if sum(f.stat.st_size for f in missing) <= INLINE_BYTES:
+        return True
+    for f in missing:
+        claim = f"torrent:{piece_length}:{f.local_path}"
+        if await io_bound(hashes.claim, claim, CLAIM_TTL):
+            task = asyncio.create_task(_hash_in_background(f, piece_length, claim))
+            _jobs.add(task)
+            task.add_done_callback(_jobs.discard)
+    return False
+
+
+async def make_torrent(name: str, files: list[TorrentFile], version: str = "hybrid", web_seed: str = None,
+                       trackers: list[str] = ()) -> bytes:
+    """
+    Builds the metainfo of a torrent; a single file with an empty path is a single-file torrent named name
+    """
+    # empty files have no pieces, and there is nothing to download in them
+    files = sorted((f for f in files if f.stat.st_size), key=lambda f: [c.encode() for c in f.path])
+    piece_length = piece_length_for(sum(f.stat.st_size for f in files))
+    all_hashes = await asyncio.gather(*(file_hashes(f.local_path, f.stat, piece_length) for f in files))
+    single = len(files) == 1 and not files[0].path
+
+    info = {"name": name, "piece length": piece_length}
+    torrent = {"created by": "PlexDLWeb", "creation date": int(time.time())}
+    if version in ("v1", "hybrid"):
+        pieces, v1_files = [], []
+        for i, (f, h) in enumerate(zip(files, all_hashes)):
+            size = f.stat.st_size
+            v1_files.append({"length": size, "path": f.path})
+            remainder = size % piece_length
+            if i < len(files) - 1 and remainder:
+                pieces.extend(h.sha1[:-1] + [h.sha1_padded])
+                pad = piece_length - remainder
+                v1_files.append({"attr": "p", "length": pad, "path": [".pad", str(pad)]})
+            else:
+                pieces.extend(h.sha1)
+        info["pieces"] = b"".join(pieces)
+        if single:
+            info["length"] = files[0].stat.st_size
+        else:
+            info["files"] = v1_files
+    if version in ("v2", "hybrid"):
+        info["meta version"] = 2
+        tree = {}
+        for f, h in zip(files, all_hashes):
+            node = tree
+            for component in f.path or [name]:
+                node = node.setdefault(component, {})
+            node[""] = {"length": f.stat.st_size, "pieces root": h.root}
+        info["file tree"] = tree
+        torrent["piece layers"] = {h.root: b"".join(h.layer) for h in all_hashes if h.layer}
+    torrent["info"] = info
+    if web_seed:
+        torrent["url-list"] = [web_seed]
+    if trackers:
+        torrent["announce"] = trackers[0]
+        torrent["announce-list"] = [[t] for t in trackers]
+    return bencode(torrent)
+
+
+def shutdown():
+    for task in _jobs:
+        task.cancel()
+    _hashers.shutdown(wait=False, cancel_futures=True)
+
+
+app.on_shutdown(shutdown)
@@ -0,0 +1,68 @@
+"""
+Standalone app serving media, thumbnails, the Plex proxy and the API from several processes, while the NiceGUI UI
+stays in a single one:
+
+    uv run python worker.py
+
+starts worker_processes uvicorn workers on worker_port. A reverse proxy sends /download, /webseed, /manifest,
+/torrent, /checksum, /thumb, /plex, /api and /metrics to them and everything else to the UI, under the same host name so that
+browsers send the UI's session cookie to the workers.
+
+Stream limits, bandwidth limits and the Transfers page cover every process through the shared transfer table (see
+scheduler.py). What stays per worker: its share of the bandwidth limits, and its token, part and /plex proxy caches,
+which only expire since the library notification listener runs in the UI process alone. The UI process also computes
+the checksums the workers queue, evicts thumbnails for everyone, and copies popular media to the hot tier (counting
+the downloads of every process), which the workers then read from.
+"""
+import os
+from contextlib import asynccontextmanager
+
+import uvicorn
+from fastapi import FastAPI
+
+import api
+import hottier
+import media
+import metrics
+import plex
+import search_index
+import thumbs
+import torrent
+import zipstream
+from common import Overloaded, POOLS
+from config import config
+
+
+@asynccontextmanager
+async def lifespan(_):
+    # what the UI's startup and shutdown hooks do, except for what the UI process does for every process: listening to
+    # library notifications, hashing, evicting thumbnails and managing the hot tier
+    await plex.startup()
+    hottier.attach()
+    await metrics.startup()
+    try:
+        yield
+    finally:
+        await metrics.shutdown()
+        await hottier.shutdown()
+        await plex.shutdown()
+        torrent.shutdown()
+        zipstream.shutdown()
+        search_index.shutdown()
+        for pool in POOLS:
+            pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+app.include_router(media.router)
+app.include_router(plex.router)
+app.include_router(thumbs.router)
+app.include_router(api.router)
+app.include_router(metrics.router)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_exception_handler(Overloaded, media.overloaded)
+app.add_exception_handler(TimeoutError, media.timed_out)
+
+if __name__ == "__main__":
+    uvicorn.run("worker:app", host=config.host, port=config.worker_port,
+                workers=config.worker_processes or os.cpu_count())
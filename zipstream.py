@@ -0,0 +1,343 @@
+"""
+Uncompressed (store mode) ZIP64 archives streamed on the fly from files on disk.
+
+Every header has a fixed size, so the archive's length and the offset of every byte are known before reading any
+file: the response has an exact Content-Length and answers Range requests anywhere in the archive. The only
+values that depend on content are the CRC-32s, which are written after each file (in a data descriptor) and in
+the central directory. They are computed while a file is streamed from its start, or read back from a persistent
+cache, and only when a resumed download skipped part of a file is that file read again to compute its CRC. Beyond
+INLINE_CRC_BYTES of such files, that happens in the background (in one process, the others seeing its claim in the
+cache) while the client is told to come back later.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Optional, Protocol
+from urllib.parse import quote
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import Response
+
+from download import Transfer
+from readahead import Readahead
+
+logger = logging.getLogger("plexdlweb.download")
+
+# flags: bit 3 = sizes and CRC follow the data in a descriptor, bit 11 = UTF-8 names
+FLAGS = 0x0808
+VERSION = 45  # 4.5, ZIP64
+VERSION_MADE_BY = (3 << 8) | VERSION  # Unix
+EXTERNAL_ATTR = 0o100644 << 16
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+LOCAL_ZIP64 = struct.Struct("<HHQQ")
+DESCRIPTOR = struct.Struct("<IIQQ")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+CENTRAL_ZIP64 = struct.Struct("<HHQQQ")
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+END = struct.Struct("<IHHHHIIH")
+CRC_KIND = "crc32"
+# bytes of files read to compute CRCs while answering a request, beyond which they are computed in the background
+INLINE_CRC_BYTES = 1024 ** 3
+CRC_CLAIM_TTL = 3600
+CHUNK_SIZE = 1024 * 1024
+
+_jobs: set[asyncio.Task] = set()
+
+
+class CrcCache(Protocol):
+    def get(self, kind: str, path: str, st: os.stat_result) -> Optional[bytes]: ...
+
+    def set(self, kind: str, path: str, st: os.stat_result, value: bytes): ...
+
+    def claim(self, key: str, ttl: float) -> bool: ...
+
+    def release(self, key: str): ...
+
+
+@dataclass(frozen=True)
+class ZipEntry:
+    name: str
+    path: str
+    stat: os.stat_result
+
+
+def _dos_time(mtime: float) -> tuple[int, int]:
+    t = time.localtime(max(mtime, 315532800))  # 1980-01-01, the DOS epoch
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def _local_header(entry: ZipEntry) -> bytes:
+    name = entry.name.encode()
+    mod_time, mod_date = _dos_time(entry.stat.st_mtime)
+    extra = LOCAL_ZIP64.pack(0x0001, 16, 0, 0)
+    return LOCAL_HEADER.pack(0x04034b50, VERSION, FLAGS, 0, mod_time, mod_date, 0, 0xFFFFFFFF, 0xFFFFFFFF,
+                             len(name), len(extra)) + name + extra
+
+
+def _central_header(entry: ZipEntry, crc: int, offset: int) -> bytes:
+    name = entry.name.encode()
+    mod_time, mod_date = _dos_time(entry.stat.st_mtime)
+    size = entry.stat.st_size
+    extra = CENTRAL_ZIP64.pack(0x0001, 24, size, size, offset)
+    return CENTRAL_HEADER.pack(0x02014b50, VERSION_MADE_BY, VERSION, FLAGS, 0, mod_time, mod_date, crc,
+                               0xFFFFFFFF, 0xFFFFFFFF, len(name), len(extra), 0, 0, 0, EXTERNAL_ATTR,
+                               0xFFFFFFFF) + name + extra
+
+
+def file_crc(path: str) -> int:
+    crc = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+async def _crc_in_background(crc_cache: CrcCache, entry: ZipEntry, claim: str):
+    started = time.monotonic()
+    try:
+        crc = await anyio.to_thread.run_sync(file_crc, entry.path)
+        now = await anyio.to_thread.run_sync(os.stat, entry.path)
+        if (now.st_size, now.st_mtime_ns) != (entry.stat.st_size, entry.stat.st_mtime_ns):
+            logger.info("%r changed while its CRC was computed", entry.path)
+            return
+        await anyio.to_thread.run_sync(crc_cache.set, CRC_KIND, entry.path, entry.stat, crc.to_bytes(4, "big"))
+        logger.info("Computed the CRC of %r in %.0fs", entry.path, time.monotonic() - started)
+    except Exception:
+        logger.exception("Computing the CRC of %r failed", entry.path)
+    finally:
+        # also when cancelled by a shutdown, so that the next start takes over at once
+        crc_cache.release(claim)
+
+
+def shutdown():
+    for task in _jobs:
+        task.cancel()
+
+
+def _central_size(entry: ZipEntry) -> int:
+    return CENTRAL_HEADER.size + len(entry.name.encode()) + CENTRAL_ZIP64.size
+
+
+class ZipStreamResponse(Response):
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self, entries: list[ZipEntry], filename: str, headers: dict | None = None,
+                 crc_cache: CrcCache | None = None, transfer: Transfer | None = None, readahead: int = 0,
+                 drop_behind: bool = True, prefetch: bool = False):
+        self.entries = entries
+        self.crc_cache = crc_cache
+        self.transfer = transfer
+        self.readahead = readahead
+        self.drop_behind = drop_behind
+        self.prefetch = prefetch
+        self._crcs: dict[int, int] = {}
+        self.background = None
+        self.status_code = 200
+        self.media_type = "application/zip"
+
+        # (offset, length, kind, entry index or bytes)
+        self.segments: list[tuple[int, int, str, object]] = []
+        self._offsets: list[int] = []
+        offset = 0
+        for i, entry in enumerate(entries):
+            self._offsets.append(offset)
+            header = _local_header(entry)
+            for kind, value, length in (("bytes", header, len(header)), ("file", i, entry.stat.st_size),
+                                        ("descriptor", i, DESCRIPTOR.size)):
+                self.segments.append((offset, length, kind, value))
+                offset += length
+        central_size = sum(map(_central_size, entries))
+        self._central_offset = offset
+        self.segments.append((offset, central_size, "central", None))
+        offset += central_size
+        end = ZIP64_END.pack(0x06064b50, ZIP64_END.size - 12, VERSION_MADE_BY, VERSION, 0, 0, len(entries),
+                             len(entries), central_size, self._central_offset) \
+            + ZIP64_LOCATOR.pack(0x07064b50, 0, offset, 1) \
+            + END.pack(0x06054b50, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0)
+        self.segments.append((offset, len(end), "bytes", end))
+        self.size = offset + len(end)
+
+        self.init_headers(headers)
+        etag_base = "|".join(f"{e.name}:{e.path}:{e.stat.st_size}:{e.stat.st_mtime_ns}" for e in entries)
+        self.headers.setdefault("etag", f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"')
+        self.headers.setdefault("accept-ranges", "bytes")
+        self.headers.setdefault("content-disposition", f"attachment; filename*=utf-8''{quote(filename)}")
+        self.headers["content-length"] = str(self.size)
+
+    # ---- CRCs
+
+    def _cached_crc(self, i: int) -> Optional[int]:
+        entry = self.entries[i]
+        if self.crc_cache is not None and (cached := self.crc_cache.get(CRC_KIND, entry.path, entry.stat)):
+            return int.from_bytes(cached, "big")
+        return None
+
+    def _read_crc(self, i: int) -> int:
+        if (crc := self._cached_crc(i)) is not None:
+            return crc
+        crc = file_crc(self.entries[i].path)
+        self._store_crc(i, crc)
+        return crc
+
+    def _store_crc(self, i: int, crc: int):
+        entry = self.entries[i]
+        if self.crc_cache is not None:
+            self.crc_cache.set(CRC_KIND, entry.path, entry.stat, crc.to_bytes(4, "big"))
+
+    async def _crc(self, i: int) -> int:
+        if (crc := self._crcs.get(i)) is None:
+            crc = self._crcs[i] = await anyio.to_thread.run_sync(self._read_crc, i)
+        return crc
+
+    def _missing_crcs(self, start: int, end: int) -> list[int]:
+        """
+        Entries whose CRC the range needs without streaming the whole file first, and which aren't cached; blocking
+        """
+        needed, streamed = set(), set()
+        for offset, length, kind, value in self.segments:
+            if offset + length <= start or offset >= end:
+                continue
+            if kind == "descriptor":
+                needed.add(value)
+            elif kind == "central":
+                needed.update(range(len(self.entries)))
+            elif kind == "file" and offset >= start and offset + length <= end:
+                streamed.add(value)
+        missing = []
+        for i in sorted(needed - streamed - self._crcs.keys()):
+            if (crc := self._cached_crc(i)) is None:
+                missing.append(i)
+            else:
+                self._crcs[i] = crc
+        return missing
+
+    async def prepare(self, scope) -> bool:
+        """
+        Whether the requested range can be sent at once; otherwise the CRCs it needs are being computed in the
+        background
+        """
+        start, end = self._parse_range(scope) or (0, self.size)
+        missing = await anyio.to_thread.run_sync(self._missing_crcs, start, end)
+        if self.crc_cache is None or sum(self.entries[i].stat.st_size for i in missing) <= INLINE_CRC_BYTES:
+            return True
+        for i in missing:
+            entry = self.entries[i]
+            claim = f"{CRC_KIND}:{entry.path}"
+            if await anyio.to_thread.run_sync(self.crc_cache.claim, claim, CRC_CLAIM_TTL):
+                task = asyncio.create_task(_crc_in_background(self.crc_cache, entry, claim))
+                _jobs.add(task)
+                task.add_done_callback(_jobs.discard)
+        return False
+
+    # ---- body
+
+    def _segment_bytes(self, kind: str, value, crcs=None) -> bytes:
+        if kind == "bytes":
+            return value
+        if kind == "descriptor":
+            size = self.entries[value].stat.st_size
+            return DESCRIPTOR.pack(0x08074b50, crcs[value], size, size)
+        return b"".join(_central_header(e, crcs[i], self._offsets[i]) for i, e in enumerate(self.entries))
+
+    async def _read_file(self, send_chunk, i: int, start: int, end: int):
+        entry = self.entries[i]
+        file = await anyio.open_file(entry.path, mode="rb")
+        hints = Readahead(file.wrapped.fileno(), start, end, self.readahead, self.drop_behind, self.prefetch)
+        try:
+            await file.seek(start)
+            # a file streamed from its first byte gets its CRC for free
+            crc = 0 if start == 0 else None
+            while start < end:
+                hints.advance(start)
+                chunk = await file.read(min(self.chunk_size, end - start))
+                if not chunk:
+                    raise RuntimeError(f"File at path {entry.path} is shorter than expected.")
+                if crc is not None:
+                    crc = zlib.crc32(chunk, crc)
+                start += len(chunk)
+                await send_chunk(chunk)
+            if crc is not None and end == entry.stat.st_size and i not in self._crcs:
+                self._crcs[i] = crc
+                await anyio.to_thread.run_sync(self._store_crc, i, crc)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await anyio.to_thread.run_sync(hints.close)
+                await file.aclose()
+
+    async def send_range(self, send_chunk, start: int, end: int):
+        for offset, length, kind, value in self.segments:
+            if offset + length <= start or offset >= end:
+                continue
+            lo, hi = max(start, offset) - offset, min(end, offset + length) - offset
+            if kind == "file":
+                await self._read_file(send_chunk, value, lo, hi)
+                continue
+            crcs = None
+            if kind == "descriptor":
+                crcs = {value: await self._crc(value)}
+            elif kind == "central":
+                crcs = {i: await self._crc(i) for i in range(len(self.entries))}
+            await send_chunk(self._segment_bytes(kind, value, crcs)[lo:hi])
+
+    def _parse_range(self, scope) -> Optional[tuple[int, int]]:
+        headers = Headers(scope=scope)
+        http_range = headers.get("range")
+        if_range = headers.get("if-range")
+        if not http_range or (if_range is not None and if_range != self.headers["etag"]):
+            return None
+        units, _, spec = http_range.partition("=")
+        if units.strip().lower() != "bytes" or "," in spec:
+            # only single ranges are supported, answering the whole archive is allowed otherwise
+            return None
+        first, _, last = spec.strip().partition("-")
+        try:
+            if not first:
+                return max(0, self.size - int(last)), self.size
+            return int(first), min(self.size, int(last) + 1) if last else self.size
+        except ValueError:
+            return None
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await self._respond(scope, receive, send)
+        finally:
+            if self.transfer is not None:
+                self.transfer.close()
+
+    async def _respond(self, scope, receive, send) -> None:
+        start, end = 0, self.size
+        status = 200
+        headers = self.headers.mutablecopy()
+        if (requested := self._parse_range(scope)) is not None:
+            start, end = requested
+            if start >= self.size or start >= end:
+                await Response(status_code=416, headers={"content-range": f"bytes */{self.size}"})(scope, receive, send)
+                return
+            status = 206
+            headers["content-range"] = f"bytes {start}-{end - 1}/{self.size}"
+            headers["content-length"] = str(end - start)
+        await send({"type": "http.response.start", "status": status, "headers": headers.raw})
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        async def send_chunk(chunk: bytes):
+            if self.transfer is not None:
+                await self.transfer.pace(len(chunk))
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            if self.transfer is not None:
+                self.transfer.record(len(chunk))
+
+        try:
+            await self.send_range(send_chunk, start, end)
+        except Exception:
+            logger.exception("Bundle download failed while streaming")
+            raise
+        await send({"type": "http.response.body", "body": b"", "more_body": False})